@@ -0,0 +1,165 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Hashable
+from .settings import settings
+from .metrics_utils import QUEUE_WAIT_SECONDS, ADMISSION_REJECTIONS
+
+class QueueFullError(Exception):
+    """
+    Raised when a model's wait queue is full and the request is rejected without waiting.
+    """
+    def __init__(self, model: str, retry_after: int):
+        super().__init__(f"Too many requests queued for model {model}")
+        self.retry_after = retry_after
+
+class AdmissionTimeoutError(Exception):
+    """
+    Raised when a request waited longer than the admission timeout for a generation slot.
+    """
+    def __init__(self, model: str, retry_after: int):
+        super().__init__(f"Timed out waiting for a generation slot on model {model}")
+        self.retry_after = retry_after
+
+class ModelAdmission:
+    """
+    Bounds the concurrent generations of one model and the number of requests waiting for them.
+
+    Up to `max_concurrency` generations run at once. Up to `max_queue` further requests wait
+    for a slot, each for at most `timeout` seconds; beyond that requests are rejected at once.
+    The suggested Retry-After is derived from the average generation time and the queue depth.
+    """
+
+    def __init__(self, model: str, max_concurrency: int, max_queue: int, timeout: float):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        # Exponentially weighted average of the generation time, used for Retry-After
+        self.generation_seconds = 10.0
+
+    def retry_after(self) -> int:
+        """
+        Returns the number of seconds after which the queue is expected to have room again.
+        """
+        return max(1, math.ceil(self.generation_seconds * (self.waiting + 1) / self.max_concurrency))
+
+    def check(self):
+        """
+        Raises QueueFullError if a new request would have to wait and the wait queue is full.
+        """
+        if self.active >= self.max_concurrency and self.waiting >= self.max_queue:
+            self.rejected += 1
+            ADMISSION_REJECTIONS.labels(self.model, "queue_full").inc()
+            raise QueueFullError(self.model, self.retry_after())
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Waits for a generation slot and holds it for the duration of the block.
+        """
+        self.check()
+        self.waiting += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            ADMISSION_REJECTIONS.labels(self.model, "timeout").inc()
+            raise AdmissionTimeoutError(self.model, self.retry_after())
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - start
+        self.admitted += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        QUEUE_WAIT_SECONDS.labels(self.model).observe(waited)
+
+        self.active += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.generation_seconds = 0.8 * self.generation_seconds + 0.2 * (time.monotonic() - start)
+            self.active -= 1
+            self.semaphore.release()
+
+    def stats(self) -> dict:
+        """
+        Returns the queue depth, wait time and outcome counters of the model.
+        """
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_seconds_avg": self.wait_seconds_total / self.admitted if self.admitted else 0.0,
+            "wait_seconds_max": self.wait_seconds_max,
+            "generation_seconds_avg": self.generation_seconds,
+        }
+
+# Admission state per model, created on first use
+admissions: Dict[str, ModelAdmission] = {}
+
+# Generations in progress keyed by (model, standalone question, corpus version)
+in_flight: Dict[Hashable, asyncio.Task] = {}
+coalesced_requests = 0
+
+def get_admission(model: str) -> ModelAdmission:
+    """
+    Returns the admission state of a model, applying its concurrency override from settings.
+
+    Args:
+        model (str): The name of the Ollama model.
+    """
+    if model not in admissions:
+        admissions[model] = ModelAdmission(
+            model,
+            max_concurrency=settings.model_max_concurrency.get(model, settings.max_concurrent_generations),
+            max_queue=settings.max_queued_requests,
+            timeout=settings.queue_timeout_seconds,
+        )
+    return admissions[model]
+
+async def coalesce(key: Hashable, generate: Callable[[], Awaitable]):
+    """
+    Runs `generate` once for all concurrent callers with the same key and shares its result.
+
+    The generation runs in its own task, so a caller that disconnects does not cancel it for
+    the others waiting on the same key.
+
+    Args:
+        key (Hashable): Identifies requests that would produce the same result.
+        generate (Callable[[], Awaitable]): Starts the generation.
+    """
+    global coalesced_requests
+    task = in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(generate())
+        in_flight[key] = task
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+    else:
+        coalesced_requests += 1
+    return await asyncio.shield(task)
+
+def get_admission_stats() -> dict:
+    """
+    Returns the admission statistics of every model and the coalescing counters.
+    """
+    return {
+        "models": {model: admission.stats() for model, admission in admissions.items()},
+        "in_flight": len(in_flight),
+        "coalesced_requests": coalesced_requests,
+    }
@@ -0,0 +1,283 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from sqlalchemy import delete, func, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from .settings import settings
+from .db_utils import EmbeddingCache, SessionLocal, AsyncSessionLocal
+
+def hash_text(text: str) -> str:
+    """
+    Returns the SHA-256 hex digest of a text after collapsing its whitespace.
+    """
+    normalized = " ".join(text.split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that serves repeated texts from the embedding_cache table.
+
+    Entries are keyed by (embedding model, SHA-256 of the normalized text), so the cache
+    is shared by document chunks and query embeddings. Lookups are plain reads: a hit only
+    refreshes last_used_at once it is older than touch_interval seconds, so repeated texts
+    neither rewrite their row nor wait on each other's row locks. The least recently used
+    entries beyond max_entries, accurate to touch_interval, are evicted once every
+    evict_every inserts.
+    """
+
+    def __init__(self, underlying: Embeddings, model: str, max_entries: int, evict_every: int = 1000,
+                 touch_interval: float = 3600):
+        self.underlying = underlying
+        self.model = model
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.touch_interval = timedelta(seconds=touch_interval)
+        self._inserted_since_eviction = 0
+        self._lock = threading.Lock()
+
+    def _stale(self):
+        return EmbeddingCache.last_used_at < func.now() - self.touch_interval
+
+    def _lookup_statement(self, hashes: List[str]):
+        # Fetch the hits and whether their last_used_at is due for a refresh
+        return (
+            select(EmbeddingCache.text_hash, EmbeddingCache.embedding, self._stale().label("stale"))
+            .where(EmbeddingCache.model == self.model, EmbeddingCache.text_hash.in_(hashes))
+        )
+
+    def _touch_statement(self, hashes: List[str]):
+        # The age is checked again on the locked row, so concurrent lookups of an entry touch it once
+        return (
+            update(EmbeddingCache)
+            .where(EmbeddingCache.model == self.model, EmbeddingCache.text_hash.in_(hashes), self._stale())
+            .values(last_used_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+
+    @staticmethod
+    def _hits(rows) -> Tuple[Dict[str, List[float]], List[str]]:
+        # The cached vectors, and the hashes of the hits whose last_used_at should be refreshed
+        cached, stale = {}, []
+        for row in rows:
+            cached[row.text_hash] = list(row.embedding)
+            if row.stale:
+                stale.append(row.text_hash)
+        return cached, stale
+
+    def _insert_statement(self, vectors_by_hash: Dict[str, List[float]]):
+        rows = [{"model": self.model, "text_hash": h, "embedding": vector} for h, vector in vectors_by_hash.items()]
+        return insert(EmbeddingCache).values(rows).on_conflict_do_nothing()
+
+    def _eviction_statement(self):
+        keep = (
+            select(EmbeddingCache.model, EmbeddingCache.text_hash)
+            .order_by(EmbeddingCache.last_used_at.desc())
+            .offset(self.max_entries)
+        )
+        return delete(EmbeddingCache).where(tuple_(EmbeddingCache.model, EmbeddingCache.text_hash).in_(keep))
+
+    def _should_evict(self, inserted: int) -> bool:
+        with self._lock:
+            self._inserted_since_eviction += inserted
+            if self._inserted_since_eviction < self.evict_every:
+                return False
+            self._inserted_since_eviction = 0
+            return True
+
+    @staticmethod
+    def _missing(texts: List[str], hashes: List[str], cached: Dict[str, List[float]]) -> Dict[str, str]:
+        # Deduplicate within the batch as well as against the cache
+        return {h: t for t, h in zip(texts, hashes) if h not in cached}
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        hashes = [hash_text(t) for t in texts]
+        with SessionLocal() as db:
+            cached, stale = self._hits(db.execute(self._lookup_statement(hashes)))
+            if stale:
+                db.execute(self._touch_statement(stale))
+            # Ends the transaction before embedding; without a touch it wrote nothing and commits without a WAL flush
+            db.commit()
+            missing = self._missing(texts, hashes, cached)
+            if missing:
+                vectors = dict(zip(missing, self.underlying.embed_documents(list(missing.values()))))
+                db.execute(self._insert_statement(vectors))
+                if self._should_evict(len(vectors)):
+                    db.execute(self._eviction_statement())
+                db.commit()
+                cached.update(vectors)
+        return [cached[h] for h in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        hashes = [hash_text(t) for t in texts]
+        async with AsyncSessionLocal() as db:
+            cached, stale = self._hits(await db.execute(self._lookup_statement(hashes)))
+            if stale:
+                await db.execute(self._touch_statement(stale))
+            await db.commit()
+            missing = self._missing(texts, hashes, cached)
+            if missing:
+                vectors = dict(zip(missing, await self.underlying.aembed_documents(list(missing.values()))))
+                await db.execute(self._insert_statement(vectors))
+                if self._should_evict(len(vectors)):
+                    await db.execute(self._eviction_statement())
+                await db.commit()
+                cached.update(vectors)
+        return [cached[h] for h in hashes]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+class SemanticAnswerCache:
+    """
+    In-memory cache of generated answers keyed by the embedding of the standalone question.
+
+    A lookup hits when a cached question for the same model, retrieval scope (collection and
+    documents searched) and corpus version has a cosine similarity of at least `threshold` with the new one. Entries expire after `ttl_seconds`,
+    and the least recently used entries are evicted to stay within `max_entries` and
+    `max_bytes`. Entries of older corpus versions are dropped as soon as a newer version is
+    seen, so answers computed against a different document set are never served.
+    """
+
+    def __init__(self, threshold: float, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.corpus_version = 0
+        self.hits = 0
+        self.misses = 0
+        self._next_key = 0
+
+    def _remove(self, key: int):
+        entry = self.entries.pop(key)
+        self.size_bytes -= entry["size_bytes"]
+
+    def _observe_corpus_version(self, corpus_version: int):
+        if corpus_version > self.corpus_version:
+            self.corpus_version = corpus_version
+            for key in [key for key, entry in self.entries.items() if entry["corpus_version"] < corpus_version]:
+                self._remove(key)
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) + 1e-12)
+
+    def lookup(self, model: str, scope: str, corpus_version: int, embedding: List[float]) -> Optional[dict]:
+        """
+        Returns the cached entry (answer and sources) closest to the question, or None on a miss.
+        """
+        self._observe_corpus_version(corpus_version)
+        now = time.monotonic()
+        for key in [key for key, entry in self.entries.items() if now - entry["created_at"] > self.ttl_seconds]:
+            self._remove(key)
+
+        keys = [key for key, entry in self.entries.items()
+                if entry["model"] == model and entry["scope"] == scope and entry["corpus_version"] == corpus_version]
+        if keys:
+            similarities = np.vstack([self.entries[key]["vector"] for key in keys]) @ self._normalize(embedding)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                self.entries.move_to_end(keys[best])
+                self.hits += 1
+                return self.entries[keys[best]]
+        self.misses += 1
+        return None
+
+    def store(self, model: str, scope: str, corpus_version: int, embedding: List[float], answer: str, sources: List[dict]):
+        """
+        Caches an answer for the question embedding, evicting least recently used entries as needed.
+        """
+        self._observe_corpus_version(corpus_version)
+        if corpus_version < self.corpus_version:
+            return
+        vector = self._normalize(embedding)
+        size_bytes = vector.nbytes + len(answer.encode("utf-8")) + sum(len(source.get("content") or "") for source in sources)
+        self.entries[self._next_key] = {
+            "model": model,
+            "scope": scope,
+            "corpus_version": corpus_version,
+            "vector": vector,
+            "answer": answer,
+            "sources": sources,
+            "created_at": time.monotonic(),
+            "size_bytes": size_bytes,
+        }
+        self._next_key += 1
+        self.size_bytes += size_bytes
+        while self.entries and (len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters and the current size of the cache.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "size_bytes": self.size_bytes,
+            "corpus_version": self.corpus_version,
+        }
+
+# Process-wide answer cache used by the chat endpoints
+answer_cache = SemanticAnswerCache(
+    threshold=settings.answer_cache_threshold,
+    max_entries=settings.answer_cache_max_entries,
+    max_bytes=settings.answer_cache_max_bytes,
+    ttl_seconds=settings.answer_cache_ttl_seconds,
+)
+
+class RewriteCache:
+    """
+    In-memory LRU cache of standalone questions keyed by a fingerprint of the rewriter input.
+
+    Entries expire after `ttl_seconds`; the least recently used are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached standalone question, or None on a miss.
+        """
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] <= self.ttl_seconds:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: str, standalone_question: str):
+        self.entries[key] = (standalone_question, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+# Process-wide cache of rewritten follow-up questions
+rewrite_cache = RewriteCache(max_entries=settings.rewrite_cache_max_entries, ttl_seconds=settings.rewrite_cache_ttl_seconds)
@@ -1,9 +1,16 @@
 import os
+import time
 from datetime import datetime
+from functools import cache
+from typing import Collection
 from dotenv import load_dotenv
 from pathlib import Path
-from sqlalchemy import create_engine, Column, Integer, String, TEXT, DateTime, func
+from .settings import settings
+from sqlalchemy import create_engine, Column, Index, Integer, String, TEXT, REAL, DateTime, func, or_, select, text
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 
 # Load environment variables
 load_dotenv(override=True, verbose=True)
@@ -16,10 +23,81 @@ DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
 
 SQLALCHEMY_DATABASE_URL = f"postgresql+psycopg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+
+def engine_options(statement_timeout: bool = False) -> dict:
+    """
+    Returns the pool and connection options shared by the sync and async engines.
+
+    Connections are checked with a ping before use and recycled after `db_pool_recycle`
+    seconds, so idle periods do not surface as errors. psycopg prepares a statement server-side
+    once a connection has run it `db_prepare_threshold` times, which covers the hot retrieval
+    and history queries.
+
+    Args:
+        statement_timeout (bool): Give every session the configured statement_timeout. Only the
+            request-path engine sets it: index builds, migrations and ingestion writes on the sync
+            engine can legitimately run for much longer.
+    """
+    connect_args = {"prepare_threshold": settings.db_prepare_threshold}
+    if statement_timeout and settings.db_statement_timeout_ms:
+        connect_args["options"] = f"-c statement_timeout={int(settings.db_statement_timeout_ms)}"
+    return {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+        "connect_args": connect_args,
+    }
+
+# One sync engine (ingestion threads, admin endpoints) and one async engine (request path) are
+# shared by the ORM and the vector store; psycopg3 drives both. They are created on first use,
+# so importing this module never touches the database.
+@cache
+def get_engine():
+    return create_engine(SQLALCHEMY_DATABASE_URL, **engine_options())
+
+@cache
+def get_async_engine():
+    return create_async_engine(SQLALCHEMY_DATABASE_URL, **engine_options(statement_timeout=True))
+
+class LazySession(Session):
+    """
+    Session bound to the shared sync engine when it first needs a connection.
+    """
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        return get_engine()
+
+class LazyAsyncSyncSession(Session):
+    """
+    The sync half of AsyncSessionLocal sessions, bound to the shared async engine on first use.
+    """
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        return get_async_engine().sync_engine
 
 # Session configuration
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = sessionmaker(class_=LazySession, autocommit=False, autoflush=False)
+AsyncSessionLocal = async_sessionmaker(sync_session_class=LazyAsyncSyncSession, autoflush=False, expire_on_commit=False)
+
+def wait_for_database():
+    """
+    Waits until the database accepts connections, retrying with exponential backoff.
+
+    Raises:
+        OperationalError: If the database is still unreachable after `settings.db_connect_max_attempts` attempts.
+    """
+    delay = settings.db_connect_initial_delay
+    for attempt in range(1, settings.db_connect_max_attempts + 1):
+        try:
+            with get_engine().connect() as conn:
+                conn.execute(text("SELECT 1"))
+            return
+        except OperationalError as e:
+            if attempt == settings.db_connect_max_attempts:
+                raise
+            print(f"Database not reachable (attempt {attempt}/{settings.db_connect_max_attempts}), retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, settings.db_connect_max_delay)
 
 # Declarative base for models
 Base = declarative_base()
@@ -34,51 +112,196 @@ class ApplicationLog(Base):
     model = Column(TEXT, nullable=False)
     created_at = Column(DateTime, server_default=func.now())
 
+    # History is read per session, newest first
+    __table_args__ = (Index("ix_application_logs_session_id_id", "session_id", "id"),)
+
 class DocumentStore(Base):
     __tablename__ = 'document_store'
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(TEXT, nullable=False)
     upload_timestamp = Column(DateTime, server_default=func.now())
+    # One of "pending", "indexing", "indexed", "updating" or "failed"; only indexed and updating documents are listed
+    status = Column(TEXT, nullable=False, server_default="indexed")
+    # SHA-256 of the uploaded bytes, used to short-circuit identical re-uploads
+    content_hash = Column(TEXT, index=True)
+    # Incremented by each update of the document through /update-doc
+    version = Column(Integer, nullable=False, server_default="1")
+    # The tenant collection the document is indexed in
+    collection = Column(TEXT, nullable=False, server_default=settings.default_collection, index=True)
+
+class SessionSummary(Base):
+    __tablename__ = 'session_summaries'
+    session_id = Column(TEXT, primary_key=True)
+    summary = Column(TEXT, nullable=False)
+    # Turns up to and including this application_logs id are folded into the summary
+    last_log_id = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class CorpusVersion(Base):
+    __tablename__ = 'corpus_version'
+    # Single row; the version is bumped whenever the set of indexed documents changes
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+class EmbeddingCache(Base):
+    __tablename__ = 'embedding_cache'
+    model = Column(TEXT, primary_key=True)
+    # SHA-256 of the whitespace-normalized text
+    text_hash = Column(TEXT, primary_key=True)
+    embedding = Column(ARRAY(REAL), nullable=False)
+    last_used_at = Column(DateTime, server_default=func.now(), index=True)
 
 # Function to initialize the database tables
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=get_engine())
+    # create_all does not alter existing tables, so add columns introduced after the first release
+    with get_engine().begin() as conn:
+        conn.execute(text("ALTER TABLE document_store ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'indexed'"))
+        conn.execute(text("ALTER TABLE document_store ADD COLUMN IF NOT EXISTS content_hash TEXT"))
+        conn.execute(text("ALTER TABLE document_store ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1"))
+        conn.execute(text(f"ALTER TABLE document_store ADD COLUMN IF NOT EXISTS collection TEXT NOT NULL DEFAULT '{settings.default_collection}'"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_document_store_collection ON document_store (collection)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_document_store_content_hash ON document_store (content_hash)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_application_logs_session_id_id ON application_logs (session_id, id)"))
 
-def insert_application_logs(db: Session, session_id: str, user_query: str, LLM_response: str, model: str):
+async def ainsert_application_log_batch(db: AsyncSession, rows: list[dict]) -> list[int]:
     """
-    Inserts chat logs into the application_logs table.
+    Asynchronously inserts chat logs with one multi-row INSERT and returns their ids in the order of rows.
+    Each row holds session_id, user_query, LLM_response, model and created_at. The caller commits.
     """
-    log = ApplicationLog(
-        session_id=session_id,
-        user_query=user_query,
-        LLM_response=LLM_response,
-        model=model
+    result = await db.execute(
+        insert(ApplicationLog).returning(ApplicationLog.id, sort_by_parameter_order=True),
+        [{key: row[key] for key in ("session_id", "user_query", "LLM_response", "model", "created_at")} for row in rows],
     )
-    db.add(log)
-    db.commit()
+    return list(result.scalars().all())
 
-def get_chat_history(db: Session, session_id: str):
+async def aget_recent_logs(db: AsyncSession, session_id: str, max_turns: int = 10):
     """
-    Retrieves chat history for a given session_id.
-    Returns a list of messages with roles "human" and "ai".
+    Asynchronously retrieves the summary of a session and its newest max_turns turns that are not
+    yet folded into it. Returns the SessionSummary record (or None) and the ApplicationLog records, oldest first.
     """
-    logs = db.query(ApplicationLog).filter_by(session_id=session_id).order_by(ApplicationLog.created_at).all()
-    history = []
-    for log in logs:
-        history.append({"role": "human", "content": log.user_query})
-        history.append({"role": "ai", "content": log.LLM_response})
-    return history
+    summary = await db.get(SessionSummary, session_id)
+    result = await db.execute(
+        select(ApplicationLog)
+        .where(ApplicationLog.session_id == session_id, ApplicationLog.id > (summary.last_log_id if summary else 0))
+        .order_by(ApplicationLog.id.desc())
+        .limit(max_turns)
+    )
+    return summary, list(reversed(result.scalars().all()))
 
-def insert_document_record(db: Session, filename: str):
+async def aget_session_summary(db: AsyncSession, session_id: str):
     """
-    Inserts a document filename into the document_store table and returns the inserted file_id.
+    Asynchronously retrieves the rolling summary of a session, or None if it has none yet.
     """
-    doc = DocumentStore(filename=filename)
+    return await db.get(SessionSummary, session_id)
+
+async def aget_unsummarized_logs(db: AsyncSession, session_id: str, keep_recent: int):
+    """
+    Asynchronously retrieves the turns of a session that are not in its summary yet,
+    leaving out the newest keep_recent turns. Returns ApplicationLog records, oldest first.
+    """
+    summary = await db.get(SessionSummary, session_id)
+    result = await db.execute(
+        select(ApplicationLog)
+        .where(ApplicationLog.session_id == session_id, ApplicationLog.id > (summary.last_log_id if summary else 0))
+        .order_by(ApplicationLog.id.desc())
+        .offset(keep_recent)
+    )
+    return list(reversed(result.scalars().all()))
+
+async def asave_session_summary(db: AsyncSession, session_id: str, summary: str, last_log_id: int):
+    """
+    Asynchronously inserts or replaces the rolling summary of a session.
+    """
+    statement = insert(SessionSummary).values(session_id=session_id, summary=summary, last_log_id=last_log_id)
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=["session_id"],
+        set_={"summary": statement.excluded.summary, "last_log_id": statement.excluded.last_log_id, "updated_at": func.now()},
+    ))
+    await db.commit()
+
+async def ainsert_document_record(db: AsyncSession, filename: str, status: str = "indexed", content_hash: str = None,
+                                  collection: str = settings.default_collection):
+    """
+    Asynchronously inserts a document filename into the document_store table and returns the inserted file_id.
+    """
+    doc = DocumentStore(filename=filename, status=status, content_hash=content_hash, collection=collection)
     db.add(doc)
-    db.commit()
-    db.refresh(doc)  # Ensure the ID is populated
+    await db.commit()
+    await db.refresh(doc)  # Ensure the ID is populated
     return doc.id
 
+async def aget_document_by_hash(db: AsyncSession, content_hash: str, collection: str = settings.default_collection,
+                                live_file_ids: Collection[int] = ()):
+    """
+    Asynchronously finds a document of the collection with the given content hash that is indexed, or
+    still being indexed by one of the live jobs in live_file_ids. A pending record whose job is gone
+    is not a duplicate, since it will never be indexed.
+    Returns the DocumentStore record, or None if there is no such document.
+    """
+    result = await db.execute(
+        select(DocumentStore)
+        .filter(DocumentStore.content_hash == content_hash, DocumentStore.collection == collection,
+                or_(DocumentStore.status.in_(["indexed", "updating"]),
+                    DocumentStore.status.in_(["pending", "indexing"]) & DocumentStore.id.in_(list(live_file_ids))))
+        .order_by(DocumentStore.id)
+    )
+    return result.scalars().first()
+
+async def aget_document(db: AsyncSession, file_id: int):
+    """
+    Asynchronously retrieves the DocumentStore record with the given file_id, or None if there is none.
+    """
+    return await db.get(DocumentStore, file_id)
+
+def get_document(db: Session, file_id: int):
+    """
+    Retrieves the DocumentStore record with the given file_id, or None if there is none.
+    """
+    return db.get(DocumentStore, file_id)
+
+async def aclaim_document_for_update(db: AsyncSession, file_id: int):
+    """
+    Asynchronously marks an indexed document as updating, so that only one update runs at a time.
+    Returns the version the update will create, or None if the document is not indexed.
+    """
+    version = await db.scalar(
+        DocumentStore.__table__.update()
+        .where(DocumentStore.id == file_id, DocumentStore.status == "indexed")
+        .values(status="updating")
+        .returning(DocumentStore.version + 1)
+    )
+    await db.commit()
+    return version
+
+def finish_document_update(db: Session, file_id: int, filename: str, content_hash: str, version: int):
+    """
+    Records a successfully indexed new version of a document and marks it as indexed again.
+    """
+    db.query(DocumentStore).filter(DocumentStore.id == file_id).update({
+        "filename": filename, "content_hash": content_hash, "version": version,
+        "status": "indexed", "upload_timestamp": func.now(),
+    })
+    db.commit()
+
+def update_document_status(db: Session, file_id: int, status: str):
+    """
+    Updates the indexing status of a document in the document_store table.
+    Returns True if the record was updated, False otherwise.
+    """
+    updated = db.query(DocumentStore).filter(DocumentStore.id == file_id).update({"status": status})
+    db.commit()
+    return updated > 0
+
+def get_interrupted_documents(db: Session, live_file_ids: Collection[int] = ()):
+    """
+    Retrieves the documents left pending, indexing or updating by ingestion jobs that no longer run,
+    i.e. all such documents except those in live_file_ids.
+    """
+    return (db.query(DocumentStore)
+            .filter(DocumentStore.status.in_(["pending", "indexing", "updating"]), DocumentStore.id.notin_(list(live_file_ids)))
+            .order_by(DocumentStore.id).all())
+
 def delete_document_record(db: Session, file_id: int):
     """
     Deletes a document record from the document_store table by file_id.
@@ -91,12 +314,55 @@ def delete_document_record(db: Session, file_id: int):
         return True
     return False
 
-def get_all_documents(db: Session):
+def get_all_documents(db: Session, collection: str = None):
     """
-    Retrieves all documents from the document_store table.
-    Returns a list of dictionaries with id, filename, and upload_timestamp.
+    Retrieves all documents that finished indexing from the document_store table, only those of
+    the collection if one is given.
+    Documents being updated are included, since their previous version stays searchable.
+    Returns a list of dictionaries with id, filename, upload_timestamp, version, status and collection.
     """
-    documents = db.query(DocumentStore).all()
-    return [{"id": doc.id, "filename": doc.filename, "upload_timestamp": doc.upload_timestamp} for doc in documents]
+    query = db.query(DocumentStore).filter(DocumentStore.status.in_(["indexed", "updating"]))
+    if collection is not None:
+        query = query.filter(DocumentStore.collection == collection)
+    return [{"id": doc.id, "filename": doc.filename, "upload_timestamp": doc.upload_timestamp,
+             "version": doc.version, "status": doc.status, "collection": doc.collection} for doc in query.all()]
 
+def bump_corpus_version(db: Session):
+    """
+    Increments the corpus version after documents are indexed or deleted and returns the new version.
+    """
+    statement = insert(CorpusVersion).values(id=1, version=1)
+    version = db.execute(statement.on_conflict_do_update(
+        index_elements=["id"],
+        set_={"version": CorpusVersion.version + 1},
+    ).returning(CorpusVersion.version)).scalar()
+    db.commit()
+    return version
 
+async def aget_corpus_version(db: AsyncSession):
+    """
+    Asynchronously retrieves the current corpus version, 0 if no document change was recorded yet.
+    """
+    return await db.scalar(select(CorpusVersion.version).where(CorpusVersion.id == 1)) or 0
+
+def pool_status(pool) -> dict:
+    """
+    Returns the utilization of a connection pool.
+    """
+    checked_out = pool.checkedout()
+    return {
+        "size": pool.size(),
+        "checked_out": checked_out,
+        "checked_in": pool.checkedin(),
+        # SQLAlchemy counts overflow from -pool_size until the pool is full
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": settings.db_max_overflow,
+        "utilization": round(checked_out / (pool.size() + settings.db_max_overflow), 3),
+        "timeout": settings.db_pool_timeout,
+    }
+
+def get_pool_status() -> dict:
+    """
+    Returns the utilization of the sync and async connection pools.
+    """
+    return {"sync": pool_status(get_engine().pool), "async": pool_status(get_async_engine().sync_engine.pool)}
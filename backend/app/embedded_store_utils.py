@@ -0,0 +1,441 @@
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+MANIFEST_FILE = "manifest.json"
+# Rows scored per matrix product, bounding the float32 copy of float16 segments
+SEARCH_BLOCK_ROWS = 16384
+# Compaction is not worth rewriting the segments below this many deleted rows
+MIN_COMPACTION_ROWS = 1000
+
+def fsync_write(path: Path, data: bytes, mode: str = "ab"):
+    """
+    Writes data to a file and forces it to disk before returning.
+    """
+    with open(path, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def read_json_lines(path: Path) -> List[dict]:
+    """
+    Reads a JSON-lines file written by fsync_write, dropping a torn last line.
+
+    A line that was only partly written before a crash is cut off, so that later appends
+    start on a clean line.
+    """
+    if not path.exists():
+        return []
+    records = []
+    valid_bytes = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+            valid_bytes += len(line)
+    if valid_bytes != path.stat().st_size:
+        with open(path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return records
+
+class Segment:
+    """
+    A fixed-capacity, memory-mapped .npy file of normalized vectors and its metadata side index.
+
+    Row i of the vector file is valid once line i of the .jsonl side index is on disk; the
+    vectors are always flushed before their metadata lines are appended.
+    """
+
+    def __init__(self, directory: Path, name: str, capacity: int, dimension: int, dtype: str):
+        self.name = name
+        self.vector_path = directory / f"{name}.npy"
+        self.metadata_path = directory / f"{name}.jsonl"
+        if self.vector_path.exists():
+            self.vectors = np.load(self.vector_path, mmap_mode="r+")
+        else:
+            self.vectors = np.lib.format.open_memmap(self.vector_path, mode="w+", dtype=dtype, shape=(capacity, dimension))
+        self.capacity = self.vectors.shape[0]
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+        self.file_ids = np.full(self.capacity, -1, dtype=np.int64)
+        self.alive = np.zeros(self.capacity, dtype=bool)
+        for record in read_json_lines(self.metadata_path)[:self.capacity]:
+            self._append_record(record)
+
+    @property
+    def count(self) -> int:
+        return len(self.ids)
+
+    def _append_record(self, record: dict):
+        row = self.count
+        self.ids.append(record["id"])
+        self.texts.append(record["text"])
+        self.metadatas.append(record["metadata"])
+        file_id = record["metadata"].get("file_id")
+        self.file_ids[row] = int(file_id) if file_id is not None else -1
+        self.alive[row] = True
+
+    def append(self, ids: List[str], texts: List[str], metadatas: List[dict], vectors: np.ndarray):
+        """
+        Durably appends rows: vectors first, then the metadata lines that make them visible.
+        """
+        start = self.count
+        self.vectors[start:start + len(ids)] = vectors
+        self.vectors.flush()
+        records = [{"id": i, "text": t, "metadata": m} for i, t, m in zip(ids, texts, metadatas)]
+        fsync_write(self.metadata_path, "".join(json.dumps(r, default=str) + "\n" for r in records).encode("utf-8"))
+        for record in records:
+            self._append_record(record)
+
+    def remove_files(self):
+        for path in (self.vector_path, self.metadata_path):
+            if path.exists():
+                path.unlink()
+
+class NumpyVectorStore(VectorStore):
+    """
+    Embedded vector store keeping float32 or float16 vectors in memory-mapped .npy segments.
+
+    Vectors are normalized on insert, so cosine similarity is a matrix product; a search scores
+    every segment block by block against one or more queries and keeps a running top-k. Each
+    segment has a JSON-lines side index holding the chunk text and metadata, which also serves
+    `file_id` filters. Deletions append ids to a tombstone log, and once the deleted share of
+    rows exceeds `compact_ratio` the live rows are rewritten into a new generation of segments
+    that replaces the old one through an atomic manifest swap.
+
+    Appends are crash-safe: a row only becomes visible once its metadata line is on disk, and
+    a torn line left by a crash is dropped when the store is opened.
+    """
+
+    def __init__(self, path: str, embedding: Embeddings, dimension: int, dtype: str = "float32",
+                 segment_size: int = 16384, compact_ratio: float = 0.25):
+        self.directory = Path(path)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.embedding = embedding
+        self.dimension = dimension
+        self.dtype = dtype
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self._lock = threading.RLock()
+        self._load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    # Manifest and generations
+
+    def _manifest_path(self) -> Path:
+        return self.directory / MANIFEST_FILE
+
+    def _write_manifest(self, generation: int, segment_names: List[str]):
+        manifest = {"generation": generation, "segments": segment_names, "dimension": self.dimension, "dtype": self.dtype}
+        tmp_path = self.directory / f"{MANIFEST_FILE}.tmp"
+        fsync_write(tmp_path, json.dumps(manifest).encode("utf-8"), mode="wb")
+        os.replace(tmp_path, self._manifest_path())
+
+    def _tombstone_path(self, generation: int) -> Path:
+        return self.directory / f"g{generation}-tombstones.jsonl"
+
+    def _load(self):
+        if self._manifest_path().exists():
+            manifest = json.loads(self._manifest_path().read_text())
+            if manifest["dimension"] != self.dimension or manifest["dtype"] != self.dtype:
+                raise ValueError(f"Vector store at {self.directory} holds {manifest['dtype']} vectors of dimension "
+                                 f"{manifest['dimension']}, expected {self.dtype} of dimension {self.dimension}")
+        else:
+            manifest = {"generation": 0, "segments": []}
+            self._write_manifest(0, [])
+        self.generation = manifest["generation"]
+        self.segments = [Segment(self.directory, name, self.segment_size, self.dimension, self.dtype)
+                         for name in manifest["segments"]]
+
+        # Segments missing from the manifest were left over by an interrupted append or compaction
+        keep = {self._tombstone_path(self.generation).name}
+        for segment in self.segments:
+            keep.update((segment.vector_path.name, segment.metadata_path.name))
+        for path in self.directory.glob("g*-*"):
+            if path.name not in keep:
+                path.unlink()
+
+        locations = self._locations()
+        for record in read_json_lines(self._tombstone_path(self.generation)):
+            if record["id"] in locations:
+                segment, row = locations[record["id"]]
+                segment.alive[row] = False
+
+    def _locations(self) -> dict:
+        return {doc_id: (segment, row) for segment in self.segments for row, doc_id in enumerate(segment.ids)}
+
+    def _fill(self, segments: List[Segment], ids: List[str], texts: List[str], metadatas: List[dict], vectors: np.ndarray,
+              generation: Optional[int] = None):
+        """
+        Appends rows to the last segment of the list, adding segments of the given generation
+        (the current one by default) as they fill up.
+        """
+        generation = self.generation if generation is None else generation
+        start = 0
+        while start < len(ids):
+            if not segments or segments[-1].count >= segments[-1].capacity:
+                name = f"g{generation}-segment-{len(segments):05d}"
+                segments.append(Segment(self.directory, name, self.segment_size, self.dimension, self.dtype))
+            segment = segments[-1]
+            end = start + min(len(ids) - start, segment.capacity - segment.count)
+            segment.append(ids[start:end], texts[start:end], metadatas[start:end], vectors[start:end])
+            start = end
+
+    def _normalize(self, vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+
+    # Writes
+
+    def add_embeddings(self, texts: Sequence[str], embeddings: Sequence[List[float]],
+                       metadatas: Optional[Sequence[dict]] = None, ids: Optional[Sequence[str]] = None) -> List[str]:
+        """
+        Appends pre-computed embeddings with their texts and metadata.
+
+        Returns:
+            List[str]: The ids of the added rows.
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in texts]
+        ids = list(ids) if ids is not None else [str(uuid.uuid4()) for _ in texts]
+        vectors = self._normalize(embeddings).astype(self.dtype)
+        with self._lock:
+            segments = list(self.segments)
+            self._fill(segments, ids, texts, metadatas, vectors)
+            if len(segments) != len(self.segments):
+                self._write_manifest(self.generation, [segment.name for segment in segments])
+                self.segments = segments
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        return self.add_embeddings(texts, self.embedding.embed_documents(texts), metadatas, ids)
+
+    def _tombstone(self, rows: List[Tuple[Segment, int]]) -> int:
+        rows = [(segment, row) for segment, row in rows if segment.alive[row]]
+        if rows:
+            lines = "".join(json.dumps({"id": segment.ids[row]}) + "\n" for segment, row in rows)
+            fsync_write(self._tombstone_path(self.generation), lines.encode("utf-8"))
+            for segment, row in rows:
+                segment.alive[row] = False
+            self._maybe_compact()
+        return len(rows)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+        with self._lock:
+            locations = self._locations()
+            return self._tombstone([locations[doc_id] for doc_id in ids if doc_id in locations]) > 0
+
+    def _file_rows(self, file_id: int) -> List[Tuple[Segment, int]]:
+        return [(segment, int(row)) for segment in self.segments
+                for row in np.flatnonzero(segment.alive[:segment.count] & (segment.file_ids[:segment.count] == file_id))]
+
+    def delete_by_file_id(self, file_id: int, version: Optional[int] = None) -> int:
+        """
+        Deletes every chunk of a document, or only the chunks added by one version of it.
+
+        Returns:
+            int: The number of deleted chunks.
+        """
+        with self._lock:
+            rows = self._file_rows(file_id)
+            if version is not None:
+                rows = [(segment, row) for segment, row in rows if segment.metadatas[row].get("version") == version]
+            return self._tombstone(rows)
+
+    def get_file_chunks(self, file_id: int) -> List[Tuple[str, str, dict]]:
+        """
+        Returns the id, text and metadata of every live chunk of a document.
+        """
+        with self._lock:
+            return [(segment.ids[row], segment.texts[row], segment.metadatas[row]) for segment, row in self._file_rows(file_id)]
+
+    def update_metadata(self, updates: List[Tuple[str, dict]]) -> int:
+        """
+        Replaces the metadata of existing chunks without re-embedding them.
+
+        Rows are immutable, so each chunk is appended again under a new id with its stored vector
+        and the new metadata, and the old row is deleted.
+
+        Returns:
+            int: The number of updated chunks.
+        """
+        with self._lock:
+            locations = self._locations()
+            rows = [(locations[doc_id], metadata) for doc_id, metadata in updates if doc_id in locations]
+            if not rows:
+                return 0
+            segments = list(self.segments)
+            self._fill(segments, [str(uuid.uuid4()) for _ in rows], [segment.texts[row] for (segment, row), _ in rows],
+                       [metadata for _, metadata in rows], np.stack([segment.vectors[row] for (segment, row), _ in rows]))
+            if len(segments) != len(self.segments):
+                self._write_manifest(self.generation, [segment.name for segment in segments])
+                self.segments = segments
+            return self._tombstone([location for location, _ in rows])
+
+    def _maybe_compact(self):
+        total = sum(segment.count for segment in self.segments)
+        dead = total - sum(int(segment.alive[:segment.count].sum()) for segment in self.segments)
+        if dead >= MIN_COMPACTION_ROWS and dead > total * self.compact_ratio:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrites the live rows into a new generation of segments and drops the deleted ones.
+
+        The new segments are fully written before the manifest is swapped to them, so a crash
+        leaves either the old or the new generation intact. The store only moves to the new
+        generation once the swap succeeded; on a failure the partial segments are removed and
+        writes keep going to the old generation and its tombstone log.
+        """
+        with self._lock:
+            old_segments = self.segments
+            generation = self.generation + 1
+            segments = []
+            try:
+                for segment in old_segments:
+                    rows = np.flatnonzero(segment.alive[:segment.count])
+                    for start in range(0, len(rows), SEARCH_BLOCK_ROWS):
+                        take = rows[start:start + SEARCH_BLOCK_ROWS]
+                        self._fill(segments, [segment.ids[i] for i in take], [segment.texts[i] for i in take],
+                                   [segment.metadatas[i] for i in take], segment.vectors[take], generation)
+                self._write_manifest(generation, [segment.name for segment in segments])
+            except BaseException:
+                for path in self.directory.glob(f"g{generation}-*"):
+                    path.unlink()
+                raise
+            # Searches already running keep their snapshot of the old segments
+            self.segments = segments
+            self.generation = generation
+            for segment in old_segments:
+                segment.remove_files()
+            old_tombstones = self._tombstone_path(generation - 1)
+            if old_tombstones.exists():
+                old_tombstones.unlink()
+
+    # Search
+
+    def search_batch(self, embeddings: Sequence[List[float]], k: int,
+                     file_ids: Optional[Sequence[int]] = None) -> List[List[Tuple[Document, float, np.ndarray]]]:
+        """
+        Returns the k most similar live chunks for each query embedding.
+
+        Args:
+            embeddings (Sequence[List[float]]): The query embeddings, scored together in one matrix product per block.
+            k (int): The number of results per query.
+            file_ids (Sequence[int], optional): Restricts the search to the chunks of these documents.
+
+        Returns:
+            list: Per query, (document, cosine similarity, stored vector) tuples, most similar first.
+        """
+        queries = self._normalize(embeddings)
+        m = len(queries)
+        top_scores = np.empty((m, 0), dtype=np.float32)
+        top_refs = np.empty((m, 0), dtype=np.int64)
+        segments = list(self.segments)
+        for index, segment in enumerate(segments):
+            count = segment.count
+            for start in range(0, count, SEARCH_BLOCK_ROWS):
+                end = min(start + SEARCH_BLOCK_ROWS, count)
+                mask = segment.alive[start:end]
+                if file_ids is not None:
+                    mask = mask & np.isin(segment.file_ids[start:end], file_ids)
+                if not mask.any():
+                    continue
+                scores = (np.asarray(segment.vectors[start:end], dtype=np.float32) @ queries.T).T
+                scores[:, ~mask] = -np.inf
+                refs = np.broadcast_to((np.int64(index) << 32) | np.arange(start, end, dtype=np.int64), scores.shape)
+                top_scores = np.concatenate([top_scores, scores], axis=1)
+                top_refs = np.concatenate([top_refs, refs], axis=1)
+                if top_scores.shape[1] > k:
+                    keep = np.argpartition(-top_scores, k - 1, axis=1)[:, :k]
+                    top_scores = np.take_along_axis(top_scores, keep, axis=1)
+                    top_refs = np.take_along_axis(top_refs, keep, axis=1)
+
+        results = []
+        for scores, refs in zip(top_scores, top_refs):
+            hits = []
+            for i in np.argsort(-scores):
+                if not np.isfinite(scores[i]):
+                    break
+                segment, row = segments[int(refs[i] >> 32)], int(refs[i] & 0xFFFFFFFF)
+                doc = Document(id=segment.ids[row], page_content=segment.texts[row], metadata=segment.metadatas[row])
+                hits.append((doc, float(scores[i]), np.asarray(segment.vectors[row], dtype=np.float32)))
+            results.append(hits)
+        return results
+
+    def search_candidates(self, embedding: List[float], k: int,
+                          file_ids: Optional[Sequence[int]] = None) -> List[Tuple[Document, float, np.ndarray]]:
+        return self.search_batch([embedding], k, file_ids)[0]
+
+    @staticmethod
+    def _filter_file_ids(filter: Optional[dict]) -> Optional[List[int]]:
+        if not filter or "file_id" not in filter:
+            return None
+        value = filter["file_id"]
+        return [int(v) for v in value] if isinstance(value, (list, tuple, set)) else [int(value)]
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               filter: Optional[dict] = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return [(doc, score) for doc, score, _ in self.search_candidates(embedding, k, self._filter_file_ids(filter))]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4,
+                                    filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4,
+                                     filter: Optional[dict] = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k, filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self):
+        # Scores are already cosine similarities
+        return lambda score: score
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   *, path: str, dimension: int, **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(path, embedding, dimension, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
+
+    def stats(self) -> dict:
+        """
+        Returns the number of segments, live and deleted rows and the size of the vector files.
+        """
+        total = sum(segment.count for segment in self.segments)
+        live = sum(int(segment.alive[:segment.count].sum()) for segment in self.segments)
+        return {
+            "backend": "numpy",
+            "path": str(self.directory),
+            "dtype": self.dtype,
+            "generation": self.generation,
+            "segments": len(self.segments),
+            "rows": total,
+            "live_rows": live,
+            "deleted_rows": total - live,
+            # Segments are preallocated sparse files, so count the blocks actually written
+            "vector_bytes": sum(segment.vector_path.stat().st_blocks * 512 for segment in self.segments),
+        }
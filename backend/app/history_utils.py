@@ -0,0 +1,220 @@
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from .settings import settings
+from .db_utils import AsyncSessionLocal, ainsert_application_log_batch, aget_recent_logs
+from .metrics_utils import CHAT_LOGS_DROPPED
+
+class ApplicationLogWriter:
+    """
+    Write-behind writer of chat logs.
+
+    Turns are buffered in memory and inserted with one multi-row INSERT once `batch_size` turns
+    are waiting or every `flush_interval` seconds, so the request path never waits on the database.
+    A turn keeps its id of None until its batch is committed; a failed batch stays buffered and is
+    retried on the next flush. Buffered turns are lost if the process is killed before a flush.
+    The buffer holds at most `max_rows` turns: once it is full and a flush cannot empty it, new
+    turns are dropped and counted until the database is reachable again.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_rows: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        # Turns not yet committed, oldest first; new turns are only ever appended
+        self.pending: List[dict] = []
+        self.flush_lock = asyncio.Lock()
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.rows_written = 0
+        self.batches_written = 0
+        self.failed_flushes = 0
+        self.dropped_rows = 0
+        # time.monotonic() of the last failed flush, so a full buffer retries at most once per flush_interval
+        self.last_failure: Optional[float] = None
+
+    def start(self):
+        """
+        Starts the background flush loop; must be called from the running event loop.
+        """
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            await self.flush()
+
+    async def add(self, turn: dict) -> bool:
+        """
+        Buffers a turn for insertion.
+
+        Args:
+            turn (dict): session_id, user_query, LLM_response, model, created_at and id (None).
+
+        Returns:
+            bool: False if the buffer is full and the turn was dropped.
+        """
+        # Backpressure: while the database is unreachable the buffer must not grow without bound
+        if len(self.pending) >= self.max_rows:
+            if self.last_failure is None or time.monotonic() - self.last_failure >= self.flush_interval:
+                await self.flush()
+            if len(self.pending) >= self.max_rows:
+                self.dropped_rows += 1
+                CHAT_LOGS_DROPPED.inc()
+                return False
+        self.pending.append(turn)
+        if len(self.pending) >= self.batch_size:
+            self.wake.set()
+        return True
+
+    async def flush(self):
+        """
+        Inserts the buffered turns in batches of `batch_size` until the buffer is empty or a batch fails.
+        """
+        async with self.flush_lock:
+            while self.pending:
+                batch = self.pending[:self.batch_size]
+                try:
+                    async with AsyncSessionLocal() as db:
+                        ids = await ainsert_application_log_batch(db, batch)
+                        await db.commit()
+                        # Set the ids before the session is closed: a history read that runs at that
+                        # await already sees the committed rows and tells them apart from pending turns by id
+                        for turn, log_id in zip(batch, ids):
+                            turn["id"] = log_id
+                        del self.pending[:len(batch)]
+                except Exception as e:
+                    self.failed_flushes += 1
+                    self.last_failure = time.monotonic()
+                    print(f"Error writing {len(batch)} chat logs, they will be retried: {e}")
+                    return
+                self.last_failure = None
+                self.rows_written += len(batch)
+                self.batches_written += 1
+
+    def pending_for(self, session_id: str) -> List[dict]:
+        return [turn for turn in self.pending if turn["session_id"] == session_id]
+
+    async def close(self):
+        """
+        Stops the flush loop and writes what is still buffered.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+        if self.pending:
+            print(f"{len(self.pending)} chat logs could not be written before shutdown")
+
+    def stats(self) -> dict:
+        return {"pending": len(self.pending), "rows_written": self.rows_written,
+                "batches_written": self.batches_written, "failed_flushes": self.failed_flushes, "dropped_rows": self.dropped_rows}
+
+class SessionHistoryCache:
+    """
+    In-memory LRU cache of the recent history of active sessions.
+
+    Each entry holds the session summary and its newest `max_turns` turns that are not folded into
+    the summary, the same window `aget_recent_logs` reads. Entries are appended to when a turn is
+    recorded, so the next turn of an active session needs no database read. On a miss the window is
+    read from the database and merged with the session's turns still waiting in the log writer.
+    """
+
+    def __init__(self, max_sessions: int, max_turns: int):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def append(self, session_id: str, turn: dict):
+        """
+        Adds a turn to a cached session; sessions that are not cached are loaded on their next read.
+        """
+        entry = self.entries.get(session_id)
+        if entry is not None:
+            entry["turns"].append(turn)
+            del entry["turns"][:-self.max_turns]
+
+    def apply_summary(self, session_id: str, summary: str, last_log_id: int):
+        """
+        Replaces the summary of a cached session and drops the turns it now covers.
+        """
+        entry = self.entries.get(session_id)
+        if entry is not None:
+            entry["summary"] = summary
+            entry["turns"] = [turn for turn in entry["turns"] if turn["id"] is None or turn["id"] > last_log_id]
+
+    async def aget(self, db: AsyncSession, session_id: str, writer: ApplicationLogWriter) -> dict:
+        """
+        Returns the cached entry of a session, loading it on a miss.
+        """
+        entry = self.entries.get(session_id)
+        if entry is not None:
+            self.entries.move_to_end(session_id)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        summary, logs = await aget_recent_logs(db, session_id, self.max_turns)
+        turns = [{"id": log.id, "user_query": log.user_query, "LLM_response": log.LLM_response} for log in logs]
+        # Turns committed while the read ran are in both; the writer has already given them their ids
+        loaded_ids = {turn["id"] for turn in turns}
+        turns += [turn for turn in writer.pending_for(session_id) if turn["id"] not in loaded_ids]
+        # A turn may have been recorded and cached while the read ran; keep the entry that has it
+        entry = self.entries.get(session_id)
+        if entry is None:
+            entry = {"summary": summary.summary if summary else None, "turns": turns[-self.max_turns:]}
+            self.entries[session_id] = entry
+            while len(self.entries) > self.max_sessions:
+                self.entries.popitem(last=False)
+        return entry
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "sessions": len(self.entries)}
+
+# Process-wide log writer and history cache; the cache is only consistent within one process
+log_writer = ApplicationLogWriter(batch_size=settings.log_batch_size, flush_interval=settings.log_flush_interval_seconds,
+                                  max_rows=settings.log_buffer_max_rows)
+history_cache = SessionHistoryCache(max_sessions=settings.history_cache_max_sessions, max_turns=settings.history_max_turns)
+
+async def aget_chat_history(db: AsyncSession, session_id: str):
+    """
+    Returns the recent chat history of a session, served from the history cache when the session is active.
+
+    Args:
+        db (AsyncSession): The session used to load the history on a cache miss.
+        session_id (str): The chat session.
+
+    Returns:
+        list: The summary as a "system" message, if any, then "human" and "ai" messages, oldest first.
+    """
+    entry = await history_cache.aget(db, session_id, log_writer)
+    history = []
+    if entry["summary"]:
+        history.append({"role": "system", "content": f"Summary of the earlier conversation: {entry['summary']}"})
+    for turn in entry["turns"]:
+        history.append({"role": "human", "content": turn["user_query"]})
+        history.append({"role": "ai", "content": turn["LLM_response"]})
+    return history
+
+async def arecord_turn(session_id: str, user_query: str, answer: str, model: str):
+    """
+    Records a chat turn: it is added to the cached history at once and written to the database
+    by the log writer in the background.
+    """
+    turn = {"id": None, "session_id": session_id, "user_query": user_query, "LLM_response": answer,
+            "model": model, "created_at": datetime.now()}
+    history_cache.append(session_id, turn)
+    await log_writer.add(turn)
@@ -0,0 +1,181 @@
+import os
+import uuid
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from .settings import settings
+from .db_utils import SessionLocal, update_document_status, finish_document_update, bump_corpus_version, get_interrupted_documents
+from .pgvector_utils import index_document_to_pgvector, delete_doc_from_pgvector, collection_name
+from .parsing_utils import shutdown_parse_pool
+from .upload_utils import UPLOAD_DIR
+
+# Worker pool that runs parse -> split -> embed -> insert off the event loop
+executor = ThreadPoolExecutor(max_workers=settings.ingestion_workers, thread_name_prefix="ingestion")
+
+# In-memory job registry, keyed by job_id. Jobs are tracked per backend process.
+jobs: dict[str, dict] = {}
+jobs_lock = threading.Lock()
+
+def update_job(job_id: str, **fields):
+    """
+    Updates the fields of an ingestion job under the registry lock.
+    """
+    with jobs_lock:
+        jobs[job_id].update(fields)
+
+def get_job(job_id: str):
+    """
+    Returns a snapshot of the ingestion job with the given job_id, or None if it is unknown.
+    """
+    with jobs_lock:
+        job = jobs.get(job_id)
+        return dict(job) if job else None
+
+def list_jobs():
+    """
+    Returns snapshots of all ingestion jobs, most recent first.
+    """
+    with jobs_lock:
+        snapshot = [dict(job) for job in jobs.values()]
+    return sorted(snapshot, key=lambda job: job["created_at"], reverse=True)
+
+def live_file_ids() -> set[int]:
+    """
+    Returns the file_ids of the jobs of this process that are queued or running.
+    """
+    with jobs_lock:
+        return {job["file_id"] for job in jobs.values() if job["status"] in ("queued", "running")}
+
+def reconcile_interrupted_jobs():
+    """
+    Settles the documents and uploaded files left behind by ingestion jobs that died with an earlier process.
+
+    Runs once at startup, before uploads are accepted. A new document left pending or indexing
+    is marked failed and its partial chunks are deleted; an update left updating has the chunks
+    of its new version deleted and the previous version released, as if the job had failed.
+    Every file still in UPLOAD_DIR belonged to such a job and is removed. Jobs are tracked per
+    process, so this assumes a single backend process runs ingestion.
+    """
+    db = SessionLocal()
+    try:
+        for document in get_interrupted_documents(db, live_file_ids()):
+            status = document.status
+            if status == "updating":
+                delete_doc_from_pgvector(db, document.id, version=document.version + 1, collection=document.collection)
+                update_document_status(db, document.id, "indexed")
+            else:
+                delete_doc_from_pgvector(db, document.id, collection=document.collection)
+                update_document_status(db, document.id, "failed")
+            print(f"Settled document {document.id} left {status} by an interrupted ingestion job")
+    finally:
+        db.close()
+    if os.path.isdir(UPLOAD_DIR):
+        for entry in os.scandir(UPLOAD_DIR):
+            if entry.is_file():
+                os.remove(entry.path)
+
+def run_ingestion_job(job_id: str, file_path: str, file_id: int, version: int = 1, filename: str = None, content_hash: str = None,
+                      collection: str = collection_name):
+    """
+    Indexes an uploaded file and records the outcome on both the job and the document record.
+
+    From version 2 on the file is a new version of an indexed document: only its changed chunks
+    are indexed, and on failure the previous version is kept.
+
+    Args:
+        job_id (str): The identifier of the ingestion job.
+        file_path (str): The path of the uploaded file on disk. It is removed once the job ends.
+        file_id (int): The document record the chunks belong to.
+        version (int): The version of the document the file is.
+        filename (str, optional): The name of the new version, recorded once it is indexed.
+        content_hash (str, optional): The SHA-256 of the new version, recorded once it is indexed.
+        collection (str): The collection the document is indexed in.
+    """
+    db = SessionLocal()
+    update = version > 1
+    try:
+        update_job(job_id, status="running")
+        if not update:
+            update_document_status(db, file_id, "indexing")
+
+        success = index_document_to_pgvector(file_path, file_id, progress=lambda **counters: update_job(job_id, **counters),
+                                             version=version, collection=collection)
+
+        if success:
+            if update:
+                finish_document_update(db, file_id, filename, content_hash, version)
+            else:
+                update_document_status(db, file_id, "indexed")
+            # The document is now searchable, so cached answers may be stale
+            bump_corpus_version(db)
+            update_job(job_id, status="completed", finished_at=datetime.now())
+        elif update:
+            # Drop the chunks of the new version; the previous version was left untouched
+            delete_doc_from_pgvector(db, file_id, version=version, collection=collection)
+            update_document_status(db, file_id, "indexed")
+            update_job(job_id, status="failed", finished_at=datetime.now())
+        else:
+            # Drop any batches that were inserted before the failure
+            delete_doc_from_pgvector(db, file_id, collection=collection)
+            update_document_status(db, file_id, "failed")
+            update_job(job_id, status="failed", finished_at=datetime.now())
+    except Exception as e:
+        print(f"Error running ingestion job {job_id}: {e}")
+        if update:
+            # Release the document for later updates
+            update_document_status(db, file_id, "indexed")
+        update_job(job_id, status="failed", error=str(e), finished_at=datetime.now())
+    finally:
+        db.close()
+        # Clean up the uploaded file
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+def submit_ingestion_job(file_path: str, file_id: int, filename: str, version: int = 1, content_hash: str = None,
+                         collection: str = collection_name) -> str:
+    """
+    Queues an uploaded file for indexing and returns the job_id immediately.
+
+    Args:
+        file_path (str): The path of the uploaded file on disk.
+        file_id (int): The document record the chunks belong to.
+        filename (str): The original name of the uploaded file.
+        version (int): The version of the document the file is; above 1 it replaces the indexed version.
+        content_hash (str, optional): The SHA-256 of the file, recorded on the document once an update is indexed.
+        collection (str): The collection the document is indexed in.
+
+    Returns:
+        str: The identifier of the queued job.
+    """
+    job_id = str(uuid.uuid4())
+    with jobs_lock:
+        jobs[job_id] = {
+            "job_id": job_id,
+            "file_id": file_id,
+            "filename": filename,
+            "collection": collection,
+            "version": version,
+            "status": "queued",
+            "pages_parsed": 0,
+            "chunks_total": 0,
+            "load_seconds": None,
+            "split_seconds": None,
+            "chunks_embedded": 0,
+            "chunks_unchanged": 0,
+            "chunks_deleted": 0,
+            "chunks_per_second": None,
+            "embed_seconds": None,
+            "db_seconds": None,
+            "error": None,
+            "created_at": datetime.now(),
+            "finished_at": None,
+        }
+    executor.submit(run_ingestion_job, job_id, file_path, file_id, version, filename, content_hash, collection)
+    return job_id
+
+def shutdown_ingestion():
+    """
+    Stops accepting jobs, cancels those that have not started yet and stops the parser processes.
+    """
+    executor.shutdown(wait=False, cancel_futures=True)
+    shutdown_parse_pool()
@@ -1,15 +1,26 @@
-from langchain_ollama import ChatOllama
 from .settings import settings
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
+from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from typing import List
+import hashlib
+import json
+import re
+from typing import List, Tuple
 from langchain_core.documents import Document
 import os
-from .pgvector_utils import vector_store
+from .retrieval_utils import get_retriever, estimate_tokens
+from .model_utils import get_chat_model
+from .cache_utils import rewrite_cache
+from .metrics_utils import REWRITE_OUTCOMES
+from .db_utils import AsyncSessionLocal, aget_session_summary, aget_unsummarized_logs, asave_session_summary
+from .history_utils import history_cache
 
-retriever = vector_store.as_retriever(search_kwargs={"k": 2})
+
+# Chains built once per model and reused across requests
+contextualize_chains = {}
+answer_chains = {}
+rag_chains = {}
 
 contextualize_q_system_prompt = (
     "Given a chat history and the latest user question "
@@ -32,30 +43,192 @@ qa_prompt = ChatPromptTemplate.from_messages([
     ("human", "{input}")
 ])
 
+def get_contextualize_chain(model: str):
+    """
+    Returns the chain that rewrites a follow-up question into a standalone question, building it on first use.
+
+    Args:
+        model (str): The name of the Ollama model to use.
+    """
+    if model not in contextualize_chains:
+        contextualize_chains[model] = contextualize_q_prompt | get_chat_model(model) | StrOutputParser()
+    return contextualize_chains[model]
+
+# Words that refer back to earlier turns, and openings of elliptical follow-ups ("and the price?")
+BACK_REFERENCE_RE = re.compile(r"\b(it|its|they|them|their|theirs|this|that|these|those|he|him|his|she|her|hers|"
+                               r"there|then|former|latter|above|previous|previously|earlier|same|such|one|ones|"
+                               r"else|again|other|another|more)\b", re.IGNORECASE)
+FOLLOW_UP_START_RE = re.compile(r"^\W*(and|but|so|or|also|what about|how about)\b", re.IGNORECASE)
+# Shorter questions are almost always follow-ups ("why?", "in which year?")
+MIN_SELF_CONTAINED_WORDS = 4
+
+def is_self_contained(question: str) -> bool:
+    """
+    Returns True when a question has no back-references, so it can be searched as it is.
+    """
+    return (len(re.findall(r"\w+", question)) >= MIN_SELF_CONTAINED_WORDS
+            and not BACK_REFERENCE_RE.search(question) and not FOLLOW_UP_START_RE.match(question))
+
+def rewrite_cache_key(model: str, question: str, history: List[dict]) -> str:
+    """
+    Fingerprints the rewriter input: the model, the recent history it sees and the question.
+    """
+    payload = json.dumps([model, question, [(message["role"], message["content"]) for message in history]])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+async def acontextualize_question(model: str, question: str, chat_history: List[dict]) -> Tuple[str, str]:
+    """
+    Returns the question reformulated so that it can be understood without the chat history.
+
+    The rewrite runs on `settings.rewriter_model` (by default a smaller model than the chat
+    model) and only sees the session summary and the last `settings.rewrite_history_messages`
+    messages. The LLM is not called for the first question of a session, for questions
+    without back-references when `settings.rewrite_skip_enabled` is set, or when the same
+    question was rewritten against the same recent history before.
+
+    Args:
+        model (str): The name of the chat model, used when no rewriter model is configured.
+        question (str): The latest user question.
+        chat_history (List[dict]): The session history the question may refer to.
+
+    Returns:
+        tuple: The standalone question and how it was obtained: "first_turn", "skipped", "cached" or "rewritten".
+    """
+    if not chat_history:
+        standalone_question, outcome = question, "first_turn"
+    elif settings.rewrite_skip_enabled and is_self_contained(question):
+        standalone_question, outcome = question, "skipped"
+    else:
+        rewriter = settings.rewriter_model or model
+        system_messages = [message for message in chat_history if message["role"] == "system"]
+        turns = [message for message in chat_history if message["role"] != "system"]
+        history = system_messages + turns[-settings.rewrite_history_messages:]
+        key = rewrite_cache_key(rewriter, question, history)
+        standalone_question = rewrite_cache.get(key)
+        if standalone_question is not None:
+            outcome = "cached"
+        else:
+            outcome = "rewritten"
+            standalone_question = (await get_contextualize_chain(rewriter).ainvoke(
+                {"input": question, "chat_history": history})).strip() or question
+            rewrite_cache.put(key, standalone_question)
+    REWRITE_OUTCOMES.labels(outcome).inc()
+    return standalone_question, outcome
+
+def get_answer_chain(model: str):
+    """
+    Returns the question answer chain of an Ollama model, building it on first use.
+
+    It answers "input" from the documents passed in as "context" and the "chat_history",
+    so callers that retrieve the context themselves can skip the retriever.
+
+    Args:
+        model (str): The name of the Ollama model to use.
+    """
+    if model not in answer_chains:
+        answer_chains[model] = create_stuff_documents_chain(get_chat_model(model), qa_prompt)
+    return answer_chains[model]
+
 def get_rag_chain(model: str):
     """
-    Creates a Retrieval-Augmented Generation (RAG) chain using an Ollama model and a PGVector vector store.
+    Returns the Retrieval-Augmented Generation (RAG) chain of an Ollama model and a PGVector vector store.
+
+    The chain is built on the first request for the model and reused afterwards.
 
-    The RAG chain consists of a history-aware retriever followed by a question answer chain.
-    The history-aware retriever uses the PGVector vector store to retrieve relevant documents based on the chat history.
+    The RAG chain consists of a retriever followed by a question answer chain.
+    The retriever searches the PGVector vector store with the standalone question produced by
+    acontextualize_question, which is passed in as "standalone_question".
     The question answer chain takes the output of the retriever and uses it to generate an answer to the user's question.
 
     Args:
         model (str): The name of the Ollama model to use.
     """
-    llm = ChatOllama(
-        model=model,
-        base_url=settings.ollama_url
-    )
-    
-    # Create a history-aware retriever that uses the PGVector vector store to retrieve relevant documents
-    history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
+    if model in rag_chains:
+        return rag_chains[model]
+
+    # Retrieve with the standalone question rather than the raw follow-up
+    # The retriever runs on the async engine, so chains must be run with ainvoke/astream
+    standalone_retriever = (lambda x: x["standalone_question"]) | get_retriever()
     # Create a question answer chain that takes the output of the retriever and uses it to generate an answer
-    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-    # Create the RAG chain by combining the history-aware retriever and the question answer chain
+    question_answer_chain = get_answer_chain(model)
+    # Create the RAG chain by combining the retriever and the question answer chain
     """
-    The create_retrieval_chain ensures that the retriever (or history-aware retriever) is invoked first to fetch the documents.
+    The create_retrieval_chain ensures that the retriever is invoked first to fetch the documents.
     The retrieved documents are then seamlessly passed as the "context" to the qa_prompt in the question-answering chain.
     """
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)    
+    rag_chain = create_retrieval_chain(standalone_retriever, question_answer_chain)
+    rag_chains[model] = rag_chain
     return rag_chain
+
+summary_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You maintain a concise running summary of a conversation between a user and an AI assistant. "
+               "Fold the new exchanges into the existing summary. Keep facts, names, numbers and open questions "
+               "that later turns may refer to. Reply with the updated summary only."),
+    ("human", "Existing summary:\n{summary}\n\nNew exchanges:\n{transcript}")
+])
+
+# Sessions whose summary is being updated by this process
+summaries_in_progress = set()
+
+def trim_chat_history(chat_history: List[dict], token_budget: int) -> List[dict]:
+    """
+    Trims chat history to a token budget, dropping the oldest turns first.
+
+    Leading system messages (the session summary) are always kept, and a human message is
+    never kept without the AI answer that follows it.
+
+    Args:
+        chat_history (List[dict]): Messages with "role" and "content", oldest first.
+        token_budget (int): The maximum estimated tokens of the kept turns.
+    """
+    system_messages = [message for message in chat_history if message["role"] == "system"]
+    turns = [message for message in chat_history if message["role"] != "system"]
+    kept = []
+    used = 0
+    # Walk back from the newest turn in (human, ai) pairs
+    for end in range(len(turns), 0, -2):
+        pair = turns[max(end - 2, 0):end]
+        tokens = sum(estimate_tokens(message["content"]) for message in pair)
+        if used + tokens > token_budget:
+            break
+        kept = pair + kept
+        used += tokens
+    return system_messages + kept
+
+async def update_session_summary(session_id: str, model: str):
+    """
+    Folds the turns that have left the recent history window into the session's rolling summary.
+
+    Runs after the response has been sent, so the extra LLM call stays off the request path.
+    Nothing happens until at least `settings.summary_min_turns` turns are waiting to be folded.
+    No database connection is held during the LLM call: the turns are read and the summary is
+    saved in two short sessions.
+
+    Args:
+        session_id (str): The chat session to summarize.
+        model (str): The Ollama model used when `settings.summary_model` is not set.
+    """
+    if session_id in summaries_in_progress:
+        return
+    summaries_in_progress.add(session_id)
+    try:
+        async with AsyncSessionLocal() as db:
+            logs = await aget_unsummarized_logs(db, session_id, keep_recent=settings.history_max_turns)
+            if len(logs) < settings.summary_min_turns:
+                return
+            summary = await aget_session_summary(db, session_id)
+            previous_summary = summary.summary if summary else "(none)"
+            transcript = "\n".join(f"User: {log.user_query}\nAssistant: {log.LLM_response}" for log in logs)
+            last_log_id = logs[-1].id
+        llm = get_chat_model(settings.summary_model or model)
+        new_summary = await (summary_prompt | llm | StrOutputParser()).ainvoke({
+            "summary": previous_summary,
+            "transcript": transcript
+        })
+        async with AsyncSessionLocal() as db:
+            await asave_session_summary(db, session_id, new_summary, last_log_id)
+        history_cache.apply_summary(session_id, new_summary, last_log_id)
+    except Exception as e:
+        print(f"Error updating summary for session {session_id}: {e}")
+    finally:
+        summaries_in_progress.discard(session_id)
@@ -1,14 +1,36 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
-from .langchain_utils import get_rag_chain
-from .pydantic_models import QueryInput, QueryResponse, DocumentInfo, DeleteFileRequest
-from .db_utils import (insert_application_logs, get_chat_history, get_all_documents, insert_document_record, delete_document_record,
-                      init_db, SessionLocal)
-from .pgvector_utils import index_document_to_pgvector, delete_doc_from_pgvector
+from fastapi import FastAPI, File, Form, Query, UploadFile, HTTPException, Depends, BackgroundTasks, Request
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
+from .langchain_utils import get_rag_chain, get_answer_chain, acontextualize_question, trim_chat_history, update_session_summary
+from .cache_utils import answer_cache, rewrite_cache
+from .settings import settings
+from .retrieval_utils import retrieval_stats, retrieval_scope, query_embedding, get_retriever, cosine_similarities
+from .pydantic_models import (QueryInput, QueryResponse, SearchInput, SearchResult, BatchQueryInput, DocumentInfo, DeleteFileRequest, JobInfo,
+                              COLLECTION_PATTERN, check_collection_name)
+from .history_utils import aget_chat_history, arecord_turn, log_writer, history_cache
+from .db_utils import (get_all_documents, get_document, ainsert_document_record, aget_document_by_hash, delete_document_record,
+                      aget_corpus_version, bump_corpus_version, aget_document, aclaim_document_for_update, get_pool_status, init_db, wait_for_database, get_async_engine,
+                      SessionLocal, AsyncSessionLocal)
+from .pgvector_utils import (get_embeddings, collection_name, initialize_vector_store, delete_doc_from_pgvector, ensure_vector_indexes, get_vector_index_report,
+                             resolve_search_params, search_params)
+from .model_utils import warm_up_models, get_readiness
+from .admission_utils import get_admission, coalesce, get_admission_stats, QueueFullError, AdmissionTimeoutError
+from .metrics_utils import timed, trace_id, stage_timings, new_trace_id, render_metrics, StageTimingCallback
+from .ingestion_utils import submit_ingestion_job, get_job, list_jobs, shutdown_ingestion, live_file_ids, reconcile_interrupted_jobs
+from .upload_utils import ALLOWED_EXTENSIONS, is_supported, is_archive, save_stream, iter_uploaded_files
+from pydantic import AfterValidator
 from sqlalchemy.orm import Session
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
 import os
 import uuid
+import json
 import logging
-import shutil
+import asyncio
+import threading
+from collections import deque
+from typing import Annotated
 
 # Set up logging
 logging.basicConfig(filename='app.log', level=logging.INFO)
@@ -16,6 +38,10 @@ logging.basicConfig(filename='app.log', level=logging.INFO)
 # Initialize FastAPI app
 app = FastAPI(swagger_ui_parameters={"syntaxHighlight": False})
 
+# Collection form and query parameters, validated like the collection of request bodies
+CollectionForm = Annotated[str, Form(pattern=COLLECTION_PATTERN), AfterValidator(check_collection_name)]
+CollectionQuery = Annotated[str | None, Query(pattern=COLLECTION_PATTERN), AfterValidator(check_collection_name)]
+
 def get_db():
     """
     Get a database session.
@@ -34,24 +60,204 @@ def get_db():
         # Close the session when the generator is exhausted.
         db.close()
 
-"""Initialize the model on startup."""
-@app.on_event("startup")
-async def startup_event():
+async def get_async_db():
+    """
+    Get an asynchronous database session.
+
+    The session is closed automatically when the generator is exhausted.
+
+    Yields:
+        An asynchronous database session (AsyncSession)
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Give each request a trace id (the caller's X-Trace-Id if set) and a fresh record of its stage timings
+    trace = request.headers.get("X-Trace-Id") or new_trace_id()
+    trace_id.set(trace)
+    stage_timings.set({})
+    response = await call_next(request)
+    if settings.trace_ids_enabled:
+        response.headers["X-Trace-Id"] = trace
+    return response
+
+def log_stage_timings(session_id: str, model: str, cached: bool, rewrite: str):
+    """
+    Log the stage durations of the current chat request as one JSON line, tagged with its trace id.
+    `rewrite` tells how the standalone question was obtained; the contextualize stage is its latency.
+    """
+    logging.info(json.dumps({"trace_id": trace_id.get(), "session_id": session_id, "model": model,
+                             "cached": cached, "rewrite": rewrite, "stages": stage_timings.get()}))
+
+# Progress of the background initialization, reported by /ready
+startup_state = {"status": "starting", "error": None}
+
+def initialize_backend():
+    """
+    Wait for the database, create the tables and the vector store, then maintain the vector indexes.
+
+    Runs in a background thread so the server accepts connections (and answers /live) at once.
+    """
     try:
+        wait_for_database()
         init_db()
-        logging.info("Model initialization completed")
+        initialize_vector_store()
+        # Settle the documents of jobs that died with the previous process, before uploads are accepted
+        reconcile_interrupted_jobs()
+        startup_state["status"] = "initialized"
+        logging.info("Database and vector store initialization completed")
     except Exception as e:
+        startup_state.update(status="failed", error=str(e))
         logging.error(f"Error during startup: {str(e)}")
-        raise
+        return
+    # Build or rebuild the vector indexes; CREATE INDEX CONCURRENTLY can take a while
+    ensure_vector_indexes()
+
+"""Initialize the backend on startup."""
+@app.on_event("startup")
+async def startup_event():
+    threading.Thread(target=initialize_backend, name="backend-initialization", daemon=True).start()
+    # Load the LLMs and the embedding model into Ollama; /ready reports when they are resident
+    app.state.warmup_task = asyncio.create_task(warm_up_models())
+    # Flush buffered chat logs in the background; rows wait in memory until the database is up
+    log_writer.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Stop the ingestion worker pool; queued jobs that have not started are cancelled
+    shutdown_ingestion()
+    # Write the chat logs that are still buffered
+    await log_writer.close()
+
+@app.get("/live", summary="Report whether the process is running")
+async def live():
+    """
+    Liveness probe. Answers as soon as the server runs and never touches the database or
+    Ollama, so a slow dependency does not get the process restarted. Only a startup that
+    gave up waiting for the database reports 503, since a restart is what it needs.
+    """
+    if startup_state["status"] == "failed":
+        return JSONResponse({"status": "failed", "error": startup_state["error"]}, status_code=503)
+    return {"status": "alive"}
+
+async def check_database() -> dict:
+    """
+    Check that the database answers a trivial query on the async pool.
+    """
+    try:
+        async with get_async_engine().connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        return {"ok": True}
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+@app.get("/ready", summary="Report whether the backend can serve requests")
+async def ready():
+    """
+    Readiness probe for the load balancer.
+
+    The backend is ready once the startup initialization has finished, the database answers
+    and every model in `settings.warmup_models` is resident in Ollama.
+
+    Returns:
+        JSONResponse: The readiness report, with status 200 when ready and 503 otherwise.
+    """
+    readiness = await get_readiness()
+    readiness["startup"] = dict(startup_state)
+    readiness["database"] = await check_database() if startup_state["status"] == "initialized" else {"ok": False}
+    readiness["ready"] = readiness["ready"] and readiness["database"]["ok"]
+    return JSONResponse(readiness, status_code=200 if readiness["ready"] else 503)
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request, exc: QueueFullError):
+    # The wait queue of the model is full: reject at once and tell the client when to retry
+    return JSONResponse({"detail": str(exc)}, status_code=429, headers={"Retry-After": str(exc.retry_after)})
+
+@app.exception_handler(AdmissionTimeoutError)
+async def admission_timeout_handler(request, exc: AdmissionTimeoutError):
+    # The request waited too long for a generation slot
+    return JSONResponse({"detail": str(exc)}, status_code=503, headers={"Retry-After": str(exc.retry_after)})
+
+@app.get("/health", summary="Report database connection pool utilization")
+def health():
+    """
+    Report the utilization of the sync and async database connection pools shared by the
+    ORM and the vector store, the chat log write buffer and the session history cache.
+
+    Returns:
+        dict: Pool size, checked-out and idle connections and overflow for each pool, buffered
+        and written chat logs, and history cache hits and misses.
+    """
+    return {"database_pools": get_pool_status(), "log_writer": log_writer.stats(), "history_cache": history_cache.stats()}
+
+def set_retrieval_scope(query_input: QueryInput | SearchInput | BatchQueryInput) -> str:
+    """
+    Scope the retrieval of the current request to its collection and documents.
+
+    Returns:
+        str: The scope as a key, so cached and coalesced answers are only shared within the same scope.
+    """
+    collection = query_input.collection or collection_name
+    file_ids = sorted(set(query_input.file_ids)) if query_input.file_ids else None
+    retrieval_scope.set({"collection": collection, "file_ids": file_ids})
+    # The collection's own ANN search parameters apply, unless the request overrides them
+    search_params.set(resolve_search_params(collection, ef_search=query_input.ef_search, probes=query_input.probes))
+    return collection + (":" + ",".join(map(str, file_ids)) if file_ids else "")
+
+async def get_answer_cache_key(model: str, scope: str, corpus_version: int, standalone_question: str):
+    """
+    Build the semantic answer cache key for a question.
+
+    The question embedding is also handed to the retriever of the current request through
+    `query_embedding`, so a cache miss does not embed the question a second time. A request
+    that bypasses the cache still needs the key, since its fresh answer replaces the cached one.
+
+    Args:
+        model (str): The model that generates the answer.
+        scope (str): The collection and documents searched, from set_retrieval_scope.
+        corpus_version (int): The current corpus version.
+        standalone_question (str): The question as rewritten without the chat history.
+
+    Returns:
+        tuple: The model, the scope, the corpus version and the question embedding, or None if the cache is disabled.
+    """
+    if not settings.answer_cache_enabled:
+        return None
+    embedding = await get_embeddings().aembed_query(standalone_question)
+    query_embedding.set((standalone_question, embedding))
+    return model, scope, corpus_version, embedding
+
+async def generate_answer(model: str, chain_input: dict, cache_key):
+    """
+    Run the RAG chain in a generation slot of the model and cache the answer.
+
+    Args:
+        model (str): The model that generates the answer.
+        chain_input (dict): The input, chat history and standalone question passed to the chain.
+        cache_key (tuple): The semantic answer cache key, or None if the cache is disabled.
+
+    Returns:
+        tuple: The answer and the context token counts reported by the retriever.
+    """
+    async with get_admission(model).slot():
+        response = await get_rag_chain(model).ainvoke(chain_input, config={"callbacks": [StageTimingCallback(model)]})
+    if cache_key:
+        answer_cache.store(*cache_key, response["answer"], serialize_sources(response["context"]))
+    return response["answer"], dict(retrieval_stats.get() or {})
 
 @app.post("/chat", response_model=QueryResponse)
-def chat(query_input: QueryInput, db: Session = Depends(get_db)):
+async def chat(query_input: QueryInput, background_tasks: BackgroundTasks):
     """
     Handle chat requests and return AI-generated responses.
 
+    The database is only read in a short session before generation starts, so no pooled
+    connection is held while the request waits for the model.
+
     Args:
         query_input (QueryInput): The input data for the chat, including session ID, question, and model information.
-        db (Session): The database session used for retrieving and storing data.
+        background_tasks (BackgroundTasks): Used to update the session summary after the response is sent.
 
     Returns:
         QueryResponse: The response containing the AI-generated answer, session ID, and model used.
@@ -59,86 +265,513 @@ def chat(query_input: QueryInput, db: Session = Depends(get_db)):
     # Generate or retrieve the session ID, creating a new one if not provided
     session_id = query_input.session_id or str(uuid.uuid4())
     # Log the session ID, user query, and model being used
-    logging.info(f"Session ID: {session_id}, User Query: {query_input.prompt}, Model: {query_input.model.value}")
+    if settings.log_payloads:
+        logging.info(f"Session ID: {session_id}, User Query: {query_input.prompt}, Model: {query_input.model.value}")
+    # Reject at once, before any work is done, when the model's wait queue is full
+    get_admission(query_input.model.value).check()
+
+    # Retrieve the recent chat history for the session, from the history cache when the session is active, trimmed to the token budget,
+    # and the corpus version; the session is closed before the LLM is called
+    with timed("history"):
+        async with AsyncSessionLocal() as db:
+            chat_history = await aget_chat_history(db, session_id)
+            corpus_version = await aget_corpus_version(db)
+        chat_history = trim_chat_history(chat_history, settings.history_token_budget)
+
+    # Search the request's collection and documents, with its ANN search parameters
+    scope = set_retrieval_scope(query_input)
+    # Collect the context token counts reported by the retriever
+    stats = {}
+    retrieval_stats.set(stats)
+
+    # Rewrite a follow-up into a standalone question, used for both retrieval and the answer cache
+    with timed("contextualize"):
+        standalone_question, rewrite = await acontextualize_question(query_input.model.value, query_input.prompt, chat_history)
+
+    # Serve the answer from the semantic answer cache when an equivalent question was answered before
+    with timed("answer_cache"):
+        cache_key = await get_answer_cache_key(query_input.model.value, scope, corpus_version, standalone_question)
+        cached = answer_cache.lookup(*cache_key) if cache_key and not query_input.bypass_cache else None
+
+    if cached:
+        answer = cached["answer"]
+    else:
+        # Identical questions in flight for the same model, scope and corpus version share a single generation
+        answer, stats = await coalesce(
+            (query_input.model.value, scope, standalone_question, corpus_version),
+            lambda: generate_answer(query_input.model.value, {
+                "input": query_input.prompt,
+                "chat_history": chat_history,
+                "standalone_question": standalone_question
+            }, cache_key)
+        )
+
+    # Record the turn in the history cache; the log writer inserts it into the application logs in a later batch
+    with timed("log_insert"):
+        await arecord_turn(session_id, query_input.prompt, answer, query_input.model.value)
+    # Log the session ID and AI-generated response
+    if settings.log_payloads:
+        logging.info(f"Session ID: {session_id}, AI Response: {answer}")
+    # Fold turns that left the history window into the session summary once the response is sent
+    background_tasks.add_task(update_session_summary, session_id, query_input.model.value)
+    log_stage_timings(session_id, query_input.model.value, cached is not None, rewrite)
+
+    # Return the response wrapped in a QueryResponse object
+    return QueryResponse(answer=answer, session_id=session_id, model=query_input.model,
+                         context_tokens_before=stats.get("context_tokens_before"),
+                         context_tokens_after=stats.get("context_tokens_after"),
+                         cached=cached is not None, rewrite=rewrite)
+
+def serialize_sources(documents):
+    """
+    Convert retrieved documents into JSON-serializable source entries.
+
+    Args:
+        documents (list[Document]): The documents returned by the retriever.
+
+    Returns:
+        list[dict]: One entry per document with its file ID, source, page and content.
+    """
+    return [
+        {
+            "file_id": doc.metadata.get("file_id"),
+            "source": doc.metadata.get("source"),
+            "page": doc.metadata.get("page"),
+            "content": doc.page_content,
+        }
+        for doc in documents
+    ]
+
+@app.post("/chat/stream")
+async def chat_stream(query_input: QueryInput):
+    """
+    Handle chat requests and stream the AI-generated response as it is produced.
+
+    The response is a stream of newline-delimited JSON events. A "sources" event with the
+    retrieved documents is sent first, followed by one "token" event per generated chunk and
+    a final "done" event carrying the session ID and model. The full answer is stored in the
+    application logs once generation finishes.
+
+    Args:
+        query_input (QueryInput): The input data for the chat, including session ID, question, and model information.
+
+    Returns:
+        StreamingResponse: An application/x-ndjson stream of chat events.
+    """
+    # Generate or retrieve the session ID, creating a new one if not provided
+    session_id = query_input.session_id or str(uuid.uuid4())
+    # Log the session ID, user query, and model being used
+    if settings.log_payloads:
+        logging.info(f"Session ID: {session_id}, User Query: {query_input.prompt}, Model: {query_input.model.value}")
+    # Reject with 429 while the status can still be sent, before the stream starts
+    admission = get_admission(query_input.model.value)
+    admission.check()
+
+    async def event_stream():
+        try:
+            # Retrieve the recent chat history for the session, from the history cache when active, trimmed to the token budget,
+            # and the corpus version in a short session: no connection is held while the answer streams
+            with timed("history"):
+                async with AsyncSessionLocal() as db:
+                    chat_history = await aget_chat_history(db, session_id)
+                    corpus_version = await aget_corpus_version(db)
+                chat_history = trim_chat_history(chat_history, settings.history_token_budget)
+
+            # Search the request's collection and documents, with its ANN search parameters
+            scope = set_retrieval_scope(query_input)
+            # Collect the context token counts reported by the retriever
+            stats = {}
+            retrieval_stats.set(stats)
+
+            # Rewrite a follow-up into a standalone question, used for both retrieval and the answer cache
+            with timed("contextualize"):
+                standalone_question, rewrite = await acontextualize_question(query_input.model.value, query_input.prompt, chat_history)
+
+            # Serve the answer from the semantic answer cache when an equivalent question was answered before
+            with timed("answer_cache"):
+                cache_key = await get_answer_cache_key(query_input.model.value, scope, corpus_version, standalone_question)
+                cached = answer_cache.lookup(*cache_key) if cache_key and not query_input.bypass_cache else None
+
+            answer_parts = []
+            if cached:
+                yield json.dumps({"type": "sources", "sources": cached["sources"], "cached": True, "rewrite": rewrite}) + "\n"
+                answer_parts.append(cached["answer"])
+                yield json.dumps({"type": "token", "content": cached["answer"]}) + "\n"
+            else:
+                # Get the Retrieval-Augmented Generation (RAG) chain based on the specified model
+                rag_chain = get_rag_chain(query_input.model.value)
+
+                sources = []
+                # Hold a generation slot of the model while the answer streams
+                async with admission.slot():
+                    # Stream the chain: the retrieved context arrives first, then the answer chunks
+                    async for chunk in rag_chain.astream({
+                        "input": query_input.prompt,
+                        "chat_history": chat_history,
+                        "standalone_question": standalone_question
+                    }, config={"callbacks": [StageTimingCallback(query_input.model.value)]}):
+                        if "context" in chunk:
+                            sources = serialize_sources(chunk["context"])
+                            yield json.dumps({"type": "sources", "sources": sources, "rewrite": rewrite,
+                                              "context_tokens_before": stats.get("context_tokens_before"),
+                                              "context_tokens_after": stats.get("context_tokens_after")}) + "\n"
+                        if "answer" in chunk and chunk["answer"]:
+                            answer_parts.append(chunk["answer"])
+                            yield json.dumps({"type": "token", "content": chunk["answer"]}) + "\n"
+                if cache_key:
+                    answer_cache.store(*cache_key, "".join(answer_parts), sources)
+
+            answer = "".join(answer_parts)
+            # Record the turn with the full answer once the stream has finished; it is written in a later batch
+            with timed("log_insert"):
+                await arecord_turn(session_id, query_input.prompt, answer, query_input.model.value)
+            # Log the session ID and AI-generated response
+            if settings.log_payloads:
+                logging.info(f"Session ID: {session_id}, AI Response: {answer}")
+
+            log_stage_timings(session_id, query_input.model.value, cached is not None, rewrite)
+            yield json.dumps({"type": "done", "session_id": session_id, "model": query_input.model.value,
+                              "cached": cached is not None}) + "\n"
+        except Exception as e:
+            # Headers are already sent, so report the failure as a final event
+            logging.error(f"Error while streaming chat for session {session_id}: {str(e)}")
+            yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+
+    # The session summary is updated once the stream has been sent
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson",
+                             background=BackgroundTask(update_session_summary, session_id, query_input.model.value))
+
+@app.post("/search", response_model=list[SearchResult])
+async def search(search_input: SearchInput) -> list[SearchResult]:
+    """
+    Return the chunks most similar to a query, without generating an answer.
 
-    # Retrieve chat history for the session from the database
-    chat_history = get_chat_history(db, session_id)
+    The query is searched like the vector leg of a chat, in the request's collection and
+    documents and with its ANN search parameters, but neither rewritten nor re-ranked.
 
-    # Get the Retrieval-Augmented Generation (RAG) chain based on the specified model
-    rag_chain = get_rag_chain(query_input.model.value)
+    Args:
+        search_input (SearchInput): The query, the number of chunks and the scope to search.
 
-    # Invoke the RAG chain to get the AI-generated response based on user input and chat history
-    response = rag_chain.invoke({
-        "input": query_input.prompt,
-        "chat_history": chat_history
-    })
+    Returns:
+        list[SearchResult]: The k most similar chunks, most similar first, with their cosine similarity and metadata.
+    """
+    set_retrieval_scope(search_input)
+    # HNSW returns at most ef_search rows, which must cover k
+    params = search_params.get()
+    params["ef_search"] = max(int(params["ef_search"]), search_input.k)
+
+    retriever = get_retriever()
+    with timed("embed", pipeline="search"):
+        embedding = await retriever.embeddings.aembed_query(search_input.query)
+    with timed("retrieve", pipeline="search"):
+        candidates = (await retriever.avector_search_batch([embedding], search_input.k))[0]
+    return [
+        SearchResult(content=doc.page_content, score=score, file_id=doc.metadata.get("file_id"),
+                     source=doc.metadata.get("source"), page=doc.metadata.get("page"), metadata=doc.metadata)
+        for (doc, _), score in zip(candidates, cosine_similarities(embedding, candidates))
+    ]
+
+@app.post("/chat/batch")
+async def chat_batch(batch_input: BatchQueryInput):
+    """
+    Answer many independent prompts and stream each result as soon as it is generated.
 
-    # Extract the answer from the response
-    answer = response['answer']
+    Prompts are processed in blocks of `settings.batch_block_size`: each block is embedded with
+    one embed_documents call and its vector (and full-text) searches run in one round trip.
+    The next block is retrieved while the current one is answered, and at most
+    `settings.batch_generation_concurrency` answers of the batch are generated at once, each
+    in a generation slot of the model. Prompts have no chat history, and the answer cache and
+    application logs are not used.
 
-    # Insert a log entry into the application logs for monitoring and analysis
-    insert_application_logs(db, session_id, query_input.prompt, answer, query_input.model.value)
-    # Log the session ID and AI-generated response
-    logging.info(f"Session ID: {session_id}, AI Response: {answer}")
+    The response is a stream of newline-delimited JSON events: one "result" event per prompt,
+    in completion order, with its index in the request, answer and sources (or an "error"
+    event with its index), and a final "done" event with the number of prompts and failures.
 
-    # Return the response wrapped in a QueryResponse object
-    return QueryResponse(answer=answer, session_id=session_id, model=query_input.model)
+    Args:
+        batch_input (BatchQueryInput): The prompts, the model and the scope to search.
+
+    Returns:
+        StreamingResponse: An application/x-ndjson stream of batch events.
+    """
+    prompts = batch_input.prompts
+    if len(prompts) > settings.batch_max_prompts:
+        raise HTTPException(status_code=422, detail=f"At most {settings.batch_max_prompts} prompts are accepted per batch")
+    model = batch_input.model.value
+    # Reject with 429 while the status can still be sent, before the stream starts
+    admission = get_admission(model)
+    admission.check()
+
+    async def event_stream():
+        # Search the request's collection and documents; the tasks below inherit the scope
+        set_retrieval_scope(batch_input)
+        retriever = get_retriever()
+        answer_chain = get_answer_chain(model)
+        events = asyncio.Queue()
+        generations = asyncio.Semaphore(settings.batch_generation_concurrency)
+        answer_tasks = set()
+
+        async def answer(index: int, documents):
+            try:
+                async with generations, admission.slot():
+                    response = await answer_chain.ainvoke({"input": prompts[index], "chat_history": [], "context": documents},
+                                                          config={"callbacks": [StageTimingCallback(model)]})
+                await events.put({"type": "result", "index": index, "prompt": prompts[index], "answer": response,
+                                  "sources": serialize_sources(documents)})
+            except Exception as e:
+                logging.error(f"Error while answering prompt {index} of a batch: {str(e)}")
+                await events.put({"type": "error", "index": index, "detail": str(e)})
+
+        async def retrieve():
+            # Answer tasks per block; with two blocks being answered, the next waits for the oldest to finish
+            blocks = deque()
+            try:
+                for start in range(0, len(prompts), settings.batch_block_size):
+                    if len(blocks) >= 2:
+                        await asyncio.wait(blocks.popleft())
+                    block = prompts[start:start + settings.batch_block_size]
+                    try:
+                        with timed("embed", pipeline="batch"):
+                            embeddings = await retriever.embeddings.aembed_documents(block)
+                        with timed("retrieve", pipeline="batch"):
+                            contexts = await retriever.aretrieve_batch(block, embeddings)
+                    except Exception as e:
+                        logging.error(f"Error while retrieving prompts {start} to {start + len(block) - 1} of a batch: {str(e)}")
+                        for index in range(start, start + len(block)):
+                            await events.put({"type": "error", "index": index, "detail": str(e)})
+                        continue
+                    tasks = [asyncio.create_task(answer(start + offset, documents)) for offset, documents in enumerate(contexts)]
+                    answer_tasks.update(tasks)
+                    blocks.append(tasks)
+                for tasks in blocks:
+                    await asyncio.wait(tasks)
+            finally:
+                await events.put(None)
+
+        producer = asyncio.create_task(retrieve())
+        failed = 0
+        try:
+            while (event := await events.get()) is not None:
+                failed += event["type"] == "error"
+                yield json.dumps(event) + "\n"
+            yield json.dumps({"type": "done", "count": len(prompts), "failed": failed}) + "\n"
+        finally:
+            # Stop retrieving and generating when the client disconnects
+            producer.cancel()
+            for task in answer_tasks:
+                task.cancel()
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+def check_file_type(filename: str):
+    """
+    Raise an HTTPException if the file type is not supported.
+    """
+    # Check if the file extension is allowed
+    if not is_supported(filename):
+        raise HTTPException(status_code=400, detail=f"Unsupported file type. Allowed types are: {', '.join(ALLOWED_EXTENSIONS)}")
+
+def check_accepting_uploads():
+    """
+    Raise an HTTPException (503) until startup has finished, so no upload races the settling of
+    documents left behind by interrupted ingestion jobs.
+    """
+    if startup_state["status"] != "initialized":
+        raise HTTPException(status_code=503, detail="The backend is still starting, please retry shortly.",
+                            headers={"Retry-After": "5"})
+
+async def save_upload(file: UploadFile):
+    """
+    Save an uploaded file under a unique temporary name without blocking the event loop, hashing it on the way.
+
+    Returns:
+        tuple: The path of the temporary file and the SHA-256 of its content.
+    """
+    return await run_in_threadpool(save_stream, file.file, file.filename)
+
+async def queue_document(db: AsyncSession, filename: str, temp_file_path: str, content_hash: str, collection: str) -> dict:
+    """
+    Create a pending document record for a saved upload and queue it for indexing in a collection.
+
+    A byte-identical re-upload to the same collection is short-circuited to the existing document and its file removed.
+
+    Returns:
+        dict: The filename, file ID, job ID (None for duplicates) and whether the file was a duplicate.
+    """
+    try:
+        existing = await aget_document_by_hash(db, content_hash, collection, live_file_ids())
+        if existing is not None:
+            os.remove(temp_file_path)
+            return {"filename": filename, "file_id": existing.id, "job_id": None, "duplicate": True, "existing_filename": existing.filename}
+
+        # Insert a pending document record and obtain a unique file ID
+        file_id = await ainsert_document_record(db, filename, status="pending", content_hash=content_hash, collection=collection)
+    except Exception:
+        # The job never started, so nobody else will clean up the temporary file
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
+
+    # Queue the document for indexing; the job removes the temporary file when it ends
+    job_id = submit_ingestion_job(temp_file_path, file_id, filename, collection=collection)
+    return {"filename": filename, "file_id": file_id, "job_id": job_id, "duplicate": False}
 
 @app.post("/upload-doc")
-async def upload_and_index_document(file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def upload_and_index_document(file: UploadFile = File(...), collection: CollectionForm = collection_name,
+                                    db: AsyncSession = Depends(get_async_db)):
     """
-    Upload and index a document.
+    Upload a document and queue it for indexing.
 
-    This endpoint allows the user to upload a document file, which is then saved
-    temporarily, indexed, and stored with a unique identifier.
+    This endpoint saves the uploaded file under a unique temporary name, creates a pending
+    document record and hands the file to the ingestion worker pool. It returns as soon as
+    the job is queued; progress can be followed through the /jobs endpoints.
 
     Args:
         file (UploadFile): The document file to be uploaded.
+        collection (str): The tenant collection to index the document in.
+        db (AsyncSession): The asynchronous database session used to create the document record.
 
     Returns:
-        dict: A dictionary containing a success message and the file ID if the operation
-        is successful.
+        dict: A dictionary containing a message, the file ID, the ingestion job ID and whether the
+        upload duplicated an existing document, in which case no job is queued.
 
     Raises:
-        HTTPException: If the file type is unsupported or if indexing fails.
+        HTTPException: If the file type is unsupported (400) or the backend is still starting (503).
+    """
+    check_file_type(file.filename)
+    check_accepting_uploads()
+    temp_file_path, content_hash = await save_upload(file)
+    result = await queue_document(db, file.filename, temp_file_path, content_hash, collection)
+    if result["duplicate"]:
+        return {"message": f"File {file.filename} is identical to {result['existing_filename']}, which is already uploaded.",
+                "file_id": result["file_id"], "job_id": None, "duplicate": True}
+    return {"message": f"File {file.filename} has been uploaded and queued for indexing.", "file_id": result["file_id"],
+            "job_id": result["job_id"], "duplicate": False}
+
+@app.post("/upload-docs")
+async def upload_and_index_documents(files: list[UploadFile] = File(...), collection: CollectionForm = collection_name,
+                                     db: AsyncSession = Depends(get_async_db)):
     """
-    allowed_extensions = ['.pdf', '.docx', '.html']
-    file_extension = os.path.splitext(file.filename)[1].lower()
+    Upload several documents, or zip/tar archives of documents, and queue them for indexing.
 
-    # Check if the file extension is allowed
-    if file_extension not in allowed_extensions:
-        raise HTTPException(status_code=400, detail=f"Unsupported file type. Allowed types are: {', '.join(allowed_extensions)}")
+    Archives are read member by member and each supported document is streamed to its own
+    uniquely named temporary file, so neither the archive nor its documents are held in memory.
+    Every document gets its own ingestion job; the jobs run concurrently on the ingestion worker
+    pool, at most `settings.ingestion_workers` at a time.
 
-    # Determine temp_file_path
-    upload_dir = "uploads"
-    os.makedirs(upload_dir, exist_ok=True)
-    temp_file_path = os.path.join(upload_dir, file.filename)
+    Args:
+        files (list[UploadFile]): The documents and archives to upload.
+        collection (str): The tenant collection to index the documents in.
+        db (AsyncSession): The asynchronous database session used to create the document records.
 
-    try:
-        # Save the uploaded file to a temporary file
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+    Returns:
+        dict: The result of each file (status "queued", "duplicate", "skipped" or "error", with its
+        file ID and job ID when it has one) and the number of files with each status.
+
+    Raises:
+        HTTPException: If the backend is still starting (503).
+    """
+    check_accepting_uploads()
+    results = []
+    for file in files:
+        if not is_supported(file.filename) and not is_archive(file.filename):
+            results.append({"filename": file.filename, "status": "skipped",
+                            "detail": f"Unsupported file type. Allowed types are: {', '.join(ALLOWED_EXTENSIONS)} or a zip/tar archive of them"})
+            continue
+        # Extraction is blocking I/O, so each member is read and saved in the threadpool
+        async for saved in iterate_in_threadpool(iter_uploaded_files(file.file, file.filename)):
+            if "path" not in saved:
+                results.append(saved)
+                continue
+            queued = await queue_document(db, saved["filename"], saved["path"], saved["content_hash"], collection)
+            results.append({"filename": queued["filename"], "status": "duplicate" if queued["duplicate"] else "queued",
+                            "file_id": queued["file_id"], "job_id": queued["job_id"]})
+    counts = {status: sum(result["status"] == status for result in results) for status in ("queued", "duplicate", "skipped", "error")}
+    return {"files": results, "counts": counts}
+
+@app.post("/update-doc")
+async def update_document(file_id: int = Form(...), file: UploadFile = File(...), db: AsyncSession = Depends(get_async_db)):
+    """
+    Upload a new version of an indexed document and queue it for incremental re-indexing.
 
-        # Insert the document record and obtain a unique file ID
-        file_id = insert_document_record(db, file.filename)
+    The new version is split and diffed against the stored chunks by chunk hash: only changed
+    chunks are embedded and inserted, unchanged chunks keep their rows and chunks that
+    disappeared are deleted. The previous version stays searchable until the job completes,
+    and is kept if it fails.
 
-        # Index the document to Pgvector
-        success = index_document_to_pgvector(temp_file_path, file_id)
+    Args:
+        file_id (int): The document to update.
+        file (UploadFile): The new version of the document.
+        db (AsyncSession): The asynchronous database session used to look up and claim the document record.
 
-        if success:
-            # Return a success message and the file ID if indexing is successful
-            return {"message": f"File {file.filename} has been successfully uploaded and indexed.", "file_id": file_id}
-        else:
-            # If indexing fails, delete the document record and raise an exception
-            delete_document_record(db, file_id)
-            raise HTTPException(status_code=500, detail=f"Failed to index {file.filename}.")
-    finally:
-        # Clean up the temporary file
+    Returns:
+        dict: A dictionary containing a message, the file ID, the ingestion job ID and the version
+        being indexed. No job is queued if the file is identical to the indexed version.
+
+    Raises:
+        HTTPException: If the file type is unsupported (400), the document does not exist (404),
+        it is still being indexed or updated (409) or the backend is still starting (503).
+    """
+    check_file_type(file.filename)
+    check_accepting_uploads()
+    document = await aget_document(db, file_id)
+    if document is None or document.status == "failed":
+        raise HTTPException(status_code=404, detail=f"Document {file_id} not found.")
+    if document.status != "indexed":
+        raise HTTPException(status_code=409, detail=f"Document {file_id} is still being indexed or updated.")
+
+    temp_file_path, content_hash = await save_upload(file)
+    try:
+        if content_hash == document.content_hash:
+            os.remove(temp_file_path)
+            return {"message": f"File {file.filename} is identical to the indexed version of {document.filename}.",
+                    "file_id": file_id, "job_id": None, "version": document.version, "unchanged": True}
+
+        # Only one update of a document runs at a time
+        version = await aclaim_document_for_update(db, file_id)
+        if version is None:
+            raise HTTPException(status_code=409, detail=f"Document {file_id} is still being indexed or updated.")
+    except Exception:
         if os.path.exists(temp_file_path):
             os.remove(temp_file_path)
+        raise
+
+    # Queue the new version; the job removes the temporary file when it ends
+    job_id = submit_ingestion_job(temp_file_path, file_id, file.filename, version=version, content_hash=content_hash,
+                                  collection=document.collection)
+    return {"message": f"File {file.filename} has been uploaded and queued as version {version} of document {file_id}.",
+            "file_id": file_id, "job_id": job_id, "version": version, "unchanged": False}
+
+@app.get("/jobs", response_model=list[JobInfo], summary="Get a list of ingestion jobs")
+def list_ingestion_jobs() -> list[JobInfo]:
+    """
+    Get a list of the ingestion jobs known to this backend process, most recent first.
+
+    Returns:
+        list[JobInfo]: The status and progress of each job.
+    """
+    return list_jobs()
+
+@app.get("/jobs/{job_id}", response_model=JobInfo, summary="Get the status of an ingestion job")
+def get_ingestion_job(job_id: str) -> JobInfo:
+    """
+    Get the status and progress of a single ingestion job.
+
+    Args:
+        job_id (str): The job ID returned by /upload-doc.
+
+    Returns:
+        JobInfo: Pages parsed, chunks embedded and any failure for the job.
+
+    Raises:
+        HTTPException: If the job is unknown.
+    """
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job
 
 @app.get("/list-docs", response_model=list[DocumentInfo], summary="Get a list of all indexed documents")
-def list_documents(db: Session = Depends(get_db)) -> list[DocumentInfo]:
+def list_documents(collection: CollectionQuery = None, db: Session = Depends(get_db)) -> list[DocumentInfo]:
     """
     Get a list of all indexed documents.
 
@@ -146,13 +779,14 @@ def list_documents(db: Session = Depends(get_db)) -> list[DocumentInfo]:
     of the indexed document.
 
     Args:
+        collection (str, optional): Only list the documents of this tenant collection.
         db (Session): The database session to use for the query.
 
     Returns:
         list[DocumentInfo]: A list of DocumentInfo objects, each containing the file ID, file name, and file extension
             of the indexed document.
     """
-    return get_all_documents(db)
+    return get_all_documents(db, collection)
 
 @app.post("/delete-doc")
 def delete_document(request: DeleteFileRequest, db: Session = Depends(get_db)):
@@ -162,19 +796,30 @@ def delete_document(request: DeleteFileRequest, db: Session = Depends(get_db)):
     This endpoint will delete a document from the system. This includes deleting the document from the database and from the Pgvector index.
 
     Args:
-        request (DeleteFileRequest): The DeleteFileRequest object containing the file ID of the document to be deleted.
+        request (DeleteFileRequest): The DeleteFileRequest object containing the file ID of the document to be deleted,
+            and optionally the collection it must belong to.
         db (Session): The database session to use for the query.
 
     Returns:
         dict: A dictionary containing a message or an error message depending on whether the deletion is successful or not.
+
+    Raises:
+        HTTPException: If the document does not belong to the requested collection.
     """
+    document = get_document(db, request.file_id)
+    if document is not None and request.collection is not None and document.collection != request.collection:
+        raise HTTPException(status_code=404, detail=f"Document {request.file_id} not found in collection {request.collection}.")
+    collection = document.collection if document is not None else request.collection or collection_name
+
     # Delete the document from Pgvector first
-    pgvector_delete_success = delete_doc_from_pgvector(db, request.file_id)
+    pgvector_delete_success = delete_doc_from_pgvector(db, request.file_id, collection=collection)
 
     # Check if the deletion from Pgvector was successful
     if pgvector_delete_success:
         # Delete the document record from the database
         db_delete_success = delete_document_record(db, request.file_id)
+        # The document is no longer searchable, so cached answers may be stale
+        bump_corpus_version(db)
 
         # Check if the deletion from the database was successful
         if db_delete_success:
@@ -187,3 +832,58 @@ def delete_document(request: DeleteFileRequest, db: Session = Depends(get_db)):
         # Return an error message if the deletion failed from Pgvector
         return {"error": f"Failed to delete document with file_id {request.file_id} from Pgvector."}
 
+@app.get("/admin/index", summary="Report the state of the vector indexes")
+def vector_index_report(sample_size: int = 20, k: int = 10, collection: CollectionQuery = None,
+                        db: Session = Depends(get_db)):
+    """
+    Report the vector and metadata indexes on the embedding table.
+
+    The report contains the configured index type and build parameters, the size and validity
+    of each index, any index build in progress and, for each collection, the indexes on its
+    partition and the recall@k of the ANN index measured against an exact scan over a random
+    sample of its stored embeddings.
+
+    Args:
+        sample_size (int): The number of stored embeddings of each collection used as recall queries.
+        k (int): The number of neighbours compared per query.
+        collection (str, optional): Only report this collection; all collections by default.
+        db (Session): The database session to use for the query.
+
+    Returns:
+        dict: The index report.
+    """
+    return get_vector_index_report(db, sample_size=sample_size, k=k, collection=collection)
+
+@app.get("/admin/answer-cache", summary="Report the semantic answer cache counters")
+def answer_cache_report():
+    """
+    Report the hit and miss counters, size and corpus version of the semantic answer cache,
+    and the counters of the follow-up rewrite cache.
+
+    Returns:
+        dict: The answer cache statistics of this backend process.
+    """
+    return {**answer_cache.stats(), "rewrite_cache": rewrite_cache.stats()}
+
+@app.get("/admin/admission", summary="Report queue depth and wait times per model")
+def admission_report():
+    """
+    Report the admission control state: active generations, queue depth, wait times,
+    rejections and coalesced requests.
+
+    Returns:
+        dict: The admission statistics of this backend process.
+    """
+    return get_admission_stats()
+
+@app.get("/metrics", summary="Prometheus metrics")
+def metrics():
+    """
+    Expose the stage latency histograms, LLM token counters and admission metrics in the
+    Prometheus text format.
+
+    Returns:
+        Response: The metrics of this backend process.
+    """
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
@@ -0,0 +1,126 @@
+import time
+import uuid
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict
+from uuid import UUID
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.outputs import LLMResult
+from prometheus_client import Counter, Histogram, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+
+# Latency buckets from a few milliseconds (cache lookups) to minutes (generation, ingestion)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram("rag_stage_duration_seconds", "Duration of each stage of the chat and ingestion pipelines",
+                          ["pipeline", "stage"], buckets=STAGE_BUCKETS)
+LLM_TOKENS = Counter("rag_llm_tokens_total", "Tokens processed by the LLM", ["model", "kind"])
+LLM_TOKENS_PER_SECOND = Histogram("rag_llm_tokens_per_second", "Completion tokens generated per second",
+                                  ["model"], buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200))
+QUEUE_WAIT_SECONDS = Histogram("rag_admission_wait_seconds", "Time spent waiting for a generation slot",
+                               ["model"], buckets=STAGE_BUCKETS)
+ADMISSION_REJECTIONS = Counter("rag_admission_rejections_total", "Requests rejected by admission control",
+                               ["model", "reason"])
+CHAT_LOGS_DROPPED = Counter("rag_chat_logs_dropped_total",
+                            "Chat turns not logged because the write buffer was full and the database unreachable")
+REWRITE_OUTCOMES = Counter("rag_rewrite_outcomes_total",
+                           "How follow-up questions were made standalone: first_turn, skipped, cached or rewritten",
+                           ["outcome"])
+
+# Trace id of the current request, returned in the X-Trace-Id header
+trace_id = contextvars.ContextVar("trace_id", default=None)
+# Stage durations of the current request, logged with its trace id
+stage_timings = contextvars.ContextVar("stage_timings", default=None)
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex
+
+def observe_stage(pipeline: str, stage: str, seconds: float):
+    """
+    Records the duration of a stage in the histogram and in the current request's timings.
+    """
+    STAGE_SECONDS.labels(pipeline, stage).observe(seconds)
+    timings = stage_timings.get()
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0.0) + seconds, 4)
+
+@contextmanager
+def timed(stage: str, pipeline: str = "chat"):
+    """
+    Times the enclosed block as one stage of a pipeline.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(pipeline, stage, time.perf_counter() - started)
+
+class StageTimingCallback(AsyncCallbackHandler):
+    """
+    Times the retriever and LLM runs of a chain and records the LLM token counts.
+
+    Ollama reports prompt_eval_count, eval_count and eval_duration with the final response,
+    from which the completion tokens per second are derived.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.started: Dict[UUID, float] = {}
+
+    async def on_retriever_start(self, serialized, query, *, run_id: UUID, **kwargs: Any):
+        self.started[run_id] = time.perf_counter()
+
+    async def on_retriever_end(self, documents, *, run_id: UUID, **kwargs: Any):
+        if run_id in self.started:
+            observe_stage("chat", "retrieve", time.perf_counter() - self.started.pop(run_id))
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs: Any):
+        self.started[run_id] = time.perf_counter()
+
+    async def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        if run_id in self.started:
+            observe_stage("chat", "generate", time.perf_counter() - self.started.pop(run_id))
+        generation = response.generations[0][0] if response.generations and response.generations[0] else None
+        if generation is None:
+            return
+        info = dict(getattr(getattr(generation, "message", None), "response_metadata", None) or {})
+        info.update(generation.generation_info or {})
+        prompt_tokens = info.get("prompt_eval_count")
+        completion_tokens = info.get("eval_count")
+        if prompt_tokens:
+            LLM_TOKENS.labels(self.model, "prompt").inc(prompt_tokens)
+        if completion_tokens:
+            LLM_TOKENS.labels(self.model, "completion").inc(completion_tokens)
+            if info.get("eval_duration"):
+                # eval_duration is reported in nanoseconds
+                LLM_TOKENS_PER_SECOND.labels(self.model).observe(completion_tokens / (info["eval_duration"] / 1e9))
+
+    async def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self.started.pop(run_id, None)
+
+    async def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self.started.pop(run_id, None)
+
+class AdmissionCollector:
+    """
+    Exposes the current queue depth and active generations of every model at scrape time.
+    """
+
+    def collect(self):
+        # Imported here because admission_utils records its wait times through this module
+        from .admission_utils import admissions
+        queue_depth = GaugeMetricFamily("rag_admission_queue_depth", "Requests waiting for a generation slot", labels=["model"])
+        active = GaugeMetricFamily("rag_admission_active_generations", "Generations in progress", labels=["model"])
+        for model, admission in list(admissions.items()):
+            queue_depth.add_metric([model], admission.waiting)
+            active.add_metric([model], admission.active)
+        yield queue_depth
+        yield active
+
+REGISTRY.register(AdmissionCollector())
+
+def render_metrics():
+    """
+    Returns the body and content type of the Prometheus exposition of all metrics.
+    """
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,102 @@
+from langchain_ollama import ChatOllama
+from ollama import AsyncClient
+from typing import Dict, List
+from .pydantic_models import ModelName
+from .settings import settings
+
+# Chat models built once per model name and shared by every chain that uses them
+chat_models: Dict[str, ChatOllama] = {}
+
+# Outcome of the last warm-up of each model: "warming", "warm" or the error message
+warmup_status: Dict[str, str] = {}
+
+def normalize_model_name(model: str) -> str:
+    """
+    Returns the model name as Ollama reports it, with the implicit ":latest" tag made explicit.
+    """
+    return model if ":" in model else f"{model}:latest"
+
+def get_model_options(model: str) -> dict:
+    """
+    Returns the keep_alive and num_ctx options of a model.
+
+    The global defaults from settings are overridden by the entry of the model in
+    `settings.model_options`, if any. Options left unset are omitted so Ollama's own
+    defaults apply.
+
+    Args:
+        model (str): The name of the Ollama model.
+    """
+    options = {"keep_alive": settings.ollama_keep_alive, "num_ctx": settings.ollama_num_ctx}
+    options.update(settings.model_options.get(model, {}))
+    return {key: value for key, value in options.items() if value is not None}
+
+def get_chat_model(model: str) -> ChatOllama:
+    """
+    Returns the shared ChatOllama client of a model, creating it on first use.
+
+    Args:
+        model (str): The name of the Ollama model.
+    """
+    if model not in chat_models:
+        chat_models[model] = ChatOllama(model=model, base_url=settings.ollama_url, **get_model_options(model))
+    return chat_models[model]
+
+async def warm_up_model(client: AsyncClient, model: str):
+    """
+    Loads a model into Ollama's memory with its keep_alive and num_ctx options.
+
+    Chat models are loaded with an empty prompt, which Ollama answers by loading the
+    weights without generating anything. The embedding model is loaded by embedding a
+    short text.
+
+    Args:
+        client (AsyncClient): The Ollama client.
+        model (str): The name of the Ollama model.
+    """
+    options = get_model_options(model)
+    keep_alive = options.pop("keep_alive", None)
+    warmup_status[model] = "warming"
+    try:
+        if model == ModelName.Ollama_embedding_model.value:
+            await client.embed(model=model, input="warm-up", keep_alive=keep_alive, options=options)
+        else:
+            await client.generate(model=model, prompt="", keep_alive=keep_alive, options=options)
+        warmup_status[model] = "warm"
+        print(f"Warmed up model {model}")
+    except Exception as e:
+        warmup_status[model] = str(e)
+        print(f"Error warming up model {model}: {e}")
+
+async def warm_up_models():
+    """
+    Loads every model listed in `settings.warmup_models`, one at a time so they do not
+    compete for memory while loading.
+    """
+    client = AsyncClient(host=settings.ollama_url)
+    for model in settings.warmup_models:
+        await warm_up_model(client, model)
+
+async def get_resident_models() -> List[str]:
+    """
+    Returns the names of the models currently loaded in Ollama.
+    """
+    response = await AsyncClient(host=settings.ollama_url).ps()
+    return [model.model for model in response.models]
+
+async def get_readiness() -> dict:
+    """
+    Reports whether every warm-up model is resident in Ollama.
+
+    Returns:
+        dict: "ready", the resident models, the warm-up models that are not resident and
+        the last warm-up outcome of each model.
+    """
+    try:
+        resident = await get_resident_models()
+    except Exception as e:
+        return {"ready": False, "resident_models": [], "missing_models": settings.warmup_models,
+                "warmup": warmup_status, "error": str(e)}
+    resident_names = {normalize_model_name(model) for model in resident}
+    missing = [model for model in settings.warmup_models if normalize_model_name(model) not in resident_names]
+    return {"ready": not missing, "resident_models": resident, "missing_models": missing, "warmup": warmup_status}
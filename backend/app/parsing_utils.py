@@ -0,0 +1,218 @@
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from typing import Iterator, List, Optional, Tuple
+from xml.etree.ElementTree import iterparse
+from langchain_core.documents import Document
+from .settings import settings
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; the memory ceiling is then not enforced
+    resource = None
+
+# Process pool that parses PDF page ranges, created on first use
+parse_pool: Optional[ProcessPoolExecutor] = None
+parse_pool_lock = threading.Lock()
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+def get_document_loader(file_path: str):
+    """
+    Return the LangChain document loader matching the file type.
+
+    Args:
+        file_path (str): The path to the document file.
+
+    Raises:
+        ValueError: If the file type is unsupported.
+    """
+    # Determine the appropriate loader based on file extension
+    if file_path.endswith('.pdf'):
+        from langchain_community.document_loaders import PyPDFLoader
+        return PyPDFLoader(file_path)
+    elif file_path.endswith('.docx'):
+        from langchain_community.document_loaders import Docx2txtLoader
+        return Docx2txtLoader(file_path)
+    elif file_path.endswith('.html'):
+        from langchain_community.document_loaders import UnstructuredHTMLLoader
+        return UnstructuredHTMLLoader(file_path)
+    else:
+        # Raise an error if the file type is unsupported
+        raise ValueError(f"Unsupported file type: {file_path}")
+
+def limit_memory(limit_mb: int):
+    """
+    Caps the address space of a parser process, so a pathological file fails with MemoryError
+    instead of exhausting the host.
+    """
+    if resource is not None and limit_mb > 0:
+        limit = limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """
+    Returns the parser process pool, creating it on first use.
+    """
+    global parse_pool
+    with parse_pool_lock:
+        if parse_pool is None:
+            # spawn rather than fork: the backend runs threads that a forked child would inherit mid-state
+            parse_pool = ProcessPoolExecutor(max_workers=settings.parse_workers, mp_context=get_context("spawn"),
+                                             initializer=limit_memory, initargs=(settings.parse_memory_limit_mb,))
+        return parse_pool
+
+def shutdown_parse_pool():
+    """
+    Stops the parser processes; a new pool is created on the next use.
+    """
+    global parse_pool
+    with parse_pool_lock:
+        if parse_pool is not None:
+            parse_pool.shutdown(wait=False, cancel_futures=True)
+            parse_pool = None
+
+def parse_pdf_pages(file_path: str, start: int, end: int) -> List[Tuple[int, str, str]]:
+    """
+    Extracts the text of pages [start, end) of a PDF. Runs in a parser process.
+
+    Returns:
+        list: (page number, page label, text) for each page of the range.
+    """
+    from pypdf import PdfReader
+    reader = PdfReader(file_path)
+    # pypdf computes the labels of all pages on every access, so read them once per range
+    labels = reader.page_labels
+    return [(number, labels[number], reader.pages[number].extract_text(extraction_mode="plain").strip())
+            for number in range(start, end)]
+
+def iter_pdf_pages(file_path: str) -> Iterator[Document]:
+    """
+    Yield the pages of a PDF in order, parsing ranges of `settings.parse_pages_per_task` pages
+    across the parser process pool.
+
+    At most two ranges per worker are parsed ahead of the consumer, so memory stays bounded
+    however long the document is. PDFs shorter than `settings.parse_min_pages_for_pool` pages
+    are parsed in this thread, where starting worker tasks would cost more than it saves.
+    """
+    from pypdf import PdfReader
+    total_pages = len(PdfReader(file_path).pages)
+    if settings.parse_workers <= 0 or total_pages < settings.parse_min_pages_for_pool:
+        yield from get_document_loader(file_path).lazy_load()
+        return
+
+    pool = get_parse_pool()
+    max_in_flight = settings.parse_workers * 2
+    in_flight = deque()
+
+    def pages_of(future) -> Iterator[Document]:
+        for number, label, content in future.result():
+            yield Document(page_content=content, metadata={"source": file_path, "total_pages": total_pages,
+                                                           "page": number, "page_label": label})
+
+    try:
+        for start in range(0, total_pages, settings.parse_pages_per_task):
+            if len(in_flight) >= max_in_flight:
+                yield from pages_of(in_flight.popleft())
+            end = min(start + settings.parse_pages_per_task, total_pages)
+            in_flight.append(pool.submit(parse_pdf_pages, file_path, start, end))
+        while in_flight:
+            yield from pages_of(in_flight.popleft())
+    except BrokenProcessPool:
+        # A worker died, most likely killed at its memory ceiling; the pool cannot be reused
+        shutdown_parse_pool()
+        raise RuntimeError(f"A parser process crashed while parsing {file_path}; "
+                           f"it may have exceeded parse_memory_limit_mb ({settings.parse_memory_limit_mb} MB)")
+    finally:
+        # Stop parsing ahead when the consumer gives up early
+        for future in in_flight:
+            future.cancel()
+
+def iter_docx_sections(file_path: str) -> Iterator[Document]:
+    """
+    Yield a DOCX document in sections of at most `settings.docx_section_paragraphs` paragraphs.
+
+    word/document.xml is read as a stream and each paragraph is cleared once its text is
+    taken, so only the current section's text is held in memory. A section also ends at a page break
+    (explicit, or the one Word recorded when the file was last saved), so the page number in
+    the metadata is that of the section's paragraphs.
+    """
+    page = 0
+    section = 0
+    paragraphs = []
+    section_page = 0
+    after_page_break = False
+
+    def make_section() -> Document:
+        return Document(page_content="\n\n".join(paragraphs),
+                        metadata={"source": file_path, "page": section_page, "section": section})
+
+    with zipfile.ZipFile(file_path) as archive, archive.open("word/document.xml") as document:
+        for _, element in iterparse(document):
+            if element.tag != WORD_NAMESPACE + "p":
+                continue
+            parts = []
+            # Page breaks before the paragraph's first text start its page; later ones start the next paragraph's
+            breaks_before = breaks_after = 0
+            for node in element.iter():
+                is_break = False
+                if node.tag == WORD_NAMESPACE + "t" and node.text:
+                    parts.append(node.text)
+                    after_page_break = False
+                elif node.tag == WORD_NAMESPACE + "tab":
+                    parts.append("\t")
+                elif node.tag == WORD_NAMESPACE + "br":
+                    if node.get(WORD_NAMESPACE + "type") == "page":
+                        is_break = after_page_break = True
+                    else:
+                        parts.append("\n")
+                elif node.tag == WORD_NAMESPACE + "lastRenderedPageBreak":
+                    # Word also records a rendered break right after an explicit one; count them once
+                    is_break = not after_page_break
+                if is_break:
+                    if parts:
+                        breaks_after += 1
+                    else:
+                        breaks_before += 1
+            # Nested paragraphs (text boxes) are emitted on their own and cleared from their parent
+            element.clear()
+            content = "".join(parts).strip()
+            if breaks_before:
+                page += breaks_before
+                if paragraphs:
+                    yield make_section()
+                    section += 1
+                    paragraphs = []
+            if content:
+                if not paragraphs:
+                    section_page = page
+                paragraphs.append(content)
+            if paragraphs and (breaks_after or len(paragraphs) >= settings.docx_section_paragraphs):
+                yield make_section()
+                section += 1
+                paragraphs = []
+            page += breaks_after
+    if paragraphs:
+        yield make_section()
+
+def iter_document_pages(file_path: str) -> Iterator[Document]:
+    """
+    Lazily parse a document into pages (PDF), sections (DOCX) or documents (other types).
+
+    Args:
+        file_path (str): The path to the document file.
+
+    Yields:
+        Document: The next page or section, with its page number in the metadata.
+
+    Raises:
+        ValueError: If the file type is unsupported.
+    """
+    if file_path.endswith('.pdf'):
+        return iter_pdf_pages(file_path)
+    if file_path.endswith('.docx'):
+        return iter_docx_sections(file_path)
+    return get_document_loader(file_path).lazy_load()
@@ -1,142 +1,962 @@
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, UnstructuredHTMLLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_ollama import OllamaEmbeddings
 from langchain_postgres import PGVector
 from .pydantic_models import ModelName
 from .settings import settings
+from .db_utils import get_engine, get_async_engine
+from .cache_utils import CachedEmbeddings
+from .model_utils import get_model_options
+from .metrics_utils import observe_stage
+from .embedded_store_utils import NumpyVectorStore
+from .parsing_utils import iter_document_pages
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from langchain_core.documents import Document
-import os
-from dotenv import load_dotenv
+import json
+import re
+import hashlib
+import contextvars
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from functools import cache
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import text, event
 
 # Initialize text splitter and embedding function
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200, length_function=len)
-embeddings = OllamaEmbeddings(model = ModelName.Ollama_embedding_model, base_url=settings.ollama_url)
-
-# Load environment variables
-load_dotenv(override=True, verbose=True)
-
-# Debugging: Print the loaded values
-print("Loaded environment variables:")
-print(f"DB_USER: {os.getenv('DB_USER')}")
-print(f"DB_PASSWORD: {os.getenv('DB_PASSWORD')}")
-print(f"DB_HOST: {os.getenv('DB_HOST')}")
-print(f"DB_PORT: {os.getenv('DB_PORT')}")
-print(f"DB_NAME: {os.getenv('DB_NAME')}")
-
-
-# Database connection using environment variables
-DB_USER = os.getenv('DB_USER')
-DB_PASSWORD = os.getenv('DB_PASSWORD')
-DB_HOST = os.getenv('DB_HOST')
-DB_PORT = os.getenv('DB_PORT')
-DB_NAME = os.getenv('DB_NAME')
-connection = f"postgresql+psycopg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"  # Uses psycopg3!
-collection_name = "my_docs"
-
-#Initialize PG_Vector vector store
-vector_store = PGVector(
-    embeddings=embeddings,
-    collection_name=collection_name,
-    connection=connection,
-    use_jsonb=True,
-)
-
-def load_and_split_document(file_path: str) -> List[Document]:
-    """
-    Load and split a document into smaller chunks based on file type.
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# start_index lets retrieval merge neighbouring chunks back together without the overlap
+text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, length_function=len, add_start_index=True)
+
+# The collection of requests and uploads that do not name a tenant collection
+collection_name = settings.default_collection
+
+# The vector store backend is "pgvector" (langchain_pg_embedding) or "numpy" (embedded, memory-mapped)
+use_pgvector = settings.vector_store_backend == "pgvector"
+
+# The embedding function and the vector stores are created on first use, so importing this
+# module neither contacts Ollama nor the database.
+@cache
+def get_embeddings():
+    embeddings = OllamaEmbeddings(model = ModelName.Ollama_embedding_model, base_url=settings.ollama_url,
+                                  **get_model_options(ModelName.Ollama_embedding_model.value))
+    if settings.embedding_cache_enabled:
+        # Serve repeated chunks and queries from the embedding_cache table instead of re-embedding them
+        embeddings = CachedEmbeddings(embeddings, model=ModelName.Ollama_embedding_model.value,
+                                      max_entries=settings.embedding_cache_max_entries,
+                                      touch_interval=settings.embedding_cache_touch_interval_seconds)
+    return embeddings
+
+@cache
+def get_async_vector_engine():
+    """
+    Returns the view of the async engine used for vector searches.
+
+    It shares the pool of db_utils but has its own event listeners, so the ANN search
+    parameters are only applied to vector search transactions.
+    """
+    async_vector_engine = get_async_engine().execution_options(vector_search=True)
+    event.listen(async_vector_engine.sync_engine, "begin", apply_search_params)
+    return async_vector_engine
+
+@cache
+def get_vector_store(collection: str = collection_name) -> Optional[PGVector]:
+    """
+    Returns the PGVector store of a collection, creating its tables and collection on first use.
+    None with the embedded backend.
+    """
+    if not use_pgvector:
+        return None
+    return PGVector(
+        embeddings=get_embeddings(),
+        collection_name=collection,
+        connection=get_engine(),
+        embedding_length=settings.embedding_dimension,
+        use_jsonb=True,
+    )
+
+def embedded_store_path(collection: str) -> Path:
+    # The default collection keeps the top-level directory it had before collections existed
+    path = Path(settings.numpy_store_path)
+    return path if collection == collection_name else path / "collections" / collection
+
+@cache
+def get_embedded_store(collection: str = collection_name) -> Optional[NumpyVectorStore]:
+    """
+    Returns the embedded NumPy vector store of a collection, loading its segments on first use.
+    None with the pgvector backend.
+    """
+    if use_pgvector:
+        return None
+    return NumpyVectorStore(
+        str(embedded_store_path(collection)),
+        get_embeddings(),
+        dimension=settings.embedding_dimension,
+        dtype=settings.numpy_store_dtype,
+        segment_size=settings.numpy_store_segment_size,
+        compact_ratio=settings.numpy_store_compact_ratio,
+    )
+
+def initialize_vector_store():
+    """
+    Creates the configured vector store, so its tables or segment files are ready before the first request.
+    """
+    if use_pgvector:
+        get_vector_store()
+        partition_embedding_table()
+    else:
+        get_embedded_store()
+
+def is_partitioned(conn) -> bool:
+    return bool(conn.execute(text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('langchain_pg_embedding')")).scalar())
+
+def partition_name(collection: str) -> str:
+    # Names created through the API already match COLLECTION_PATTERN and are not reserved; older ones are made safe
+    return "langchain_pg_embedding_" + re.sub(r"[^a-z0-9_]", "_", collection.lower())[:40]
+
+def create_partition(conn, collection: str, collection_id: str) -> None:
+    conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {partition_name(collection)} PARTITION OF langchain_pg_embedding
+        FOR VALUES IN ('{collection_id}')
+    """))
+
+def partition_embedding_table() -> None:
+    """
+    Converts langchain_pg_embedding into a table list-partitioned by collection, once.
+
+    Each collection gets its own partition, so a search scoped to a collection only scans and
+    indexes that tenant's rows; rows of collections without a partition land in a default one.
+    The existing rows are copied in one transaction, which blocks writes to the table while it
+    runs. Embeddings are written with COPY, which the partitioned table accepts; PGVector's
+    add_texts is not used, since its upsert needs a unique key on id alone.
+    """
+    if not use_pgvector or not settings.partition_embeddings:
+        return
+    with get_engine().begin() as conn:
+        # Only one backend process migrates the table
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": INDEX_LOCK_KEY})
+        if is_partitioned(conn):
+            return
+        print("Partitioning langchain_pg_embedding by collection")
+        conn.execute(text("ALTER TABLE langchain_pg_embedding RENAME TO langchain_pg_embedding_unpartitioned"))
+        conn.execute(text("""
+            CREATE TABLE langchain_pg_embedding (LIKE langchain_pg_embedding_unpartitioned INCLUDING DEFAULTS INCLUDING GENERATED)
+            PARTITION BY LIST (collection_id)
+        """))
+        # The primary key of a partitioned table must contain the partition key
+        conn.execute(text("ALTER TABLE langchain_pg_embedding ADD CONSTRAINT langchain_pg_embedding_collection_id_id_pkey PRIMARY KEY (collection_id, id)"))
+        conn.execute(text("""
+            ALTER TABLE langchain_pg_embedding ADD FOREIGN KEY (collection_id)
+            REFERENCES langchain_pg_collection (uuid) ON DELETE CASCADE
+        """))
+        conn.execute(text("CREATE TABLE langchain_pg_embedding_default PARTITION OF langchain_pg_embedding DEFAULT"))
+        for name, collection_id in conn.execute(text("SELECT name, uuid FROM langchain_pg_collection")).all():
+            create_partition(conn, name, collection_id)
+        conn.execute(text("""
+            INSERT INTO langchain_pg_embedding (id, collection_id, embedding, document, cmetadata)
+            SELECT id, collection_id, embedding, document, cmetadata FROM langchain_pg_embedding_unpartitioned
+        """))
+        # Its indexes go with it; ensure_vector_indexes builds them on the partitions
+        conn.execute(text("DROP TABLE langchain_pg_embedding_unpartitioned"))
+
+# Collection uuids by name, filled by ensure_collection
+collection_ids: Dict[str, str] = {}
+collection_lock = threading.Lock()
+
+def ensure_collection(collection: str) -> str:
+    """
+    Creates a collection with its partition on first use and returns its uuid.
+
+    Ingestion workers of this process are serialized by a lock and other backend processes by
+    the advisory lock that partition_embedding_table takes, so concurrent first uploads to a
+    collection do not race on its langchain_pg_collection row or its partition.
+    """
+    with collection_lock:
+        if collection in collection_ids:
+            return collection_ids[collection]
+        with get_engine().begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": INDEX_LOCK_KEY})
+            get_vector_store(collection)
+            collection_id = str(conn.execute(text("SELECT uuid FROM langchain_pg_collection WHERE name = :name"),
+                                             {"name": collection}).scalar())
+            if is_partitioned(conn):
+                create_partition(conn, collection, collection_id)
+        collection_ids[collection] = collection_id
+        return collection_id
+
+# Index search parameters for the current request, applied to every transaction on the async engine
+search_params = contextvars.ContextVar("search_params", default=None)
+
+def resolve_search_params(name: str = collection_name, ef_search: Optional[int] = None, probes: Optional[int] = None) -> dict:
+    """
+    Resolve the ANN search parameters for a query.
+
+    Request values take precedence over the collection's entry in
+    `settings.collection_search_params`, which takes precedence over the global defaults.
+
+    Args:
+        name (str): The collection being searched.
+        ef_search (int, optional): The hnsw.ef_search requested for this query.
+        probes (int, optional): The ivfflat.probes requested for this query.
+
+    Returns:
+        dict: The ef_search and probes to use.
+    """
+    params = {"ef_search": settings.hnsw_ef_search, "probes": settings.ivfflat_probes}
+    params.update(settings.collection_search_params.get(name, {}))
+    if ef_search is not None:
+        params["ef_search"] = ef_search
+    if probes is not None:
+        params["probes"] = probes
+    return params
+
+def search_param_statements(params: dict) -> List[str]:
+    """
+    Return the SET LOCAL statements that apply the ANN search parameters to a transaction.
+    """
+    if settings.vector_index_type == "hnsw":
+        ef_search = int(params['ef_search'])
+        if active_quantization != "none":
+            # HNSW returns at most ef_search rows, which must cover the candidates to re-score
+            ef_search = max(ef_search, settings.vector_rescore_candidates)
+        return [f"SET LOCAL hnsw.ef_search = {ef_search}"]
+    if settings.vector_index_type == "ivfflat":
+        return [f"SET LOCAL ivfflat.probes = {int(params['probes'])}"]
+    return []
+
+def apply_search_params(conn):
+    # SET LOCAL only lasts for the transaction, so pooled connections never leak a request's settings
+    params = search_params.get()
+    if params is None:
+        return
+    for statement in search_param_statements(params):
+        conn.exec_driver_sql(statement)
+
+# Quantization of the first-pass search that the vector index serves; switched from "none" to
+# settings.vector_quantization by ensure_vector_indexes once the quantized index is usable
+active_quantization = "none"
+
+def get_active_quantization() -> str:
+    return active_quantization
+
+def quantized_expressions(quantization: str, embedding: str = ":embedding") -> dict:
+    """
+    Return the SQL of a quantized view of the embeddings.
+
+    The index is built on the column expression, so a search must order by exactly the same
+    expression, with the query vector quantized the same way, for the planner to use it.
+
+    Args:
+        quantization (str): "none" (full-precision vector), "halfvec" (16-bit floats) or "binary"
+            (one bit per dimension, its sign, compared by Hamming distance).
+        embedding (str): The SQL of the query vector in pgvector's text representation.
+
+    Returns:
+        dict: The indexed column expression, the query expression for the query vector,
+            the operator class and the distance operator.
+    """
+    dimension = settings.embedding_dimension
+    if quantization == "halfvec":
+        return {"column": f"(embedding::halfvec({dimension}))", "query": f"CAST({embedding} AS halfvec({dimension}))",
+                "opclass": "halfvec_cosine_ops", "operator": "<=>"}
+    if quantization == "binary":
+        return {"column": f"(binary_quantize(embedding)::bit({dimension}))",
+                "query": f"binary_quantize(CAST({embedding} AS vector({dimension})))::bit({dimension})",
+                "opclass": "bit_hamming_ops", "operator": "<~>"}
+    return {"column": "embedding", "query": f"CAST({embedding} AS vector)", "opclass": "vector_cosine_ops", "operator": "<=>"}
+
+def quantized_search_sql(quantization: str, limit: str = ":k", file_ids: bool = False, embedding: str = ":embedding") -> str:
+    """
+    Return the SELECT of the nearest neighbours of :embedding in the collection.
+
+    `embedding` replaces the :embedding parameter, e.g. with a column of a LATERAL join
+    that searches many query vectors in one statement.
+
+    With quantization, the quantized index finds the :candidates nearest rows, which are then
+    re-scored by their full-precision cosine distance; the stored vectors are kept for this.
+    With file_ids, only the chunks of the :file_ids documents are searched: they are selected
+    through the file_id index first and ranked exactly, since an ANN index would be scanned for
+    the whole collection and filtered afterwards, returning fewer than k rows.
+    """
+    if file_ids:
+        return f"""
+            WITH scoped AS MATERIALIZED (
+                SELECT id, document, cmetadata, embedding FROM langchain_pg_embedding
+                WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection)
+                AND cmetadata->>'file_id' = ANY(CAST(:file_ids AS text[]))
+            )
+            SELECT e.id, e.document, e.cmetadata, e.embedding FROM scoped e
+            ORDER BY e.embedding <=> CAST({embedding} AS vector)
+            LIMIT {limit}
+        """
+    if quantization == "none":
+        return f"""
+            SELECT e.id, e.document, e.cmetadata, e.embedding
+            FROM langchain_pg_embedding e
+            WHERE e.collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection)
+            ORDER BY e.embedding <=> CAST({embedding} AS vector)
+            LIMIT {limit}
+        """
+    expressions = quantized_expressions(quantization, embedding)
+    # The candidates carry their rows out of the index scan: joining back on id alone would probe
+    # the partition of every collection, since the primary key is (collection_id, id)
+    return f"""
+        SELECT e.id, e.document, e.cmetadata, e.embedding
+        FROM (
+            SELECT id, document, cmetadata, embedding FROM langchain_pg_embedding
+            WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection)
+            ORDER BY {expressions['column']} {expressions['operator']} {expressions['query']}
+            LIMIT :candidates
+        ) e
+        ORDER BY e.embedding <=> CAST({embedding} AS vector)
+        LIMIT {limit}
+    """
+
+def chunk_hash(content: str) -> str:
+    """
+    SHA-256 of a chunk's text as stored (without NUL characters), used to diff document versions.
+    """
+    return hashlib.sha256(content.replace("\x00", "").encode("utf-8")).hexdigest()
+
+def iter_document_chunks(file_path: str, file_id: int, report: Callable[..., None], version: int = 1) -> Iterator[Document]:
+    """
+    Lazily load a document and yield its chunks one page at a time.
+
+    Large PDFs are parsed in page ranges across the parser process pool and DOCX files are
+    streamed in sections (see parsing_utils); the page number stays in each chunk's metadata.
 
     Args:
         file_path (str): The path to the document file.
+        file_id (int): The unique identifier for the document, stored in each chunk's metadata.
+        report (Callable): Called with the running pages_parsed, chunks_total, load_seconds and split_seconds counters.
+        version (int): The document version the chunks belong to, stored in their metadata.
+
+    Yields:
+        Document: The next chunk of the document.
+    """
+    pages_parsed = 0
+    chunks_total = 0
+    load_seconds = 0.0
+    split_seconds = 0.0
+    pages = iter_document_pages(file_path)
+    while True:
+        started = time.perf_counter()
+        page = next(pages, None)
+        load_seconds += time.perf_counter() - started
+        if page is None:
+            break
+        pages_parsed += 1
+        started = time.perf_counter()
+        splits = text_splitter.split_documents([page])
+        split_seconds += time.perf_counter() - started
+        chunks_total += len(splits)
+        report(pages_parsed=pages_parsed, chunks_total=chunks_total,
+               load_seconds=round(load_seconds, 3), split_seconds=round(split_seconds, 3))
+        for split in splits:
+            # Add the file_id to each split for later retrieval, and what a later version needs to diff against it
+            split.metadata['file_id'] = file_id
+            split.metadata['version'] = version
+            split.metadata['chunk_hash'] = chunk_hash(split.page_content)
+            yield split
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    """
+    Group an iterable into lists of at most batch_size items without materializing it.
+    """
+    iterator = iter(items)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+def embed_batch(batch: List[Document]) -> Tuple[List[Document], List[List[float]], float]:
+    """
+    Embed a batch of chunks with a single Ollama request.
 
     Returns:
-        List[Document]: A list of document chunks.
-
-    Raises:
-        ValueError: If the file type is unsupported.
-    """
-    # Determine the appropriate loader based on file extension
-    if file_path.endswith('.pdf'):
-        loader = PyPDFLoader(file_path)
-    elif file_path.endswith('.docx'):
-        loader = Docx2txtLoader(file_path)
-    elif file_path.endswith('.html'):
-        loader = UnstructuredHTMLLoader(file_path)
-    else:
-        # Raise an error if the file type is unsupported
-        raise ValueError(f"Unsupported file type: {file_path}")
+        tuple: The batch, its embedding vectors and the seconds spent embedding.
+    """
+    started = time.perf_counter()
+    vectors = get_embeddings().embed_documents([doc.page_content for doc in batch])
+    return batch, vectors, time.perf_counter() - started
+
+def copy_embeddings_to_pgvector(batch: List[Document], vectors: List[List[float]], collection: str = collection_name) -> float:
+    """
+    Write a batch of embedded chunks into langchain_pg_embedding with PostgreSQL COPY.
+
+    Args:
+        batch (List[Document]): The chunks to store.
+        vectors (List[List[float]]): The embedding of each chunk, in the same order.
+        collection (str): The collection the chunks belong to.
+
+    Returns:
+        float: The seconds spent writing the batch.
+    """
+    started = time.perf_counter()
+    # Creates the collection and its partition on first use
+    collection_id = ensure_collection(collection)
+    raw_connection = get_engine().raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        with cursor.copy("COPY langchain_pg_embedding (id, collection_id, embedding, document, cmetadata) FROM STDIN") as copy:
+            for doc, vector in zip(batch, vectors):
+                copy.write_row((
+                    str(uuid.uuid4()),
+                    collection_id,
+                    # pgvector parses the text form "[x1,x2,...]"
+                    "[" + ",".join(map(str, vector)) + "]",
+                    # PostgreSQL text cannot hold NUL characters, which some PDFs contain
+                    doc.page_content.replace("\x00", ""),
+                    json.dumps(doc.metadata, default=str),
+                ))
+        raw_connection.commit()
+    finally:
+        raw_connection.close()
+    return time.perf_counter() - started
+
+def write_embeddings(batch: List[Document], vectors: List[List[float]], collection: str = collection_name) -> float:
+    """
+    Write a batch of embedded chunks to the collection in the configured vector store backend.
 
-    # Load the document using the selected loader
-    documents = loader.load()
-    # Split the document into smaller chunks
-    return text_splitter.split_documents(documents)
+    Returns:
+        float: The seconds spent writing the batch.
+    """
+    embedded_store = get_embedded_store(collection)
+    if embedded_store is None:
+        return copy_embeddings_to_pgvector(batch, vectors, collection)
+    started = time.perf_counter()
+    embedded_store.add_embeddings([doc.page_content for doc in batch], vectors, [doc.metadata for doc in batch])
+    return time.perf_counter() - started
+
+# Metadata that differs between uploads of the same text without the chunk having changed
+VOLATILE_METADATA_KEYS = ("source", "version")
+
+def stable_metadata(metadata: dict) -> dict:
+    return {key: value for key, value in metadata.items() if key not in VOLATILE_METADATA_KEYS}
+
+def get_document_chunks(file_id: int, collection: str = collection_name) -> Dict[str, List[Tuple[str, dict]]]:
+    """
+    Return the stored chunks of a document in a collection grouped by chunk hash.
+
+    Chunks indexed before hashes were stored are hashed from their text.
+
+    Returns:
+        dict: The (id, metadata) of the chunks with each hash.
+    """
+    chunks = defaultdict(list)
+    embedded_store = get_embedded_store(collection)
+    if embedded_store is not None:
+        for chunk_id, content, metadata in embedded_store.get_file_chunks(file_id):
+            chunks[metadata.get("chunk_hash") or chunk_hash(content)].append((chunk_id, metadata))
+        return chunks
+    get_vector_store(collection)
+    with get_engine().connect() as conn:
+        rows = conn.execute(text("""
+            SELECT id, cmetadata,
+                   COALESCE(cmetadata->>'chunk_hash', encode(sha256(convert_to(document, 'UTF8')), 'hex')) AS chunk_hash
+            FROM langchain_pg_embedding
+            WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection)
+            AND cmetadata->>'file_id' = :file_id
+        """), {"collection": collection, "file_id": str(file_id)})
+        for row in rows:
+            chunks[row.chunk_hash].append((row.id, row.cmetadata))
+    return chunks
 
-def index_document_to_pgvector(file_path: str, file_id: int) -> bool:
+def update_chunk_metadata(updates: List[Tuple[str, dict]], collection: str = collection_name) -> None:
+    """
+    Replace the metadata of stored chunks of a collection, keeping their embeddings.
+    """
+    if not updates:
+        return
+    embedded_store = get_embedded_store(collection)
+    if embedded_store is not None:
+        embedded_store.update_metadata(updates)
+        return
+    # The collection condition limits the statements to its partition
+    with get_engine().begin() as conn:
+        conn.execute(text("""
+            UPDATE langchain_pg_embedding SET cmetadata = CAST(:cmetadata AS jsonb)
+            WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection) AND id = :id
+        """), [{"id": chunk_id, "collection": collection, "cmetadata": json.dumps(metadata, default=str)}
+               for chunk_id, metadata in updates])
+
+def delete_chunks(chunk_ids: List[str], collection: str = collection_name) -> None:
+    """
+    Delete stored chunks of a collection by id.
+    """
+    if not chunk_ids:
+        return
+    embedded_store = get_embedded_store(collection)
+    if embedded_store is not None:
+        embedded_store.delete(chunk_ids)
+        return
+    with get_engine().begin() as conn:
+        conn.execute(text("""
+            DELETE FROM langchain_pg_embedding
+            WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection) AND id = ANY(:ids)
+        """), {"collection": collection, "ids": chunk_ids})
+
+def index_document_to_pgvector(file_path: str, file_id: int, progress: Optional[Callable[..., None]] = None, version: int = 1,
+                               collection: str = collection_name) -> bool:
     """
     Indexes a document in the PG_Vector vector store.
 
+    The document is streamed through the pipeline: pages are split as they are loaded,
+    chunks are embedded in batches of `settings.embedding_batch_size` with at most
+    `settings.embedding_max_concurrency` Ollama requests in flight, and each embedded
+    batch is written with COPY as soon as it is ready. Only the in-flight batches are
+    held in memory.
+
+    From version 2 on, the new version is diffed against the stored chunks by chunk hash:
+    only new chunks are embedded and inserted, unchanged chunks keep their rows (their
+    metadata is updated if, say, their page moved) and chunks that disappeared are deleted.
+    The updates and deletions are applied once the new chunks are stored, so until then the
+    previous version stays searchable, and on failure removing the rows tagged with the new
+    version restores it.
+
     Args:
         file_path (str): The path to the document file.
         file_id (int): The unique identifier for the document.
+        progress (Callable, optional): Called with keyword counters (pages_parsed, chunks_total, load_seconds,
+            split_seconds, chunks_embedded, chunks_unchanged, chunks_deleted, chunks_per_second, embed_seconds,
+            db_seconds, error) as indexing advances.
+        version (int): The version of the document being indexed.
+        collection (str): The collection the document is indexed in.
 
     Returns:
         bool: True if the document was indexed successfully, False otherwise.
     """
+    counters = {}
+
+    def report(**fields):
+        # Keep the latest counters for the stage metrics recorded once the document is indexed
+        counters.update(fields)
+        if progress:
+            progress(**fields)
+
+    started = time.perf_counter()
+    chunks_embedded = 0
+    embed_seconds = 0.0
+    db_seconds = 0.0
+
+    def write_oldest(in_flight: deque):
+        nonlocal chunks_embedded, embed_seconds, db_seconds
+        batch, vectors, batch_embed_seconds = in_flight.popleft().result()
+        embed_seconds += batch_embed_seconds
+        db_seconds += write_embeddings(batch, vectors, collection)
+        chunks_embedded += len(batch)
+        elapsed = time.perf_counter() - started
+        report(chunks_embedded=chunks_embedded, chunks_per_second=round(chunks_embedded / elapsed, 2),
+               embed_seconds=round(embed_seconds, 3), db_seconds=round(db_seconds, 3))
+
+    chunks_unchanged = 0
+    metadata_updates = []
+
+    def changed_chunks(chunks: Iterator[Document], existing: dict) -> Iterator[Document]:
+        # Pass on the chunks with no stored twin; each stored chunk is matched at most once
+        nonlocal chunks_unchanged
+        for chunk in chunks:
+            matches = existing.get(chunk.metadata["chunk_hash"])
+            if not matches:
+                yield chunk
+                continue
+            chunk_id, metadata = matches.pop()
+            chunks_unchanged += 1
+            report(chunks_unchanged=chunks_unchanged)
+            if stable_metadata(metadata) != stable_metadata(chunk.metadata):
+                metadata_updates.append((chunk_id, {**metadata, **stable_metadata(chunk.metadata)}))
+
     try:
-        # Load and split the document into smaller chunks
-        splits = load_and_split_document(file_path)
+        existing = get_document_chunks(file_id, collection) if version > 1 else None
+        max_in_flight = settings.embedding_max_concurrency
+        with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="embedding") as pool:
+            in_flight = deque()
+            chunks = iter_document_chunks(file_path, file_id, report, version)
+            if existing is not None:
+                chunks = changed_chunks(chunks, existing)
+            for batch in iter_batches(chunks, settings.embedding_batch_size):
+                # Wait for the oldest batch before submitting more, keeping memory bounded
+                if len(in_flight) >= max_in_flight:
+                    write_oldest(in_flight)
+                in_flight.append(pool.submit(embed_batch, batch))
+            while in_flight:
+                write_oldest(in_flight)
 
-        # Add metadata to each split
-        for split in splits:
-            # Add the file_id to each split for later retrieval
-            split.metadata['file_id'] = file_id
+        if existing is not None:
+            update_chunk_metadata(metadata_updates, collection)
+            stale = [chunk_id for matches in existing.values() for chunk_id, _ in matches]
+            delete_chunks(stale, collection)
+            report(chunks_deleted=len(stale))
+            print(f"Version {version} of file_id {file_id}: {chunks_unchanged} chunks unchanged "
+                  f"({len(metadata_updates)} with new metadata), {chunks_embedded} added, {len(stale)} deleted")
 
-        # Add the document chunks to the vector store
-        vector_store.add_documents(splits)
+        elapsed = time.perf_counter() - started
+        for stage, seconds in (("load", counters.get("load_seconds", 0.0)), ("split", counters.get("split_seconds", 0.0)),
+                               ("embed", embed_seconds), ("insert", db_seconds)):
+            observe_stage("ingestion", stage, seconds)
+        print(f"Indexed {chunks_embedded} chunks for file_id {file_id} in {elapsed:.2f}s "
+              f"({chunks_embedded / elapsed:.1f} chunks/s, embed {embed_seconds:.2f}s, db {db_seconds:.2f}s)")
         return True
     except Exception as e:
         print(f"Error indexing document: {e}")
+        report(error=str(e))
         return False
 
-def delete_doc_from_pgvector(db: Session, file_id: int) -> bool:
+def get_collection_id(db: Session, collection: str = collection_name) -> Optional[str]:
+    """
+    Return the uuid of a vector store collection as a string, or None if it does not exist.
+    """
+    collection_row = db.execute(
+        text("SELECT uuid FROM langchain_pg_collection WHERE name = :name"),
+        {"name": collection}
+    ).fetchone()
+    return str(collection_row[0]) if collection_row else None
+
+def delete_doc_from_pgvector(db: Session, file_id: int, version: Optional[int] = None, collection: str = collection_name) -> bool:
     """
     Deletes a document with the specified file_id from the PGVector vector store.
 
     Args:
         db (Session): SQLAlchemy session to execute the deletion.
         file_id (int): The unique identifier for the document to delete.
+        version (int, optional): Only delete the chunks added by this version of the document.
+        collection (str): The collection the document is indexed in.
 
     Returns:
         bool: True if the document was deleted successfully, False otherwise.
     """
     try:
-        # Find the collection_id for the given collection_name
-        collection_query = db.execute(
-            text("SELECT uuid FROM langchain_pg_collection WHERE name = :name"),
-            {"name": collection_name}  # Ensure collection_name is defined in your scope
-        )
-        collection_row = collection_query.fetchone()
-        if not collection_row:
-            print(f"Collection '{collection_name}' not found")
+        embedded_store = get_embedded_store(collection)
+        if embedded_store is not None:
+            deleted = embedded_store.delete_by_file_id(file_id, version)
+            print(f"Deleted {deleted} chunks with file_id {file_id}")
+            return True
+
+        # Find the collection_id for the given collection name
+        collection_id = get_collection_id(db, collection)
+        if collection_id is None:
+            print(f"Collection '{collection}' not found")
             return False
-        collection_id = collection_row[0]
 
         # Delete embeddings where collection_id matches and cmetadata['file_id'] = file_id
-        delete_query = text("""
+        delete_query = """
             DELETE FROM langchain_pg_embedding
             WHERE collection_id = :collection_id
             AND cmetadata->>'file_id' = :file_id
-        """)
-        db.execute(
-            delete_query,
-            {"collection_id": str(collection_id), "file_id": str(file_id)}
-        )
+        """
+        params = {"collection_id": collection_id, "file_id": str(file_id)}
+        if version is not None:
+            delete_query += " AND cmetadata->>'version' = :version"
+            params["version"] = str(version)
+        db.execute(text(delete_query), params)
         db.commit()
         print(f"Deleted all documents with file_id {file_id}")
         return True
     except Exception as e:
         print(f"Error deleting document with file_id {file_id} from PGVector: {str(e)}")
-        return False
\ No newline at end of file
+        return False
+
+# Names of the managed indexes on langchain_pg_embedding
+VECTOR_INDEX_NAMES = {"hnsw": "ix_langchain_pg_embedding_hnsw", "ivfflat": "ix_langchain_pg_embedding_ivfflat"}
+QUANTIZATIONS = ("none", "halfvec", "binary")
+FILE_ID_INDEX_NAME = "ix_langchain_pg_embedding_file_id"
+FTS_INDEX_NAME = "ix_langchain_pg_embedding_document_tsv"
+# Key for the advisory lock that keeps concurrent workers from building the same index
+INDEX_LOCK_KEY = 7342105589
+
+def desired_index_options() -> List[str]:
+    """
+    Return the reloptions the managed vector index should be built with.
+    """
+    if settings.vector_index_type == "hnsw":
+        return [f"m={settings.hnsw_m}", f"ef_construction={settings.hnsw_ef_construction}"]
+    return [f"lists={settings.ivfflat_lists}"]
+
+def vector_index_name(index_type: str, quantization: str) -> str:
+    return VECTOR_INDEX_NAMES[index_type] + ("" if quantization == "none" else f"_{quantization}")
+
+def get_index_state(conn, index_name: str):
+    """
+    Return the reloptions and validity of an index, or None if it does not exist.
+    """
+    return conn.execute(text("""
+        SELECT c.reloptions, i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+        WHERE c.relname = :name
+    """), {"name": index_name}).fetchone()
+
+def list_partitions(conn) -> Optional[List[Tuple[str, int]]]:
+    """
+    Return the (name, oid) of the partitions of langchain_pg_embedding, or None if it is not partitioned.
+    """
+    if not is_partitioned(conn):
+        return None
+    return [tuple(row) for row in conn.execute(text("""
+        SELECT c.relname, c.oid FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'langchain_pg_embedding'::regclass ORDER BY c.relname
+    """)).all()]
+
+def create_index(conn, index_name: str, definition: str, partitions: Optional[List[Tuple[str, int]]]) -> None:
+    """
+    Create an index on langchain_pg_embedding without blocking writes.
+
+    A partitioned table cannot be indexed CONCURRENTLY, so the index is created on the parent
+    only, built concurrently on each partition and attached; it becomes valid once every
+    partition has its index. Partitions created later are indexed when they are created.
+
+    Args:
+        index_name (str): The name of the index on the table (the parent index if partitioned).
+        definition (str): What follows the table name, e.g. "USING gin (document_tsv)".
+        partitions (list, optional): The partitions from list_partitions, None if not partitioned.
+    """
+    if partitions is None:
+        conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON langchain_pg_embedding {definition}"))
+        return
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} ON ONLY langchain_pg_embedding {definition}"))
+    for partition, oid in partitions:
+        attached = conn.execute(text("""
+            SELECT 1 FROM pg_inherits i JOIN pg_index x ON x.indexrelid = i.inhrelid
+            WHERE i.inhparent = to_regclass(:index_name) AND x.indrelid = to_regclass(:partition)
+        """), {"index_name": index_name, "partition": partition}).scalar()
+        if attached:
+            continue
+        # Named after the partition's oid to stay within the identifier length
+        child = f"{index_name}_p{oid}"
+        state = get_index_state(conn, child)
+        if state is not None and not state.indisvalid:
+            # Left behind by an interrupted concurrent build
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {child}"))
+        conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {child} ON {partition} {definition}"))
+        conn.execute(text(f"ALTER INDEX {index_name} ATTACH PARTITION {child}"))
+
+def drop_index(conn, index_name: str, partitions: Optional[List[Tuple[str, int]]]) -> None:
+    print(f"Dropping vector index {index_name}")
+    # Dropping a partitioned index drops the indexes of its partitions, but cannot be done CONCURRENTLY
+    concurrently = "" if partitions is not None else "CONCURRENTLY "
+    conn.execute(text(f"DROP INDEX {concurrently}IF EXISTS {index_name}"))
+
+def ensure_vector_indexes() -> None:
+    """
+    Create and maintain the indexes on langchain_pg_embedding.
+
+    Types the embedding column with its dimension (required for ANN indexes), creates the
+    expression index on cmetadata->>'file_id', adds the full-text column and its GIN index
+    when hybrid retrieval is enabled and builds the configured HNSW or IVFFlat index, on the
+    expression of `settings.vector_quantization`.
+    An existing vector index that is invalid or was built with different parameters is dropped
+    and rebuilt. Indexes of the other type or quantization are only dropped once the configured
+    one is built, and searches switch to the new quantization at that point, so a collection is
+    migrated without a window in which it has no usable index. Indexes are built CONCURRENTLY
+    so that queries and ingestion keep running, which is why this is meant to run in a background thread.
+    On a partitioned table each index is built per partition (see create_index).
+    """
+    global active_quantization
+    if not use_pgvector:
+        return
+    try:
+        with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            wanted_name = (vector_index_name(settings.vector_index_type, settings.vector_quantization)
+                           if settings.vector_index_type in VECTOR_INDEX_NAMES else None)
+            # Only one backend process maintains the indexes at a time
+            if not conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": INDEX_LOCK_KEY}).scalar():
+                print("Vector index maintenance is running in another process")
+                # That process builds the index; use it if it is already there
+                state = get_index_state(conn, wanted_name) if wanted_name else None
+                if wanted_name is None or (state is not None and state.indisvalid):
+                    active_quantization = settings.vector_quantization
+                return
+            try:
+                partitions = list_partitions(conn)
+                # Tables created before the dimension was configured have an untyped vector column
+                typmod = conn.execute(text("""
+                    SELECT atttypmod FROM pg_attribute
+                    WHERE attrelid = 'langchain_pg_embedding'::regclass AND attname = 'embedding'
+                """)).scalar()
+                if typmod is not None and typmod < 0:
+                    conn.execute(text(f"ALTER TABLE langchain_pg_embedding ALTER COLUMN embedding TYPE vector({settings.embedding_dimension})"))
+
+                create_index(conn, FILE_ID_INDEX_NAME, "((cmetadata->>'file_id'))", partitions)
+
+                if settings.retriever_mode == "hybrid":
+                    # Full-text leg of the hybrid retriever; adding the stored column rewrites the table once
+                    conn.execute(text(f"""
+                        ALTER TABLE langchain_pg_embedding ADD COLUMN IF NOT EXISTS document_tsv tsvector
+                        GENERATED ALWAYS AS (to_tsvector('{settings.fts_config}'::regconfig, coalesce(document, ''))) STORED
+                    """))
+                    create_index(conn, FTS_INDEX_NAME, "USING gin (document_tsv)", partitions)
+
+                if wanted_name is not None:
+                    existing = get_index_state(conn, wanted_name)
+                    # A partitioned index is invalid until all partitions are attached, which create_index resumes
+                    invalid = existing is not None and not existing.indisvalid and partitions is None
+                    if existing is not None and (invalid or sorted(existing.reloptions or []) != sorted(desired_index_options())):
+                        drop_index(conn, wanted_name, partitions)
+                    expressions = quantized_expressions(settings.vector_quantization)
+                    options = ", ".join(option.replace("=", " = ") for option in desired_index_options())
+                    print(f"Ensuring vector index {wanted_name} WITH ({options})")
+                    create_index(conn, wanted_name, f"USING {settings.vector_index_type} "
+                                 f"({expressions['column']} {expressions['opclass']}) WITH ({options})", partitions)
+                # Searches use the configured quantization from here on; the previous index served them until now
+                active_quantization = settings.vector_quantization
+
+                for index_type in VECTOR_INDEX_NAMES:
+                    for quantization in QUANTIZATIONS:
+                        index_name = vector_index_name(index_type, quantization)
+                        if index_name != wanted_name and get_index_state(conn, index_name) is not None:
+                            drop_index(conn, index_name, partitions)
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": INDEX_LOCK_KEY})
+    except Exception as e:
+        print(f"Error maintaining vector indexes: {e}")
+
+def measure_recall(db: Session, sample_size: int, k: int, collection: str = collection_name) -> dict:
+    """
+    Estimate the recall@k of the search path in a collection against an exact full-precision scan.
+
+    Random stored embeddings are used as queries. Each is searched through the index with the
+    collection's search parameters, as retrieval does, and once with index scans disabled, and
+    the overlap of the two top-k lists is averaged. With a quantized index, the recall of its
+    first pass alone (the top k by quantized distance, without re-scoring) is also measured.
+
+    Returns:
+        dict: The mean "search" recall@k and, when quantized, the "first_pass" recall@k;
+            None values if the collection is empty.
+    """
+    collection_id = get_collection_id(db, collection)
+    samples = db.execute(text("""
+        SELECT embedding::text FROM langchain_pg_embedding
+        WHERE collection_id = :collection_id ORDER BY random() LIMIT :sample_size
+    """), {"collection_id": collection_id, "sample_size": sample_size}).scalars().all()
+
+    quantization = active_quantization
+    searches = {"search": text(f"SELECT id FROM ({quantized_search_sql(quantization)}) s")}
+    if quantization != "none":
+        expressions = quantized_expressions(quantization)
+        searches["first_pass"] = text(f"""
+            SELECT id FROM langchain_pg_embedding
+            WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection)
+            ORDER BY {expressions['column']} {expressions['operator']} {expressions['query']} LIMIT :k
+        """)
+    exact_query = text(f"SELECT id FROM ({quantized_search_sql('none')}) s")
+    statements = search_param_statements(resolve_search_params(collection))
+    recalls = {name: [] for name in searches}
+    for query in samples:
+        arguments = {"collection": collection, "embedding": query, "k": k,
+                     "candidates": max(k, settings.vector_rescore_candidates)}
+        # Exact search with index scans disabled
+        db.execute(text("SET LOCAL enable_indexscan = off"))
+        exact = set(db.execute(exact_query, arguments).scalars().all())
+        db.rollback()
+        if not exact:
+            continue
+        for name, search_query in searches.items():
+            # Approximate search through the index
+            for statement in statements:
+                db.execute(text(statement))
+            approximate = set(db.execute(search_query, arguments).scalars().all())
+            db.rollback()
+            recalls[name].append(len(approximate & exact) / len(exact))
+    return {name: round(sum(values) / len(values), 4) if values else None for name, values in recalls.items()}
+
+def get_quantization_report(db: Session) -> dict:
+    """
+    Report the storage of the embeddings at each precision and what the configured quantization saves.
+
+    The full-precision vectors stay in the table for re-scoring; quantization shrinks the ANN index,
+    which is what has to stay in memory. The per-row sizes follow pgvector's on-disk formats
+    (an 8-byte header and 4, 2 or 1/8 bytes per dimension).
+
+    Returns:
+        dict: The configured and active quantization, the re-scored candidates, the stored vectors,
+            the bytes per vector at each precision and the estimated index bytes saved.
+    """
+    dimension = settings.embedding_dimension
+    bytes_per_vector = {"none": 8 + 4 * dimension, "halfvec": 8 + 2 * dimension, "binary": 8 + (dimension + 7) // 8}
+    vectors = db.execute(text("SELECT count(*) FROM langchain_pg_embedding")).scalar()
+    table_bytes = db.execute(text("SELECT sum(pg_table_size(relid)) FROM pg_partition_tree('langchain_pg_embedding')")).scalar()
+    return {
+        "configured": settings.vector_quantization,
+        "active": active_quantization,
+        "rescore_candidates": settings.vector_rescore_candidates,
+        "vectors": vectors,
+        "table_bytes": table_bytes,
+        "bytes_per_vector": bytes_per_vector,
+        # Index tuples hold the indexed value, so the index shrinks by about the difference per row
+        "estimated_index_bytes_saved": vectors * (bytes_per_vector["none"] - bytes_per_vector[settings.vector_quantization]),
+    }
+
+def list_embedded_collections() -> List[str]:
+    """
+    Return the collections of the embedded backend: the default one and those with a directory under collections/.
+    """
+    root = embedded_store_path(collection_name) / "collections"
+    others = sorted(path.name for path in root.iterdir() if path.is_dir()) if root.is_dir() else []
+    return [collection_name] + others
+
+def get_vector_index_report(db: Session, sample_size: int = 20, k: int = 10, collection: Optional[str] = None) -> dict:
+    """
+    Report the size and build state of the indexes on langchain_pg_embedding and the ANN recall per collection.
+
+    Args:
+        db (Session): SQLAlchemy session used for the catalog queries and the recall samples.
+        sample_size (int): The number of stored embeddings of each collection used as recall queries.
+        k (int): The number of neighbours compared per query.
+        collection (str, optional): Only report this collection; all collections by default.
+
+    Returns:
+        dict: The configured index, the size and validity of each index, any build in progress and
+            the quantization storage report, and per collection its search parameters, partition,
+            the indexes on the partition and the measured recall@k (also of the quantized first pass
+            alone). With the embedded backend, the segment and row counts of each collection.
+    """
+    if not use_pgvector:
+        names = [collection] if collection else list_embedded_collections()
+        # Reporting an unknown collection must not create its directory
+        return {"collections": {name: get_embedded_store(name).stats() for name in names
+                                if name == collection_name or embedded_store_path(name).exists()}}
+    indexes = db.execute(text("""
+        SELECT c.relname AS name, t.relname AS table_name, pg_relation_size(c.oid) AS size_bytes, i.indisvalid AS valid,
+               i.indisready AS ready, pg_get_indexdef(c.oid) AS definition
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid JOIN pg_class t ON t.oid = i.indrelid
+        WHERE i.indrelid IN (SELECT relid FROM pg_partition_tree('langchain_pg_embedding'))
+        ORDER BY c.relname
+    """)).mappings().all()
+    builds = db.execute(text("""
+        SELECT index_relid::regclass::text AS name, phase, blocks_done, blocks_total, tuples_done, tuples_total
+        FROM pg_stat_progress_create_index WHERE relid IN (SELECT relid FROM pg_partition_tree('langchain_pg_embedding'))
+    """)).mappings().all()
+    partitions = db.execute(text("""
+        SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound,
+               c.reltuples::bigint AS estimated_rows, pg_table_size(c.oid) AS size_bytes
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'langchain_pg_embedding'::regclass
+        ORDER BY c.relname
+    """)).mappings().all()
+    partitions_by_name = {partition["name"]: dict(partition) for partition in partitions}
+    names = [collection] if collection else db.execute(text("SELECT name FROM langchain_pg_collection ORDER BY name")).scalars().all()
+    collections = {}
+    for name in names:
+        # An unpartitioned table keeps every collection in langchain_pg_embedding itself, and
+        # collections without their own partition are stored in the default one
+        table_name = "langchain_pg_embedding"
+        if partitions_by_name:
+            table_name = partition_name(name) if partition_name(name) in partitions_by_name else "langchain_pg_embedding_default"
+        recall = measure_recall(db, sample_size, k, name)
+        collections[name] = {
+            "search_params": resolve_search_params(name),
+            "partition": partitions_by_name.get(table_name),
+            "indexes": [dict(index) for index in indexes if index["table_name"] == table_name],
+            f"recall_at_{k}": recall["search"],
+        }
+        if "first_pass" in recall:
+            collections[name][f"first_pass_recall_at_{k}"] = recall["first_pass"]
+    return {
+        "index_type": settings.vector_index_type,
+        "build_options": desired_index_options() if settings.vector_index_type in VECTOR_INDEX_NAMES else [],
+        "indexes": [dict(index) for index in indexes],
+        "builds_in_progress": [dict(build) for build in builds],
+        "partitions": [dict(partition) for partition in partitions],
+        "quantization": get_quantization_report(db),
+        "collections": collections,
+    }
@@ -1,7 +1,22 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, AfterValidator
+from typing import Annotated
 from enum import Enum
 from datetime import datetime
 
+# Collection names become table names of the embedding partitions, so they are kept to simple identifiers
+COLLECTION_PATTERN = r"^[a-z0-9_]{1,40}$"
+# Their partitions would take the names of the default partition and of the table renamed while partitioning
+RESERVED_COLLECTIONS = ("default", "unpartitioned")
+
+def check_collection_name(name: str | None) -> str | None:
+    # Pydantic patterns have no look-ahead, so the reserved names are rejected here
+    if name in RESERVED_COLLECTIONS:
+        raise ValueError(f"Collection name '{name}' is reserved")
+    return name
+
+# A tenant collection name in a request body; route parameters combine check_collection_name with Query or Form
+CollectionName = Annotated[str, Field(pattern=COLLECTION_PATTERN), AfterValidator(check_collection_name)]
+
 class ModelName(str, Enum):
     Ollama_LLM_model1: str = "gemma3:4b"
     Ollama_LLM_model2: str = "gemma3:1b"
@@ -11,16 +26,85 @@ class QueryInput(BaseModel):
     prompt: str
     session_id: str = Field(default=None)
     model: ModelName = Field(default=ModelName.Ollama_LLM_model1)
+    # Optional per-request ANN search tuning (hnsw.ef_search / ivfflat.probes)
+    ef_search: int | None = Field(default=None, ge=1, le=1000)
+    probes: int | None = Field(default=None, ge=1)
+    # Skip the semantic answer cache and always generate a fresh answer
+    bypass_cache: bool = False
+    # Search this tenant's collection instead of the default one, optionally only these documents
+    collection: CollectionName | None = None
+    file_ids: list[int] | None = Field(default=None, min_length=1, max_length=1000)
+
+class SearchInput(BaseModel):
+    query: str
+    k: int = Field(default=5, ge=1, le=100)
+    ef_search: int | None = Field(default=None, ge=1, le=1000)
+    probes: int | None = Field(default=None, ge=1)
+    collection: CollectionName | None = None
+    file_ids: list[int] | None = Field(default=None, min_length=1, max_length=1000)
+
+class SearchResult(BaseModel):
+    content: str
+    # Cosine similarity of the chunk to the query
+    score: float
+    file_id: int | None = None
+    source: str | None = None
+    page: int | None = None
+    metadata: dict = {}
+
+class BatchQueryInput(BaseModel):
+    # Answered independently, without chat history; the limit is settings.batch_max_prompts
+    prompts: list[str] = Field(min_length=1)
+    model: ModelName = Field(default=ModelName.Ollama_LLM_model1)
+    ef_search: int | None = Field(default=None, ge=1, le=1000)
+    probes: int | None = Field(default=None, ge=1)
+    collection: CollectionName | None = None
+    file_ids: list[int] | None = Field(default=None, min_length=1, max_length=1000)
 
 class QueryResponse(BaseModel):
     answer: str
     session_id: str
     model: ModelName
+    # Estimated prompt tokens of the retrieved context before and after merging and budget packing
+    context_tokens_before: int | None = None
+    context_tokens_after: int | None = None
+    # True when the answer was served from the semantic answer cache
+    cached: bool = False
+    # How the standalone question was obtained: "first_turn", "skipped", "cached" or "rewritten"
+    rewrite: str | None = None
 
 class DocumentInfo(BaseModel):
     id: int
     filename: str
     upload_timestamp: datetime
+    version: int = 1
+    # "updating" while a new version is indexed; the previous version is still searchable
+    status: str = "indexed"
+    collection: str | None = None
 
 class DeleteFileRequest(BaseModel):
-    file_id: int
\ No newline at end of file
+    file_id: int
+    # When given, the document must belong to this collection
+    collection: CollectionName | None = None
+
+class JobInfo(BaseModel):
+    job_id: str
+    file_id: int
+    filename: str
+    collection: str | None = None
+    version: int = 1
+    status: str
+    pages_parsed: int = 0
+    chunks_total: int = 0
+    load_seconds: float | None = None
+    split_seconds: float | None = None
+    chunks_embedded: int = 0
+    # Updates only: chunks kept from the previous version and chunks that disappeared from it
+    chunks_unchanged: int = 0
+    chunks_deleted: int = 0
+    chunks_per_second: float | None = None
+    embed_seconds: float | None = None
+    db_seconds: float | None = None
+    error: str | None = None
+    created_at: datetime
+    finished_at: datetime | None = None
@@ -0,0 +1,515 @@
+import asyncio
+import contextvars
+import math
+from functools import cache
+from typing import Any, List, Optional, Tuple
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import text
+from .settings import settings
+from .db_utils import get_engine
+from .pgvector_utils import (get_async_vector_engine, get_embedded_store, embedded_store_path, get_embeddings, get_active_quantization,
+                             quantized_search_sql, collection_name, CHUNK_OVERLAP)
+
+@cache
+def vector_search_query(quantization: str, file_ids: bool = False):
+    """
+    Nearest neighbours by cosine distance; the collection is resolved inline to keep one round trip.
+    With quantization, a first pass over the quantized index is re-scored at full precision.
+    With file_ids, only the chunks of those documents are ranked.
+    """
+    return text(quantized_search_sql(quantization, file_ids=file_ids)).columns(embedding=Vector())
+
+@cache
+def vector_search_batch_query(quantization: str, file_ids: bool = False):
+    """
+    Nearest neighbours of every vector of :embeddings in one statement: the single-query search
+    runs once per vector through a LATERAL join, and each row carries the ordinal of its query.
+    """
+    search = quantized_search_sql(quantization, file_ids=file_ids, embedding="q.embedding")
+    return text(f"""
+        SELECT q.ord, r.id, r.document, r.cmetadata, r.embedding
+        FROM unnest(CAST(:embeddings AS text[])) WITH ORDINALITY AS q(embedding, ord)
+        CROSS JOIN LATERAL ({search}) r
+        ORDER BY q.ord, r.embedding <=> CAST(q.embedding AS vector)
+    """).columns(embedding=Vector())
+
+# Full-text matches ranked by cover density over the generated document_tsv column
+LEXICAL_SEARCH_QUERY = text("""
+    SELECT e.id, e.document, e.cmetadata, e.embedding
+    FROM langchain_pg_embedding e, websearch_to_tsquery(CAST(:config AS regconfig), :query) q
+    WHERE e.collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection)
+    AND e.document_tsv @@ q
+    AND (CAST(:file_ids AS text[]) IS NULL OR e.cmetadata->>'file_id' = ANY(CAST(:file_ids AS text[])))
+    ORDER BY ts_rank_cd(e.document_tsv, q) DESC
+    LIMIT :k
+""").columns(embedding=Vector())
+
+# The full-text search of every query of :queries in one statement, tagged with the query's ordinal
+LEXICAL_SEARCH_BATCH_QUERY = text("""
+    SELECT q.ord, r.id, r.document, r.cmetadata, r.embedding
+    FROM unnest(CAST(:queries AS text[])) WITH ORDINALITY AS q(query, ord)
+    CROSS JOIN LATERAL (
+        SELECT e.id, e.document, e.cmetadata, e.embedding, ts_rank_cd(e.document_tsv, t) AS rank
+        FROM langchain_pg_embedding e, websearch_to_tsquery(CAST(:config AS regconfig), q.query) t
+        WHERE e.collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection)
+        AND e.document_tsv @@ t
+        AND (CAST(:file_ids AS text[]) IS NULL OR e.cmetadata->>'file_id' = ANY(CAST(:file_ids AS text[])))
+        ORDER BY rank DESC
+        LIMIT :k
+    ) r
+    ORDER BY q.ord, r.rank DESC
+""").columns(embedding=Vector())
+
+# Token counts of the latest retrieval, filled in for whoever set a dict for the current request
+retrieval_stats = contextvars.ContextVar("retrieval_stats", default=None)
+
+# Collection and file_ids the current request searches, as {"collection": str | None, "file_ids": list | None}
+retrieval_scope = contextvars.ContextVar("retrieval_scope", default=None)
+
+# The standalone question of the current request and its embedding, as (query, embedding), when the
+# answer cache key already embedded it; the retriever reuses it instead of embedding the query again
+query_embedding = contextvars.ContextVar("query_embedding", default=None)
+
+def get_scope(default_collection: str) -> Tuple[str, Optional[List[int]]]:
+    """
+    Return the collection and file_ids to search for the current request.
+    """
+    scope = retrieval_scope.get() or {}
+    return scope.get("collection") or default_collection, scope.get("file_ids")
+
+# A retrieved chunk together with its stored embedding
+Candidate = Tuple[Document, np.ndarray]
+
+def to_vector_literal(vector: List[float]) -> str:
+    """
+    Format an embedding in pgvector's text representation.
+    """
+    return "[" + ",".join(map(str, vector)) + "]"
+
+def rows_to_candidates(rows) -> List[Candidate]:
+    """
+    Convert (id, document, cmetadata, embedding) rows into documents paired with their embeddings.
+    """
+    return [(Document(id=row.id, page_content=row.document, metadata=row.cmetadata or {}), row.embedding) for row in rows]
+
+def group_rows_by_query(rows, count: int) -> List[List[Candidate]]:
+    """
+    Split the (ord, id, document, cmetadata, embedding) rows of a batch search into the ranked
+    candidates of each query; ordinals start at 1.
+    """
+    results = [[] for _ in range(count)]
+    for row in rows:
+        results[row.ord - 1].append((Document(id=row.id, page_content=row.document, metadata=row.cmetadata or {}), row.embedding))
+    return results
+
+def cosine_similarities(query_embedding: List[float], candidates: List[Candidate]) -> List[float]:
+    """
+    Return the cosine similarity of the query to each candidate's stored embedding.
+    """
+    if not candidates:
+        return []
+    vectors = np.vstack([vector for _, vector in candidates]).astype(np.float32)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    similarities = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query) + 1e-12)
+    return similarities.tolist()
+
+def estimate_tokens(content: str) -> int:
+    """
+    Estimate the number of prompt tokens of a text from its length.
+    """
+    return math.ceil(len(content) / settings.chars_per_token)
+
+def reciprocal_rank_fusion(result_lists: List[List[Candidate]], rrf_k: int, top_k: int) -> List[Candidate]:
+    """
+    Merge ranked result lists by reciprocal rank fusion.
+
+    Each document scores the sum of 1 / (rrf_k + rank) over the lists it appears in,
+    with ranks starting at 1.
+
+    Args:
+        result_lists (List[List[Candidate]]): The ranked results of each retrieval leg.
+        rrf_k (int): The rank offset that damps the influence of top positions.
+        top_k (int): The number of fused candidates to return.
+
+    Returns:
+        List[Candidate]: The top_k candidates by fused score.
+    """
+    scores = {}
+    candidates = {}
+    for results in result_lists:
+        for rank, candidate in enumerate(results, start=1):
+            doc_id = candidate[0].id
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+            candidates.setdefault(doc_id, candidate)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [candidates[doc_id] for doc_id in ranked[:top_k]]
+
+def mmr_select(query_embedding: np.ndarray, candidate_embeddings: np.ndarray, k: int, lambda_mult: float) -> List[int]:
+    """
+    Select k candidates by maximal marginal relevance.
+
+    All query and pairwise cosine similarities are computed up front with one matrix product;
+    each greedy step then only updates a running vector of the highest similarity to the
+    already selected candidates.
+
+    Args:
+        query_embedding (np.ndarray): The query vector, shape (d,).
+        candidate_embeddings (np.ndarray): The candidate vectors, shape (n, d).
+        k (int): The number of candidates to select.
+        lambda_mult (float): Trade-off between relevance (1.0) and diversity (0.0).
+
+    Returns:
+        List[int]: The indices of the selected candidates, in selection order.
+    """
+    vectors = np.vstack([query_embedding, candidate_embeddings]).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    similarities = vectors[1:] @ vectors.T
+    relevance = similarities[:, 0]
+    pairwise = similarities[:, 1:]
+
+    n = len(candidate_embeddings)
+    selected = []
+    max_similarity = np.full(n, -np.inf, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    for _ in range(min(k, n)):
+        redundancy = np.where(np.isfinite(max_similarity), max_similarity, 0.0)
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_similarity = np.maximum(max_similarity, pairwise[:, best])
+    return selected
+
+def overlap_length(first: Document, second: Document) -> int:
+    """
+    Return how many leading characters of second repeat the end of first, or -1 if the
+    two chunks are not adjacent parts of the same document.
+
+    Chunks stored with a start_index are compared by position; older chunks fall back to
+    matching the end of the first chunk against the start of the second, which finds the
+    chunk_overlap region left by the text splitter.
+    """
+    if first.metadata.get("file_id") != second.metadata.get("file_id"):
+        return -1
+    if first.metadata.get("page") != second.metadata.get("page"):
+        return -1
+    a, b = first.page_content, second.page_content
+    start_a, start_b = first.metadata.get("start_index"), second.metadata.get("start_index")
+    if start_a is not None and start_b is not None:
+        overlap = start_a + len(a) - start_b
+        if 0 <= overlap < len(b) and start_b > start_a:
+            return overlap
+        return -1
+    for size in range(min(len(a), len(b) - 1, CHUNK_OVERLAP), settings.min_merge_overlap - 1, -1):
+        if a.endswith(b[:size]):
+            return size
+    return -1
+
+def merge_adjacent_chunks(documents: List[Document]) -> List[Document]:
+    """
+    Merge chunks that continue each other into single passages with the overlap removed.
+
+    The merged passage takes the position of its highest-ranked member.
+    """
+    passages = [Document(id=doc.id, page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in documents]
+    merged = True
+    while merged:
+        merged = False
+        for i, first in enumerate(passages):
+            for j, second in enumerate(passages):
+                if i == j:
+                    continue
+                overlap = overlap_length(first, second)
+                if overlap < 0:
+                    continue
+                first.page_content = first.page_content + second.page_content[overlap:]
+                first.metadata["merged_chunks"] = first.metadata.get("merged_chunks", 1) + second.metadata.get("merged_chunks", 1)
+                if i > j:
+                    # Keep the passage at the better of the two ranks
+                    passages[j] = first
+                    del passages[i]
+                else:
+                    del passages[j]
+                merged = True
+                break
+            if merged:
+                break
+    return passages
+
+def pack_context(documents: List[Document], token_budget: int) -> List[Document]:
+    """
+    Pack ranked passages into the context until the token budget is used.
+
+    Passages that do not fit are skipped so that smaller, lower-ranked ones can still be
+    added. If even the best passage does not fit, it is truncated to the budget.
+    """
+    packed = []
+    used = 0
+    for doc in documents:
+        tokens = estimate_tokens(doc.page_content)
+        if used + tokens <= token_budget:
+            packed.append(doc)
+            used += tokens
+    if not packed and documents:
+        best = documents[0]
+        characters = int(token_budget * settings.chars_per_token)
+        packed.append(Document(id=best.id, page_content=best.page_content[:characters], metadata=best.metadata))
+    return packed
+
+class SQLRetriever(BaseRetriever):
+    """
+    Retriever that queries langchain_pg_embedding directly.
+
+    The vector leg and the optional full-text leg run as single SQL statements, concurrently
+    on the async path, and are merged with reciprocal rank fusion. The lexical leg catches exact
+    matches on identifiers such as part numbers and error codes that embeddings tend to blur.
+    When MMR is enabled the fused candidates are re-ranked for diversity using their stored
+    embeddings, and when a token budget is set adjacent chunks are merged and packed into it.
+    With `rescore_k` set, the vector leg searches the quantized index for that many candidates
+    and re-scores them with the full-precision embeddings. Both legs search the collection and
+    documents of `retrieval_scope`, filtered in SQL. `aretrieve_batch` searches many queries
+    with one statement per leg.
+    """
+
+    embeddings: Any
+    collection: str
+    vector_k: int = 20
+    # 0 disables the full-text leg
+    lexical_k: int = 0
+    candidate_k: int = 2
+    rrf_k: int = 60
+    fts_config: str = "english"
+    top_k: int = 2
+    mmr_lambda: Optional[float] = None
+    token_budget: Optional[int] = None
+    # 0 searches the full-precision vectors directly
+    rescore_k: int = 0
+
+    def _quantization(self) -> str:
+        # Quantized search starts once ensure_vector_indexes has built the quantized index
+        return get_active_quantization() if self.rescore_k > 0 else "none"
+
+    def _vector_query(self):
+        _, file_ids = get_scope(self.collection)
+        return vector_search_query(self._quantization(), file_ids is not None)
+
+    def _scope_params(self) -> dict:
+        collection, file_ids = get_scope(self.collection)
+        # cmetadata->>'file_id' is text
+        return {"collection": collection, "file_ids": [str(file_id) for file_id in file_ids] if file_ids is not None else None}
+
+    def _vector_params(self, embedding: List[float]) -> dict:
+        return {**self._scope_params(), "embedding": to_vector_literal(embedding), "k": self.vector_k,
+                "candidates": max(self.rescore_k, self.vector_k)}
+
+    def _lexical_params(self, query: str) -> dict:
+        return {**self._scope_params(), "config": self.fts_config, "query": query, "k": self.lexical_k}
+
+    def _select(self, embedding: List[float], vector_results: List[Candidate], lexical_results: List[Candidate]) -> List[Document]:
+        candidates = reciprocal_rank_fusion([vector_results, lexical_results], self.rrf_k, self.candidate_k)
+        if not candidates:
+            return []
+
+        if self.mmr_lambda is not None:
+            order = mmr_select(np.asarray(embedding, dtype=np.float32), np.vstack([vector for _, vector in candidates]),
+                               self.top_k, self.mmr_lambda)
+            selected = [candidates[i][0] for i in order]
+        else:
+            selected = [doc for doc, _ in candidates[:self.top_k]]
+
+        tokens_before = sum(estimate_tokens(doc.page_content) for doc in selected)
+        if self.token_budget is not None:
+            selected = pack_context(merge_adjacent_chunks(selected), self.token_budget)
+        tokens_after = sum(estimate_tokens(doc.page_content) for doc in selected)
+
+        stats = retrieval_stats.get()
+        if stats is not None:
+            stats.update(candidates=len(candidates), context_tokens_before=tokens_before, context_tokens_after=tokens_after)
+        return selected
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        embedding = self.embeddings.embed_query(query)
+        with get_engine().connect() as conn:
+            vector_results = rows_to_candidates(conn.execute(self._vector_query(), self._vector_params(embedding)))
+        lexical_results = []
+        if self.lexical_k > 0:
+            try:
+                with get_engine().connect() as conn:
+                    lexical_results = rows_to_candidates(conn.execute(LEXICAL_SEARCH_QUERY, self._lexical_params(query)))
+            except Exception as e:
+                print(f"Lexical search failed, using vector results only: {e}")
+        return self._select(embedding, vector_results, lexical_results)
+
+    async def _vector_search(self, embedding: List[float]) -> List[Candidate]:
+        async with get_async_vector_engine().connect() as conn:
+            return rows_to_candidates(await conn.execute(self._vector_query(), self._vector_params(embedding)))
+
+    async def _lexical_search(self, query: str) -> List[Candidate]:
+        if self.lexical_k <= 0:
+            return []
+        try:
+            async with get_async_vector_engine().connect() as conn:
+                return rows_to_candidates(await conn.execute(LEXICAL_SEARCH_QUERY, self._lexical_params(query)))
+        except Exception as e:
+            # A missing document_tsv column should degrade retrieval, not fail the chat
+            print(f"Lexical search failed, using vector results only: {e}")
+            return []
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        known = query_embedding.get()
+        if known is not None and known[0] == query:
+            return known[1]
+        return await self.embeddings.aembed_query(query)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        lexical_task = asyncio.ensure_future(self._lexical_search(query))
+        embedding = await self._aembed_query(query)
+        vector_results, lexical_results = await asyncio.gather(self._vector_search(embedding), lexical_task)
+        return self._select(embedding, vector_results, lexical_results)
+
+    async def avector_search_batch(self, embeddings: List[List[float]], k: Optional[int] = None) -> List[List[Candidate]]:
+        """
+        Run the vector leg for many query embeddings in a single round trip.
+
+        Args:
+            embeddings (List[List[float]]): The query embeddings.
+            k (int, optional): The number of results per query; defaults to `vector_k`.
+
+        Returns:
+            List[List[Candidate]]: The ranked candidates of each query, in the order of the embeddings.
+        """
+        k = k or self.vector_k
+        params = {**self._scope_params(), "embeddings": [to_vector_literal(embedding) for embedding in embeddings],
+                  "k": k, "candidates": max(self.rescore_k, k)}
+        query = vector_search_batch_query(self._quantization(), params["file_ids"] is not None)
+        async with get_async_vector_engine().connect() as conn:
+            return group_rows_by_query(await conn.execute(query, params), len(embeddings))
+
+    async def alexical_search_batch(self, queries: List[str]) -> List[List[Candidate]]:
+        """
+        Run the full-text leg for many queries in a single round trip; empty lists when it is disabled or fails.
+        """
+        if self.lexical_k <= 0:
+            return [[] for _ in queries]
+        try:
+            async with get_async_vector_engine().connect() as conn:
+                rows = await conn.execute(LEXICAL_SEARCH_BATCH_QUERY, {**self._scope_params(), "config": self.fts_config,
+                                                                       "queries": queries, "k": self.lexical_k})
+                return group_rows_by_query(rows, len(queries))
+        except Exception as e:
+            print(f"Lexical search failed, using vector results only: {e}")
+            return [[] for _ in queries]
+
+    async def aretrieve_batch(self, queries: List[str], embeddings: List[List[float]]) -> List[List[Document]]:
+        """
+        Retrieve the context of many queries whose embeddings are already computed.
+
+        Both legs search all queries at once, concurrently, and each query's candidates then go
+        through the same fusion, re-ranking and packing as a single retrieval.
+
+        Returns:
+            List[List[Document]]: The selected documents of each query, in the order of the queries.
+        """
+        vector_results, lexical_results = await asyncio.gather(self.avector_search_batch(embeddings),
+                                                               self.alexical_search_batch(queries))
+        return [self._select(embedding, vectors, lexical)
+                for embedding, vectors, lexical in zip(embeddings, vector_results, lexical_results)]
+
+class EmbeddedRetriever(SQLRetriever):
+    """
+    Retriever over the embedded NumPy vector store.
+
+    Uses the same MMR re-ranking and context packing as SQLRetriever; there is no full-text leg.
+    The search runs in a worker thread on the async path, since the matrix products are CPU bound.
+    Each collection has its own store; `retrieval_scope` selects it and the file_ids to search.
+    """
+
+    store: Any
+
+    def _search_batch(self, embeddings: List[List[float]], k: int) -> List[List[Candidate]]:
+        collection, file_ids = get_scope(self.collection)
+        store = self.store
+        if collection != self.collection:
+            # Searching an unknown collection must not create its directory
+            if not embedded_store_path(collection).exists():
+                return [[] for _ in embeddings]
+            store = get_embedded_store(collection)
+        return [[(doc, vector) for doc, _, vector in results] for results in store.search_batch(embeddings, k, file_ids)]
+
+    def _search(self, embedding: List[float]) -> List[Candidate]:
+        return self._search_batch([embedding], self.vector_k)[0]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        embedding = self.embeddings.embed_query(query)
+        return self._select(embedding, self._search(embedding), [])
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        embedding = await self._aembed_query(query)
+        return self._select(embedding, await asyncio.to_thread(self._search, embedding), [])
+
+    async def avector_search_batch(self, embeddings: List[List[float]], k: Optional[int] = None) -> List[List[Candidate]]:
+        return await asyncio.to_thread(self._search_batch, embeddings, k or self.vector_k)
+
+    async def alexical_search_batch(self, queries: List[str]) -> List[List[Candidate]]:
+        return [[] for _ in queries]
+
+@cache
+def get_retriever() -> BaseRetriever:
+    """
+    Build the retriever selected by `settings.retriever_mode` and `settings.rerank_enabled`.
+
+    "hybrid" fuses vector and full-text search; "vector" is plain similarity search. With
+    re-ranking enabled, a wide candidate set is re-ranked by MMR and packed into the context
+    token budget; otherwise the top `settings.retriever_k` chunks are used as they are.
+    With `settings.vector_quantization`, vector search runs on the quantized index and re-scores
+    `settings.vector_rescore_candidates` candidates at full precision.
+    The embedded NumPy backend supports re-ranking but not the full-text leg or quantization.
+    Built on first use and shared by all chains; each request's collection and documents are
+    taken from `retrieval_scope`.
+    """
+    embeddings = get_embeddings()
+    embedded_store = get_embedded_store()
+    if embedded_store is not None:
+        return EmbeddedRetriever(
+            embeddings=embeddings,
+            store=embedded_store,
+            collection=collection_name,
+            vector_k=settings.rerank_candidate_k if settings.rerank_enabled else settings.retriever_k,
+            candidate_k=settings.rerank_candidate_k if settings.rerank_enabled else settings.retriever_k,
+            top_k=settings.rerank_top_k if settings.rerank_enabled else settings.retriever_k,
+            mmr_lambda=settings.mmr_lambda if settings.rerank_enabled else None,
+            token_budget=settings.context_token_budget if settings.rerank_enabled else None,
+        )
+    hybrid = settings.retriever_mode == "hybrid"
+    rescore_k = settings.vector_rescore_candidates if settings.vector_quantization != "none" else 0
+    if settings.rerank_enabled:
+        return SQLRetriever(
+            embeddings=embeddings,
+            collection=collection_name,
+            vector_k=settings.rerank_candidate_k,
+            lexical_k=settings.hybrid_lexical_k if hybrid else 0,
+            candidate_k=settings.rerank_candidate_k,
+            rrf_k=settings.rrf_k,
+            fts_config=settings.fts_config,
+            top_k=settings.rerank_top_k,
+            mmr_lambda=settings.mmr_lambda,
+            token_budget=settings.context_token_budget,
+            rescore_k=rescore_k,
+        )
+    # PGVector's own retriever can neither use the quantized index nor be scoped per request,
+    # so plain vector search goes through SQL too
+    return SQLRetriever(
+        embeddings=embeddings,
+        collection=collection_name,
+        vector_k=settings.hybrid_vector_k if hybrid else settings.retriever_k,
+        lexical_k=settings.hybrid_lexical_k if hybrid else 0,
+        candidate_k=settings.retriever_k,
+        rrf_k=settings.rrf_k,
+        fts_config=settings.fts_config,
+        top_k=settings.retriever_k,
+        rescore_k=rescore_k,
+    )
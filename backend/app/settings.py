@@ -3,4 +3,150 @@ from pydantic_settings import BaseSettings
 class Settings(BaseSettings):
     ollama_url: str = "http://host.docker.internal:11434"
 
-settings = Settings()
\ No newline at end of file
+    # Ollama models loaded at startup and kept resident; /ready reports them.
+    # keep_alive is in seconds (-1 keeps a model loaded indefinitely).
+    # Per-model overrides of keep_alive and num_ctx, e.g. {"gemma3:4b": {"num_ctx": 8192, "keep_alive": 3600}}
+    warmup_models: list[str] = ["gemma3:4b", "gemma3:1b", "mxbai-embed-large"]
+    ollama_keep_alive: int | None = 1800
+    ollama_num_ctx: int | None = None
+    model_options: dict[str, dict[str, int]] = {}
+
+    # Startup waits for the database, retrying with exponential backoff
+    db_connect_max_attempts: int = 10
+    db_connect_initial_delay: float = 0.5
+    db_connect_max_delay: float = 10.0
+
+    # Database connection pools, shared by the ORM and the vector store (one sync, one async)
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    # Applies to the async (request path) engine only; maintenance and ingestion on the sync engine are not limited
+    db_statement_timeout_ms: int | None = 30_000
+    # Executions after which psycopg prepares a statement server-side; None disables preparing
+    db_prepare_threshold: int | None = 2
+
+    # Admission control: concurrent generations per model (with per-model overrides), requests
+    # allowed to wait for a slot and how long they may wait before a 503
+    max_concurrent_generations: int = 2
+    model_max_concurrency: dict[str, int] = {}
+    max_queued_requests: int = 16
+    queue_timeout_seconds: float = 30.0
+
+    # Batch chat (/chat/batch): at most batch_max_prompts prompts per request, embedded and searched in
+    # blocks of batch_block_size per round trip, with batch_generation_concurrency answers generated at once
+    batch_max_prompts: int = 1000
+    batch_block_size: int = 256
+    batch_generation_concurrency: int = 2
+
+    # Observability: X-Trace-Id response header and per-request stage timings in the log;
+    # prompts and answers are only written to the log when log_payloads is set
+    trace_ids_enabled: bool = True
+    log_payloads: bool = False
+
+    # Document ingestion
+    ingestion_workers: int = 2
+    embedding_batch_size: int = 64
+    embedding_max_concurrency: int = 4
+
+    # Bulk uploads (/upload-docs): limits per extracted document and per uploaded archive
+    bulk_upload_max_file_mb: int = 200
+    bulk_upload_max_files: int = 10_000
+
+    # Document parsing: PDFs of at least parse_min_pages_for_pool pages are parsed in ranges of
+    # parse_pages_per_task pages across parse_workers processes (0 parses in the ingestion thread),
+    # each capped at parse_memory_limit_mb of address space (0 for no limit); DOCX files are
+    # streamed in sections of docx_section_paragraphs paragraphs
+    parse_workers: int = 2
+    parse_pages_per_task: int = 16
+    parse_min_pages_for_pool: int = 32
+    parse_memory_limit_mb: int = 2048
+    docx_section_paragraphs: int = 50
+
+    # Persistent embedding cache shared by document chunks and queries; a hit only rewrites the entry's
+    # last_used_at once it is older than embedding_cache_touch_interval_seconds
+    embedding_cache_enabled: bool = True
+    embedding_cache_max_entries: int = 500_000
+    embedding_cache_touch_interval_seconds: int = 3600
+
+    # Collections: each tenant's documents live in their own collection; requests without one use default_collection.
+    # With pgvector, langchain_pg_embedding is list-partitioned by collection so scans and indexes stay tenant-sized
+    default_collection: str = "my_docs"
+    partition_embeddings: bool = True
+
+    # Vector store backend: "pgvector" or "numpy" (embedded memory-mapped .npy segments under numpy_store_path)
+    vector_store_backend: str = "pgvector"
+    numpy_store_path: str = "vector_store"
+    numpy_store_dtype: str = "float32"
+    numpy_store_segment_size: int = 16384
+    # Rewrite the segments once this share of rows has been deleted
+    numpy_store_compact_ratio: float = 0.25
+
+    # Vector index on langchain_pg_embedding.embedding: "hnsw", "ivfflat" or "none"
+    embedding_dimension: int = 1024
+    vector_index_type: str = "hnsw"
+    hnsw_m: int = 16
+    hnsw_ef_construction: int = 64
+    ivfflat_lists: int = 100
+    # Quantized first pass: the index is built on "halfvec" (16-bit) or "binary" (bit, Hamming) views of the
+    # embeddings, and its top vector_rescore_candidates are re-scored at full precision; "none" indexes the vectors
+    vector_quantization: str = "none"
+    vector_rescore_candidates: int = 100
+    # Query-time defaults, overridable per collection (e.g. {"my_docs": {"ef_search": 100}}) and per request
+    hnsw_ef_search: int = 40
+    ivfflat_probes: int = 1
+    collection_search_params: dict[str, dict[str, int]] = {}
+
+    # Retrieval: "vector" or "hybrid" (vector + full-text search fused by reciprocal rank fusion)
+    retriever_mode: str = "vector"
+    retriever_k: int = 2
+    hybrid_vector_k: int = 20
+    hybrid_lexical_k: int = 20
+    rrf_k: int = 60
+    # Text search configuration of the generated document_tsv column, fixed when the column is created
+    fts_config: str = "english"
+
+    # Wide-recall re-ranking: fetch candidates, pick a diverse subset by MMR and pack it into a token budget
+    rerank_enabled: bool = True
+    rerank_candidate_k: int = 50
+    rerank_top_k: int = 8
+    mmr_lambda: float = 0.7
+    context_token_budget: int = 1024
+    chars_per_token: float = 4.0
+    # Shortest shared text accepted as chunk overlap when merging chunks without a start_index
+    min_merge_overlap: int = 50
+
+    # Follow-up rewriting: rewriter_model turns a follow-up into a standalone question (None uses the
+    # chat model) from the last rewrite_history_messages messages; results are cached by a fingerprint
+    # of that input, and questions without back-references are used as they are when rewrite_skip_enabled
+    rewriter_model: str | None = "gemma3:1b"
+    rewrite_history_messages: int = 4
+    rewrite_skip_enabled: bool = True
+    rewrite_cache_max_entries: int = 5000
+    rewrite_cache_ttl_seconds: float = 3600
+
+    # Chat history: recent turns sent to the LLM, bounded by count and tokens; older turns are summarized
+    history_max_turns: int = 10
+    history_token_budget: int = 1024
+    # Summarize once this many turns have fallen out of the recent window; None uses the chat model
+    summary_min_turns: int = 4
+    summary_model: str | None = None
+    # Recent histories of up to this many sessions are kept in memory and updated on write
+    history_cache_max_sessions: int = 10_000
+
+    # Write-behind chat logging: turns are inserted in batches of log_batch_size or every log_flush_interval_seconds;
+    # requests wait for a flush only while log_buffer_max_rows turns are buffered, and beyond that turns are dropped
+    # (rag_chat_logs_dropped_total) until a flush succeeds
+    log_batch_size: int = 100
+    log_flush_interval_seconds: float = 0.5
+    log_buffer_max_rows: int = 10_000
+
+    # Semantic answer cache keyed by the standalone question's embedding
+    answer_cache_enabled: bool = True
+    answer_cache_threshold: float = 0.95
+    answer_cache_max_entries: int = 2000
+    answer_cache_max_bytes: int = 64 * 1024 * 1024
+    answer_cache_ttl_seconds: float = 3600
+
+settings = Settings()
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import tarfile
+import uuid
+import zipfile
+from typing import BinaryIO, Iterator, Optional, Tuple
+from .settings import settings
+
+# Uploaded files wait here until their ingestion job has indexed them
+UPLOAD_DIR = "uploads"
+ALLOWED_EXTENSIONS = ['.pdf', '.docx', '.html']
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+class FileTooLargeError(Exception):
+    """
+    Raised when an uploaded or extracted file exceeds `settings.bulk_upload_max_file_mb`.
+    """
+
+def is_supported(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in ALLOWED_EXTENSIONS
+
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def save_stream(source: BinaryIO, filename: str, max_bytes: Optional[int] = None) -> Tuple[str, str]:
+    """
+    Copy a stream to a uniquely named file under UPLOAD_DIR in 1 MiB blocks, hashing it on the way.
+
+    Args:
+        source (BinaryIO): The stream to copy.
+        filename (str): The original name; only its base name is kept, behind a random prefix
+            so that files with the same name never overwrite each other.
+        max_bytes (int, optional): Abort with FileTooLargeError once this many bytes were copied.
+
+    Returns:
+        tuple: The path of the saved file and the SHA-256 of its content.
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}_{os.path.basename(filename)}")
+    digest = hashlib.sha256()
+    written = 0
+    try:
+        with open(path, "wb") as buffer:
+            while block := source.read(1024 * 1024):
+                written += len(block)
+                if max_bytes is not None and written > max_bytes:
+                    raise FileTooLargeError(f"{filename} is larger than {settings.bulk_upload_max_file_mb} MB")
+                digest.update(block)
+                buffer.write(block)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return path, digest.hexdigest()
+
+def iter_archive_members(archive: BinaryIO, filename: str) -> Iterator[Tuple[str, Optional[BinaryIO]]]:
+    """
+    Yield the regular files of a zip or tar archive as (name, stream) pairs, one at a time.
+
+    Tar archives are read as a stream and zip members are decompressed as they are read, so
+    the archive is never held in memory. Streams are only valid until the next member is yielded.
+    """
+    if filename.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive) as zip_archive:
+            for member in zip_archive.infolist():
+                if not member.is_dir():
+                    with zip_archive.open(member) as stream:
+                        yield member.filename, stream
+    else:
+        with tarfile.open(fileobj=archive, mode="r|*") as tar_archive:
+            for member in tar_archive:
+                if member.isfile():
+                    yield member.name, tar_archive.extractfile(member)
+
+def iter_uploaded_files(source: BinaryIO, filename: str) -> Iterator[dict]:
+    """
+    Save an uploaded file, or every supported document in an uploaded archive, to UPLOAD_DIR.
+
+    Args:
+        source (BinaryIO): The uploaded file.
+        filename (str): Its original name, which tells archives from documents.
+
+    Yields:
+        dict: For each file, its filename and either the saved path and content_hash, or a
+        status of "skipped" or "error" with the reason in detail.
+    """
+    max_bytes = settings.bulk_upload_max_file_mb * 1024 * 1024
+    members = iter_archive_members(source, filename) if is_archive(filename) else [(filename, source)]
+    count = 0
+    try:
+        for name, stream in members:
+            base_name = os.path.basename(name)
+            # Skip folders of resource forks and hidden files that archivers add
+            if not base_name or base_name.startswith(".") or "__MACOSX/" in name:
+                continue
+            if not is_supported(name):
+                yield {"filename": name, "status": "skipped", "detail": f"Unsupported file type. Allowed types are: {', '.join(ALLOWED_EXTENSIONS)}"}
+                continue
+            count += 1
+            if count > settings.bulk_upload_max_files:
+                yield {"filename": filename, "status": "skipped",
+                       "detail": f"Only the first {settings.bulk_upload_max_files} documents of the archive were ingested"}
+                break
+            try:
+                path, content_hash = save_stream(stream, name, max_bytes)
+            except FileTooLargeError as e:
+                yield {"filename": name, "status": "error", "detail": str(e)}
+                continue
+            yield {"filename": name, "path": path, "content_hash": content_hash}
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        yield {"filename": filename, "status": "error", "detail": f"Unreadable archive: {e}"}
@@ -0,0 +1,80 @@
+"""
+Import-time budget check for the backend.
+
+Imports app.main in fresh interpreters and fails when the best of several runs exceeds the
+budget. Importing must not contact the database or Ollama, so the check runs without either:
+the DB_* variables only need to be set, and default to an unreachable local address.
+
+Run it from the backend directory (exits with status 1 when over budget):
+    python -m bench.check_import_time --budget-seconds 4 --runs 3
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# Enough for the import to succeed; nothing may connect to it during the import
+PLACEHOLDER_DATABASE = {"DB_USER": "bench", "DB_PASSWORD": "bench", "DB_HOST": "127.0.0.1", "DB_PORT": "1", "DB_NAME": "bench"}
+
+# Also asserted by tests/test_import_time.py
+DEFAULT_BUDGET_SECONDS = 4.0
+
+IMPORT_TIME_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+def run_import(env: dict) -> tuple:
+    """
+    Imports app.main with -X importtime in a fresh interpreter.
+
+    Returns:
+        tuple: The total import seconds and the importtime lines of the top-level modules.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app.main"],
+                            cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing app.main failed:\n{result.stderr[-4000:]}")
+    modules = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if match:
+            modules.append((match.group(4), int(match.group(2)) / 1e6, len(match.group(3))))
+    total = next(seconds for name, seconds, _ in reversed(modules) if name == "app.main")
+    return total, modules
+
+def import_env() -> dict:
+    """
+    Returns the current environment with the placeholder database settings filled in.
+    """
+    env = dict(os.environ)
+    for name, value in PLACEHOLDER_DATABASE.items():
+        env.setdefault(name, value)
+    return env
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the backend against a budget")
+    parser.add_argument("--budget-seconds", type=float, default=DEFAULT_BUDGET_SECONDS)
+    parser.add_argument("--runs", type=int, default=3, help="The best run is compared, to discount a cold disk cache")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest direct imports of app.main to list")
+    args = parser.parse_args()
+
+    env = import_env()
+    runs = [run_import(env) for _ in range(args.runs)]
+    best, modules = min(runs, key=lambda run: run[0])
+    # Children are listed before their parent, so the import tree of app.main is the block that
+    # ends with it; its direct imports are one level deeper
+    end = max(i for i, (name, _, _) in enumerate(modules) if name == "app.main")
+    start = max((i for i, (_, _, depth) in enumerate(modules[:end]) if depth == 1), default=-1) + 1
+    top_level = sorted(((name, seconds) for name, seconds, depth in modules[start:end] if depth == 3),
+                       key=lambda item: item[1], reverse=True)
+    print(f"import app.main: {best:.3f}s (budget {args.budget_seconds:.3f}s, runs {[round(run[0], 3) for run in runs]})")
+    for name, seconds in top_level[:args.top]:
+        print(f"  {seconds:8.3f}s  {name}")
+    if best > args.budget_seconds:
+        print("Import time is over budget")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Offline benchmark of the backend API.
+
+Starts the stub Ollama server and the backend as subprocesses, then drives /upload-doc,
+/list-docs, /chat and /delete-doc at a configurable concurrency and writes the results as
+JSON: p50/p95/p99 latency and requests/s per endpoint, ingestion chunks/s and the peak RSS
+of the backend process.
+
+The backend needs a PostgreSQL database with the pgvector extension. With --start-db the
+harness runs a throwaway pgvector container through Docker for the duration of the run, so a
+single command reproduces the numbers; without it, the database is configured through the usual
+DB_USER, DB_PASSWORD, DB_HOST, DB_PORT and DB_NAME variables (for example the `database` service
+of docker-compose.yaml, published on port 6024). Nothing else needs a network or a GPU.
+
+Run it from the backend directory:
+    python -m bench.run_bench --start-db --concurrency 8 --chat-requests 200 --output bench-results.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import zipfile
+from datetime import datetime, timezone
+from pathlib import Path
+import httpx
+import numpy as np
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# Image of the throwaway database started by --start-db; the same as the database service of docker-compose.yaml
+DB_IMAGE = "pgvector/pgvector:pg16"
+
+# Vocabulary of the generated documents and questions, so retrieval finds overlapping words
+TOPICS = ["invoice", "contract", "shipment", "warranty", "payment", "refund", "supplier", "delivery",
+          "inventory", "customer", "license", "renewal", "audit", "budget", "forecast", "pricing"]
+
+def make_docx(paragraphs: list) -> bytes:
+    """
+    Builds a minimal .docx file containing the given paragraphs.
+    """
+    body = "".join(f"<w:p><w:r><w:t>{paragraph}</w:t></w:r></w:p>" for paragraph in paragraphs)
+    document = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                f"<w:body>{body}</w:body></w:document>")
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml",
+                         '<?xml version="1.0" encoding="UTF-8"?>'
+                         '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                         '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                         '<Default Extension="xml" ContentType="application/xml"/>'
+                         '<Override PartName="/word/document.xml" '
+                         'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+                         '</Types>')
+        archive.writestr("_rels/.rels",
+                         '<?xml version="1.0" encoding="UTF-8"?>'
+                         '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                         '<Relationship Id="rId1" Target="word/document.xml" '
+                         'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+                         '</Relationships>')
+        archive.writestr("word/document.xml", document)
+    return buffer.getvalue()
+
+def make_document(index: int, paragraphs: int, rng: np.random.Generator) -> bytes:
+    lines = []
+    for paragraph in range(paragraphs):
+        words = rng.choice(TOPICS, size=60)
+        lines.append(f"Document {index} section {paragraph}: " + " ".join(words) + ".")
+    return make_docx(lines)
+
+def summarize(latencies: list, errors: int, wall_seconds: float) -> dict:
+    """
+    Returns count, error count, requests/s and latency percentiles in milliseconds.
+    """
+    summary = {"requests": len(latencies) + errors, "errors": errors,
+               "requests_per_second": round(len(latencies) / wall_seconds, 2) if wall_seconds else None}
+    if latencies:
+        values = np.asarray(latencies) * 1000
+        summary.update({
+            "p50_ms": round(float(np.percentile(values, 50)), 2),
+            "p95_ms": round(float(np.percentile(values, 95)), 2),
+            "p99_ms": round(float(np.percentile(values, 99)), 2),
+            "mean_ms": round(float(values.mean()), 2),
+            "max_ms": round(float(values.max()), 2),
+        })
+    return summary
+
+async def drive(requests: list, concurrency: int) -> dict:
+    """
+    Runs request coroutine factories with at most `concurrency` in flight and summarizes them.
+
+    Each factory returns an awaitable httpx response; non-2xx responses count as errors.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, results = [], []
+    errors = 0
+
+    async def run(make_request):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await make_request()
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+                results.append(response.json())
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run(make_request) for make_request in requests))
+    return {"summary": summarize(latencies, errors, time.perf_counter() - started), "results": results}
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/ready")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"Backend was not ready after {timeout}s")
+
+async def wait_for_jobs(client: httpx.AsyncClient, job_ids: list, timeout: float) -> list:
+    deadline = time.monotonic() + timeout
+    pending = set(job_ids)
+    jobs = {}
+    while pending and time.monotonic() < deadline:
+        for job_id in list(pending):
+            job = (await client.get(f"/jobs/{job_id}")).json()
+            if job["status"] in ("completed", "failed"):
+                jobs[job_id] = job
+                pending.discard(job_id)
+        await asyncio.sleep(0.2)
+    if pending:
+        raise RuntimeError(f"{len(pending)} ingestion jobs did not finish within {timeout}s")
+    return list(jobs.values())
+
+def peak_rss_mb(pid: int):
+    """
+    Returns the peak resident set size (VmHWM) of a process in MiB, or None if unavailable.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+async def run_benchmark(args, backend_pid: int) -> dict:
+    rng = np.random.default_rng(args.seed)
+    timeout = httpx.Timeout(args.request_timeout)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.backend_port}", timeout=timeout) as client:
+        await wait_until_ready(client, args.startup_timeout)
+        results = {}
+
+        # Ingestion: upload every document at once and wait for the jobs to finish
+        documents = [(f"bench-{args.seed}-{i}.docx", make_document(i, args.paragraphs, rng)) for i in range(args.documents)]
+        started = time.perf_counter()
+        uploads = await drive([
+            (lambda name=name, content=content: client.post("/upload-doc", files={"file": (name, content)}))
+            for name, content in documents
+        ], args.concurrency)
+        job_ids = [upload["job_id"] for upload in uploads["results"] if upload.get("job_id")]
+        jobs = await wait_for_jobs(client, job_ids, args.ingestion_timeout)
+        ingestion_seconds = time.perf_counter() - started
+        chunks = sum(job["chunks_embedded"] for job in jobs)
+        results["upload_doc"] = uploads["summary"]
+        results["ingestion"] = {
+            "documents": len(jobs),
+            "failed": sum(job["status"] == "failed" for job in jobs),
+            "chunks": chunks,
+            "wall_seconds": round(ingestion_seconds, 3),
+            "chunks_per_second": round(chunks / ingestion_seconds, 2) if ingestion_seconds else None,
+            "embed_seconds": round(sum(job["embed_seconds"] or 0 for job in jobs), 3),
+            "db_seconds": round(sum(job["db_seconds"] or 0 for job in jobs), 3),
+        }
+
+        results["list_docs"] = (await drive(
+            [lambda: client.get("/list-docs") for _ in range(args.list_requests)], args.concurrency))["summary"]
+
+        # Chat: distinct sessions and questions, bypassing the answer cache unless asked not to
+        questions = [" ".join(rng.choice(TOPICS, size=4)) for _ in range(args.chat_requests)]
+        results["chat"] = (await drive([
+            (lambda question=question, i=i: client.post("/chat", json={
+                "prompt": f"What does the documentation say about {question}?",
+                "session_id": f"bench-{args.seed}-{i}",
+                "bypass_cache": not args.use_answer_cache,
+            }))
+            for i, question in enumerate(questions)
+        ], args.concurrency))["summary"]
+
+        file_ids = [upload["file_id"] for upload in uploads["results"] if upload.get("file_id") is not None]
+        results["delete_doc"] = (await drive([
+            (lambda file_id=file_id: client.post("/delete-doc", json={"file_id": file_id}))
+            for file_id in file_ids
+        ], args.concurrency))["summary"]
+
+        results["backend_peak_rss_mb"] = peak_rss_mb(backend_pid)
+        return results
+
+def start_process(command: list, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+
+def start_database(port: int, timeout: float) -> tuple:
+    """
+    Starts a throwaway PostgreSQL + pgvector container published on 127.0.0.1:port and waits until it accepts connections.
+
+    The container is removed when it is stopped, so every run starts from an empty database.
+
+    Returns:
+        tuple: The container name and the DB_* variables that point the backend at it.
+    """
+    name = f"rag-bench-db-{os.getpid()}"
+    subprocess.run(["docker", "run", "--rm", "--detach", "--name", name,
+                    "-e", "POSTGRES_USER=bench", "-e", "POSTGRES_PASSWORD=bench", "-e", "POSTGRES_DB=bench",
+                    "-p", f"127.0.0.1:{port}:5432", DB_IMAGE], check=True, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    # Over TCP, so the temporary server that runs during initdb (Unix socket only) does not count as ready
+    while subprocess.run(["docker", "exec", name, "pg_isready", "-h", "127.0.0.1", "-U", "bench", "-d", "bench"],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+        if time.monotonic() > deadline:
+            stop_database(name)
+            raise TimeoutError(f"The database container did not become ready within {timeout} seconds")
+        time.sleep(1)
+    return name, {"DB_USER": "bench", "DB_PASSWORD": "bench", "DB_HOST": "127.0.0.1", "DB_PORT": str(port), "DB_NAME": "bench"}
+
+def stop_database(name: str):
+    subprocess.run(["docker", "stop", name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the RAG chatbot backend")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--chat-requests", type=int, default=100)
+    parser.add_argument("--list-requests", type=int, default=100)
+    parser.add_argument("--documents", type=int, default=4)
+    parser.add_argument("--paragraphs", type=int, default=200, help="Paragraphs of about 400 characters per document")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="Seconds per streamed answer token")
+    parser.add_argument("--response-tokens", type=int, default=64)
+    parser.add_argument("--embed-latency", type=float, default=0.005)
+    parser.add_argument("--use-answer-cache", action="store_true", help="Let /chat serve answers from the answer cache")
+    parser.add_argument("--backend-port", type=int, default=8001)
+    parser.add_argument("--stub-port", type=int, default=11500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-timeout", type=float, default=120)
+    parser.add_argument("--ingestion-timeout", type=float, default=600)
+    parser.add_argument("--request-timeout", type=float, default=300)
+    parser.add_argument("--start-db", action="store_true",
+                        help=f"Run a throwaway {DB_IMAGE} container with Docker instead of using the DB_* variables")
+    parser.add_argument("--db-port", type=int, default=6025, help="Host port of the --start-db container")
+    parser.add_argument("--output", default="bench-results.json")
+    args = parser.parse_args()
+
+    env = dict(os.environ, OLLAMA_URL=f"http://127.0.0.1:{args.stub_port}")
+    database = None
+    if args.start_db:
+        database, db_env = start_database(args.db_port, args.startup_timeout)
+        env.update(db_env)
+    stub = start_process([sys.executable, "-m", "bench.stub_ollama", "--port", str(args.stub_port),
+                          "--token-latency", str(args.token_latency), "--response-tokens", str(args.response_tokens),
+                          "--embed-latency", str(args.embed_latency)], env)
+    backend = start_process([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+                             "--port", str(args.backend_port), "--log-level", "warning"], env)
+    try:
+        results = asyncio.run(run_benchmark(args, backend.pid))
+    finally:
+        backend.terminate()
+        stub.terminate()
+        backend.wait()
+        stub.wait()
+        if database is not None:
+            stop_database(database)
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": vars(args),
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Stand-in for the Ollama HTTP API used by the benchmark harness.
+
+Implements the endpoints the backend calls (/api/chat, /api/generate, /api/embed and /api/ps)
+without a GPU or model weights. Chat answers are streamed word by word with a configurable
+per-token latency, and embeddings are deterministic hashed bag-of-words vectors, so texts that
+share words are close to each other and retrieval behaves sensibly.
+
+Run it with:
+    python -m bench.stub_ollama --port 11500 --token-latency 0.02 --response-tokens 64
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import re
+import time
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+app = FastAPI()
+
+# Overridden from the command line
+config = {
+    "token_latency": 0.02,
+    "response_tokens": 64,
+    "embed_latency": 0.005,
+    "dimension": 1024,
+}
+
+# Models "loaded" by a request, reported by /api/ps
+loaded_models = {}
+
+WORD_RE = re.compile(r"\w+")
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+def mark_loaded(model: str, keep_alive=None):
+    name = model if ":" in model else f"{model}:latest"
+    seconds = keep_alive if isinstance(keep_alive, (int, float)) else 300
+    loaded_models[name] = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+def embed_text(text: str) -> list:
+    """
+    Returns a deterministic unit vector: each word adds 1 to a dimension chosen by its hash.
+    """
+    vector = np.zeros(config["dimension"], dtype=np.float32)
+    for word in WORD_RE.findall(text.lower()):
+        digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+        vector[int.from_bytes(digest, "little") % config["dimension"]] += 1.0
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0] = 1.0
+        norm = 1.0
+    return (vector / norm).tolist()
+
+def count_tokens(text: str) -> int:
+    return len(WORD_RE.findall(text))
+
+@app.post("/api/embed")
+async def embed(request: Request):
+    body = await request.json()
+    mark_loaded(body["model"], body.get("keep_alive"))
+    inputs = body.get("input", "")
+    inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+    await asyncio.sleep(config["embed_latency"])
+    return {"model": body["model"], "embeddings": [embed_text(text) for text in inputs],
+            "prompt_eval_count": sum(count_tokens(text) for text in inputs)}
+
+@app.post("/api/generate")
+async def generate(request: Request):
+    # Only used for warm-up: an empty prompt loads the model
+    body = await request.json()
+    mark_loaded(body["model"], body.get("keep_alive"))
+    return {"model": body["model"], "created_at": now(), "response": "", "done": True, "done_reason": "load"}
+
+@app.post("/api/chat")
+async def chat(request: Request):
+    body = await request.json()
+    model = body["model"]
+    mark_loaded(model, body.get("keep_alive"))
+    prompt_tokens = sum(count_tokens(str(message.get("content", ""))) for message in body.get("messages", []))
+    words = [f"token{i}" for i in range(config["response_tokens"])]
+
+    def final(started: float) -> dict:
+        elapsed_ns = int((time.perf_counter() - started) * 1e9)
+        return {"model": model, "created_at": now(), "message": {"role": "assistant", "content": ""},
+                "done": True, "done_reason": "stop", "total_duration": elapsed_ns,
+                "prompt_eval_count": prompt_tokens, "eval_count": len(words), "eval_duration": max(elapsed_ns, 1)}
+
+    if not body.get("stream", True):
+        started = time.perf_counter()
+        await asyncio.sleep(config["token_latency"] * len(words))
+        response = final(started)
+        response["message"]["content"] = " ".join(words)
+        return response
+
+    async def stream():
+        started = time.perf_counter()
+        for word in words:
+            await asyncio.sleep(config["token_latency"])
+            yield json.dumps({"model": model, "created_at": now(),
+                              "message": {"role": "assistant", "content": word + " "}, "done": False}) + "\n"
+        yield json.dumps(final(started)) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/api/ps")
+async def ps():
+    current = datetime.now(timezone.utc)
+    return {"models": [
+        {"name": name, "model": name, "digest": "", "size": 0, "size_vram": 0,
+         "expires_at": expires_at.isoformat(), "details": {}}
+        for name, expires_at in loaded_models.items() if expires_at > current
+    ]}
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub Ollama server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--token-latency", type=float, default=config["token_latency"],
+                        help="Seconds between streamed answer tokens")
+    parser.add_argument("--response-tokens", type=int, default=config["response_tokens"])
+    parser.add_argument("--embed-latency", type=float, default=config["embed_latency"],
+                        help="Seconds per /api/embed request")
+    parser.add_argument("--dimension", type=int, default=config["dimension"])
+    args = parser.parse_args()
+    config.update(token_latency=args.token_latency, response_tokens=args.response_tokens,
+                  embed_latency=args.embed_latency, dimension=args.dimension)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+from app.embedded_store_utils import NumpyVectorStore
+
+DIMENSION = 4
+
+class FakeEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return [1.0, float(len(text)), 0.0, 1.0]
+
+def open_store(path, **kwargs) -> NumpyVectorStore:
+    return NumpyVectorStore(str(path), FakeEmbeddings(), DIMENSION, segment_size=4, **kwargs)
+
+def add_chunks(store: NumpyVectorStore, file_id: int, count: int) -> list:
+    vectors = np.random.default_rng(file_id).normal(size=(count, DIMENSION))
+    return store.add_embeddings([f"f{file_id}-{n}" for n in range(count)], vectors,
+                                [{"file_id": file_id} for _ in range(count)])
+
+def live_texts(store: NumpyVectorStore) -> set:
+    return {segment.texts[row] for segment in store.segments for row in np.flatnonzero(segment.alive[:segment.count])}
+
+def test_appends_fill_segments_and_survive_reload(tmp_path):
+    store = open_store(tmp_path)
+    add_chunks(store, 1, 6)
+    add_chunks(store, 2, 3)
+    assert [segment.count for segment in store.segments] == [4, 4, 1]
+
+    reopened = open_store(tmp_path)
+    assert reopened.stats()["live_rows"] == 9
+    assert live_texts(reopened) == live_texts(store)
+
+def test_deletes_are_tombstoned_and_survive_reload(tmp_path):
+    store = open_store(tmp_path)
+    ids = add_chunks(store, 1, 3)
+    add_chunks(store, 2, 2)
+    assert store.delete([ids[0]])
+    assert store.delete_by_file_id(2) == 2
+
+    reopened = open_store(tmp_path)
+    assert live_texts(reopened) == {"f1-1", "f1-2"}
+    assert reopened.stats()["deleted_rows"] == 3
+
+def test_compaction_drops_deleted_rows(tmp_path):
+    store = open_store(tmp_path)
+    add_chunks(store, 1, 6)
+    add_chunks(store, 2, 3)
+    store.delete_by_file_id(1)
+    store.compact()
+
+    assert store.generation == 1
+    assert store.stats()["rows"] == 3
+    assert list(tmp_path.glob("g0-*")) == []
+    reopened = open_store(tmp_path)
+    assert reopened.generation == 1
+    assert live_texts(reopened) == {"f2-0", "f2-1", "f2-2"}
+
+def test_failed_compaction_keeps_the_old_generation(tmp_path, monkeypatch):
+    store = open_store(tmp_path)
+    ids = add_chunks(store, 1, 6)
+    store.delete(ids[:2])
+    fill = NumpyVectorStore._fill
+    calls = 0
+
+    def failing_fill(self, *args, **kwargs):
+        nonlocal calls
+        calls += 1
+        if calls > 1:
+            raise OSError("disk full")
+        return fill(self, *args, **kwargs)
+    monkeypatch.setattr(NumpyVectorStore, "_fill", failing_fill)
+    with pytest.raises(OSError):
+        store.compact()
+    monkeypatch.setattr(NumpyVectorStore, "_fill", fill)
+
+    # The partial segments are gone and later deletes still go to the old tombstone log
+    assert store.generation == 0
+    assert list(tmp_path.glob("g1-*")) == []
+    store.delete([ids[2]])
+    reopened = open_store(tmp_path)
+    assert reopened.generation == 0
+    assert live_texts(reopened) == {"f1-3", "f1-4", "f1-5"}
+
+def test_reload_discards_a_compaction_interrupted_before_the_manifest_swap(tmp_path):
+    store = open_store(tmp_path)
+    ids = add_chunks(store, 1, 6)
+    store.delete(ids[:2])
+    # A crash after writing part of the next generation, before the manifest points at it
+    store._fill([], ["x"], ["partial"], [{"file_id": 1}], np.ones((1, DIMENSION)), generation=1)
+    assert list(tmp_path.glob("g1-*"))
+
+    reopened = open_store(tmp_path)
+    assert list(tmp_path.glob("g1-*")) == []
+    assert reopened.generation == 0
+    assert live_texts(reopened) == {"f1-2", "f1-3", "f1-4", "f1-5"}
+
+def test_search_filters_by_file_id(tmp_path):
+    store = open_store(tmp_path)
+    add_chunks(store, 1, 5)
+    add_chunks(store, 2, 5)
+    query = FakeEmbeddings().embed_query("q")
+
+    hits = store.similarity_search_by_vector(query, k=10, filter={"file_id": 2})
+    assert {doc.metadata["file_id"] for doc in hits} == {2}
+    assert len(hits) == 5
+    hits = store.similarity_search_by_vector(query, k=3, filter={"file_id": [1, 2]})
+    assert len(hits) == 3
+    assert store.similarity_search_by_vector(query, k=3, filter={"file_id": 3}) == []
@@ -0,0 +1,58 @@
+import asyncio
+from datetime import datetime
+from app import history_utils
+from app.history_utils import ApplicationLogWriter
+
+class FakeSession:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def commit(self):
+        pass
+
+def make_turn(n: int) -> dict:
+    return {"id": None, "session_id": "s", "user_query": f"q{n}", "LLM_response": f"a{n}", "model": "m",
+            "created_at": datetime.now()}
+
+def test_full_buffer_drops_turns_while_flushes_fail(monkeypatch):
+    async def failing_insert(db, rows):
+        raise ConnectionError("database unreachable")
+    monkeypatch.setattr(history_utils, "AsyncSessionLocal", FakeSession)
+    monkeypatch.setattr(history_utils, "ainsert_application_log_batch", failing_insert)
+    writer = ApplicationLogWriter(batch_size=2, flush_interval=60, max_rows=3)
+
+    async def record():
+        return [await writer.add(make_turn(n)) for n in range(6)]
+
+    assert asyncio.run(record()) == [True, True, True, False, False, False]
+    assert len(writer.pending) == 3
+    assert writer.stats()["dropped_rows"] == 3
+    # Only the first add to the full buffer tried a flush; the next ones wait for flush_interval
+    assert writer.failed_flushes == 1
+
+def test_buffer_accepts_turns_again_once_the_database_is_back(monkeypatch):
+    database_up = False
+
+    async def insert(db, rows):
+        if not database_up:
+            raise ConnectionError("database unreachable")
+        return list(range(1, len(rows) + 1))
+    monkeypatch.setattr(history_utils, "AsyncSessionLocal", FakeSession)
+    monkeypatch.setattr(history_utils, "ainsert_application_log_batch", insert)
+    writer = ApplicationLogWriter(batch_size=2, flush_interval=0, max_rows=2)
+
+    async def record():
+        nonlocal database_up
+        outcomes = [await writer.add(make_turn(n)) for n in range(3)]
+        database_up = True
+        outcomes.append(await writer.add(make_turn(3)))
+        return outcomes
+
+    assert asyncio.run(record()) == [True, True, False, True]
+    # The flush before the last turn wrote the two buffered turns
+    assert [turn["user_query"] for turn in writer.pending] == ["q3"]
+    assert writer.stats()["rows_written"] == 2
+    assert writer.stats()["dropped_rows"] == 1
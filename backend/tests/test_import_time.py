@@ -0,0 +1,7 @@
+from bench.check_import_time import DEFAULT_BUDGET_SECONDS, import_env, run_import
+
+def test_app_main_imports_within_budget():
+    env = import_env()
+    # The best of three runs, as bench.check_import_time compares, to discount a cold disk cache
+    best = min(run_import(env)[0] for _ in range(3))
+    assert best <= DEFAULT_BUDGET_SECONDS, f"import app.main took {best:.3f}s, over the {DEFAULT_BUDGET_SECONDS}s budget"
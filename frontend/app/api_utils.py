@@ -1,34 +1,51 @@
+import json
 import requests
 import streamlit as st
 
-def get_api_response(prompt, session_id, model):
-    headers = {'accept': 'application/json', 'Content-Type': 'application/json'}
+# (connect, read) timeouts for chat requests, so a saturated backend does not hang the UI
+CHAT_TIMEOUT = (5, 300)
+
+def show_busy_warning(response):
+    retry_after = response.headers.get("Retry-After")
+    st.warning(f"The server is busy, please try again in {retry_after} seconds." if retry_after
+               else "The server is busy, please try again shortly.")
+
+def stream_api_response(prompt, session_id, model):
+    """
+    Streams a chat response from the backend, yielding each event as a dictionary.
+    Event types are "sources", "token", "done" and "error".
+    """
+    headers = {'accept': 'application/x-ndjson', 'Content-Type': 'application/json'}
     data = {"prompt": prompt, "model": model}
     if session_id:
         data["session_id"] = session_id
 
     try:
-        response = requests.post("http://LLMRAGCHATBOT_Backend:8000/chat", headers=headers, json=data)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            st.error(f"API request failed with status code {response.status_code}: {response.text}")
-            return None
+        with requests.post("http://LLMRAGCHATBOT_Backend:8000/chat/stream", headers=headers, json=data, stream=True, timeout=CHAT_TIMEOUT) as response:
+            if response.status_code in (429, 503):
+                show_busy_warning(response)
+                return
+            if response.status_code != 200:
+                st.error(f"API request failed with status code {response.status_code}: {response.text}")
+                return
+            for line in response.iter_lines(decode_unicode=True):
+                if line:
+                    yield json.loads(line)
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")
-        return None
 
-def upload_document(file):
+def upload_documents(files):
     try:
-        files = {"file": (file.name, file, file.type)}
-        response = requests.post("http://LLMRAGCHATBOT_Backend:8000/upload-doc", files=files)
+        # Several files under the same field name; archives are extracted by the backend
+        payload = [("files", (file.name, file, file.type)) for file in files]
+        response = requests.post("http://LLMRAGCHATBOT_Backend:8000/upload-docs", files=payload)
         if response.status_code == 200:
             return response.json()
         else:
-            st.error(f"Failed to upload file. Error: {response.status_code} - {response.text}")
+            st.error(f"Failed to upload files. Error: {response.status_code} - {response.text}")
             return None
     except Exception as e:
-        st.error(f"An error occurred while uploading the file: {str(e)}")
+        st.error(f"An error occurred while uploading the files: {str(e)}")
         return None
 
 def list_documents():
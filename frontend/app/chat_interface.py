@@ -1,5 +1,5 @@
 import streamlit as st
-from api_utils import get_api_response
+from api_utils import stream_api_response
 
 def display_chat_interface():
     # Display chat history
@@ -13,23 +13,39 @@ def display_chat_interface():
         with st.chat_message("user"):
             st.markdown(prompt)
 
-        # Get API response
-        with st.spinner("Generating response..."):
-            response = get_api_response(prompt, st.session_state.session_id, st.session_state.model)
+        # Collects the sources and final metadata while the tokens are rendered
+        response = {}
 
-            if response:
-                st.session_state.session_id = response.get('session_id')
-                st.session_state.messages.append({"role": "assistant", "content": response['answer']})
+        def token_stream():
+            for event in stream_api_response(prompt, st.session_state.session_id, st.session_state.model):
+                if event["type"] == "sources":
+                    response["sources"] = event["sources"]
+                elif event["type"] == "token":
+                    yield event["content"]
+                elif event["type"] == "done":
+                    response.update(event)
+                elif event["type"] == "error":
+                    st.error(f"An error occurred while generating the response: {event['detail']}")
 
-                with st.chat_message("assistant"):
-                    st.markdown(response['answer'])
+        # Render the answer token by token as it arrives
+        with st.chat_message("assistant"):
+            answer = st.write_stream(token_stream())
 
-                with st.expander("Details"):
-                    st.subheader("Generated Answer")
-                    st.code(response['answer'])
-                    st.subheader("Model Used")
-                    st.code(response['model'])
-                    st.subheader("Session ID")
-                    st.code(response['session_id'])
-            else:
-                st.error("Failed to get a response from the API. Please try again.")
+        if "session_id" in response:
+            st.session_state.session_id = response['session_id']
+            st.session_state.messages.append({"role": "assistant", "content": answer})
+
+            with st.expander("Details"):
+                st.subheader("Generated Answer")
+                st.code(answer)
+                st.subheader("Model Used")
+                st.code(response['model'])
+                st.subheader("Session ID")
+                st.code(response['session_id'])
+                if response.get("sources"):
+                    st.subheader("Sources")
+                    for source in response["sources"]:
+                        st.markdown(f"**{source['source']}** (page {source['page']}, file ID {source['file_id']})")
+                        st.text(source["content"])
+        else:
+            st.error("Failed to get a response from the API. Please try again.")
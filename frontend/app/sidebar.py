@@ -1,5 +1,5 @@
 import streamlit as st
-from api_utils import upload_document, list_documents, delete_document
+from api_utils import upload_documents, list_documents, delete_document
 
 def display_sidebar():
     """
@@ -9,17 +9,27 @@ def display_sidebar():
     model_options = ["gemma3:4b", "gemma3:1b"]
     st.sidebar.selectbox("Select Model", options=model_options, key="model") #the user’s selection is automatically stored in st.session_state under the key
 
-    # Document upload
-    uploaded_file = st.sidebar.file_uploader("Choose a file", type=["pdf", "docx", "html"])
-    if uploaded_file is not None and st.sidebar.button("Upload"):
+    # Document upload: one or more documents, or zip/tar archives of them; the archive types follow the
+    # backend's ARCHIVE_EXTENSIONS (.zip, .tar, .tar.gz, .tgz, .tar.bz2, .tar.xz), matched on the last suffix
+    uploaded_files = st.sidebar.file_uploader("Choose files", type=["pdf", "docx", "html", "zip", "tar", "gz", "tgz", "bz2", "xz"],
+                                              accept_multiple_files=True)
+    if uploaded_files and st.sidebar.button("Upload"):
         with st.spinner("Uploading..."):
             """
-            Uploads the selected file to the server. If the upload is successful,
-            the file ID is displayed in the sidebar.
+            Uploads the selected files to the server and displays the outcome of each
+            document in the sidebar.
             """
-            upload_response = upload_document(uploaded_file)
+            upload_response = upload_documents(uploaded_files)
             if upload_response is not None:
-                st.sidebar.success(f"File uploaded successfully with ID {upload_response['file_id']}.")
+                counts = upload_response["counts"]
+                if counts["queued"]:
+                    st.sidebar.success(f"{counts['queued']} file(s) queued for indexing. "
+                                       "They appear in the document list once indexing completes.")
+                for result in upload_response["files"]:
+                    if result["status"] == "duplicate":
+                        st.sidebar.info(f"{result['filename']} was already uploaded with ID {result['file_id']}.")
+                    elif result["status"] in ("skipped", "error"):
+                        st.sidebar.warning(f"{result['filename']}: {result['detail']}")
                 st.session_state.documents = list_documents()
 
     # List and delete documents